@@ -0,0 +1,927 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import copy
+import traceback
+import msgpack
+import tornadis
+from tornado import gen
+from tornado.concurrent import Future
+from bson import ObjectId
+from compress import Compressor
+from dal import NEARCACHE_CHANNEL, KW_CLEAR_SCRIPT, command_unsupported, script_unsupported, generate_key, encode_value, decode_value, stringify_ids, unwrap_swr, kw_keys, get_range_by_page, page_meta_key, parse_page_meta, \
+    encode_page_token, decode_page_token, keyset_query, keyset_sort
+
+"""
+AsyncDal是Dal的tornado协程版本,redis使用tornadis.Client,mongodb使用motor的数据库对象
+与Dal共用generate_key和encode_value/decode_value,两者可以同时读写同一份缓存
+使用方式: result = yield dal.find_one(table, query={...})
+"""
+class AsyncRedisProxy(object):
+    def __init__(self, dal):
+        self.dal = dal
+        self.unlink_supported = True
+        #同RedisProxy.kw_clear_script: False为脚本不可用,之后直接使用pipeline
+        self.kw_clear_script = True
+
+    def generateKey(self, table, prefix="", query={}, sort=None, limit=None, name="tablecache", criteria=None, pack=True):
+        return generate_key(table, prefix, query, sort=sort, limit=limit, name=name, criteria=criteria, pack=pack, hashed=self.dal.hashed_keys)
+
+    #执行一条redis命令,tornadis以返回值的形式给出错误,这里转换为异常
+    @gen.coroutine
+    def call(self, *args):
+        result = yield self.dal.get_redis().call(*args)
+        if isinstance(result, tornadis.TornadisException):
+            raise result
+        raise gen.Return(result)
+
+    #一次往返执行多条命令,commands为参数tuple的列表
+    #tornadis的Pipeline不支持事务,transaction为True时用MULTI/EXEC包裹,返回EXEC的结果
+    @gen.coroutine
+    def pipeline(self, commands, transaction=False):
+        pipe_cmd = tornadis.Pipeline()
+        if transaction:
+            pipe_cmd.stack_call("MULTI")
+        for args in commands:
+            pipe_cmd.stack_call(*args)
+        if transaction:
+            pipe_cmd.stack_call("EXEC")
+        result = yield self.dal.get_redis().call(pipe_cmd)
+        if isinstance(result, tornadis.TornadisException):
+            raise result
+        if transaction:
+            result = result[-1]
+            if isinstance(result, tornadis.TornadisException):
+                raise result
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def strict_set(self, key, value, cache_time=0, pack=True):
+        try:
+            args = ["SET", key, encode_value(value, pack, self.dal.compressor) if pack else value]
+            if cache_time:
+                args += ["EX", cache_time]
+            result = yield self.call(*args)
+            if self.dal.debug:
+                self.dal.logger.debug("[AsyncRedisProxy.strict_set]key=%s, cache_time=%s, result=%s" %(key, cache_time, result))
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_set]error, %s" %traceback.format_exc())
+
+    @gen.coroutine
+    def strict_get(self, key, pack=True):
+        result = None
+        try:
+            result = yield self.call("GET", key)
+            if self.dal.debug:
+                self.dal.logger.debug("[AsyncRedisProxy.strict_get]key=%s" %(key))
+            if not result:
+                result = None
+            elif pack:
+                result = decode_value(result, pack, self.dal.compressor)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_get]error, %s" %traceback.format_exc())
+            result = None
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def strict_mget(self, keys, pack=True):
+        result = []
+        if keys:
+            try:
+                result = yield self.call("MGET", *keys)
+                if pack:
+                    result = [decode_value(value, pack, self.dal.compressor) if value else None for value in result]
+            except Exception:
+                self.dal.logger.error("[AsyncRedisProxy.strict_mget]error, %s" %traceback.format_exc())
+                result = [None] * len(keys)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def strict_pipeline_set(self, key_value_dict, cache_time=0, pack=True):
+        if not key_value_dict:
+            return
+        try:
+            commands = []
+            for key, value in key_value_dict.iteritems():
+                if pack:
+                    value = encode_value(value, pack, self.dal.compressor)
+                commands.append(("SET", key, value, "EX", cache_time) if cache_time else ("SET", key, value))
+            yield self.pipeline(commands)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_pipeline_set]error, %s" %traceback.format_exc())
+
+    @gen.coroutine
+    def strict_setex(self, key, seconds, value, pack=True):
+        try:
+            if pack:
+                value = msgpack.packb(value)
+            yield self.call("SETEX", key, seconds, value)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_setex]error, %s" %traceback.format_exc())
+
+    @gen.coroutine
+    def strict_setnx(self, key, value, cache_time=43200):
+        result = None
+        try:
+            args = ["SET", key, value, "NX"]
+            if cache_time:
+                args += ["EX", cache_time]
+            result = yield self.call(*args)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_setnx]error, %s" %traceback.format_exc())
+        raise gen.Return(bool(result))
+
+    @gen.coroutine
+    def strict_incr(self, key):
+        try:
+            yield self.call("INCR", key)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_incr]error, %s" %traceback.format_exc())
+
+    @gen.coroutine
+    def strict_incrby(self, key, increment):
+        try:
+            yield self.call("INCRBY", key, increment)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_incrby]error, %s" %traceback.format_exc())
+
+    @gen.coroutine
+    def set(self, table, prefix="", value={}, query={}, cache_time=3600, sort=None, limit=None, cache_kw=None, criteria=None, pack=True):
+        key = self.generateKey(table, prefix, query, sort=sort, limit=limit, criteria=criteria, pack=pack)
+        try:
+            args = ["SET", key, encode_value(value, pack, self.dal.compressor)]
+            if cache_time:
+                args += ["EX", cache_time]
+            result = yield self.call(*args)
+            if self.dal.debug:
+                self.dal.logger.debug("[AsyncRedisProxy.set]key=%s, result=%s" %(key, result))
+            if cache_kw:
+                yield self.dal.cacheKeyword(key, query, cache_kw)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.set]error, %s" %traceback.format_exc())
+
+    @gen.coroutine
+    def get(self, table, prefix="", query={}, cache_time=0, sort=None, limit=None, criteria=None, pack=True):
+        key = self.generateKey(table, prefix, query, sort=sort, limit=limit, criteria=criteria, pack=pack)
+        result = None
+        try:
+            result = yield self.call("GET", key)
+            if result:
+                result = unwrap_swr(decode_value(result, pack, self.dal.compressor))
+            else:
+                result = None
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.get]error, %s" %traceback.format_exc())
+            result = None
+        if self.dal.debug:
+            self.dal.logger.debug("[AsyncRedisProxy.get]key=%s, status=%s" %(key, result is not None))
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def strict_lpush(self, key, value, prefix="", pack=True):
+        if prefix:
+            key = key + "_" + prefix
+        try:
+            if pack:
+                value = msgpack.packb(value)
+            yield self.call("LPUSH", key, value)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_lpush]error, %s" %traceback.format_exc())
+
+    @gen.coroutine
+    def strict_lrange(self, key, start, stop, prefix="", pack=True):
+        if prefix:
+            key = key + "_" + prefix
+        result = None
+        try:
+            result = yield self.call("LRANGE", key, start, stop)
+            if pack:
+                result = [msgpack.unpackb(r, use_list = True) for r in result]
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_lrange]error, %s" %traceback.format_exc())
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def strict_sadd(self, key, member, prefix="", pack=True, cache_time=0):
+        if prefix:
+            key = key + "_" + prefix
+        try:
+            members = member if isinstance(member, list) else [member]
+            if pack:
+                members = [msgpack.packb(m) for m in members]
+            if cache_time:
+                yield self.pipeline([("SADD", key) + tuple(members), ("EXPIRE", key, cache_time)], transaction=True)
+            else:
+                yield self.call("SADD", key, *members)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_sadd]error, %s" %traceback.format_exc())
+
+    @gen.coroutine
+    def strict_srem(self, key, member, prefix=""):
+        if prefix:
+            key = key + "_" + prefix
+        try:
+            members = member if isinstance(member, list) else [member]
+            yield self.call("SREM", key, *members)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_srem]error, %s" %traceback.format_exc())
+
+    @gen.coroutine
+    def strict_sinter(self, key, prefix="", pack=True):
+        if prefix:
+            key = key + "_" + prefix
+        result = None
+        try:
+            result = yield self.call("SINTER", key)
+            if pack and result:
+                result = [msgpack.unpackb(value, use_list = True) for value in result]
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_sinter]error, %s" %traceback.format_exc())
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def strict_scard(self, key, prefix=""):
+        if prefix:
+            key = key + "_" + prefix
+        result = None
+        try:
+            result = yield self.call("SCARD", key)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_scard]error, %s" %traceback.format_exc())
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def strict_sismember(self, key, member, prefix=""):
+        if prefix:
+            key = key + "_" + prefix
+        result = None
+        try:
+            result = yield self.call("SISMEMBER", key, member)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_sismember]error, %s" %traceback.format_exc())
+        raise gen.Return(bool(result))
+
+    @gen.coroutine
+    def strict_zadd(self, key, value, score=0, prefix="", cache_time=0):
+        if prefix:
+            key = key + "_" + prefix
+        try:
+            if cache_time:
+                yield self.pipeline([("ZADD", key, score, value), ("EXPIRE", key, cache_time)], transaction=True)
+            else:
+                yield self.call("ZADD", key, score, value)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_zadd]error, %s" %traceback.format_exc())
+
+    #sets为(member, score)列表,与Dal.load_page_data写入的格式一致;按chunk_size分批ZADD
+    @gen.coroutine
+    def strict_pipeline_zadd(self, key, sets, prefix="", cache_time=0, chunk_size=1000):
+        if prefix:
+            key = key + "_" + prefix
+        try:
+            commands = []
+            for i in xrange(0, len(sets), chunk_size):
+                args = ["ZADD", key]
+                for value, score in sets[i:i+chunk_size]:
+                    args += [score, value]
+                commands.append(tuple(args))
+            if cache_time:
+                commands.append(("EXPIRE", key, cache_time))
+            if commands:
+                yield self.pipeline(commands)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_pipeline_zadd]error, %s" %traceback.format_exc())
+
+    @gen.coroutine
+    def _zrange(self, cmd, key, start, stop, prefix="", withscores=False):
+        if prefix:
+            key = key + "_" + prefix
+        result = None
+        try:
+            if withscores:
+                result = yield self.call(cmd, key, start, stop, "WITHSCORES")
+                result = [(result[i], float(result[i+1])) for i in xrange(0, len(result), 2)]
+            else:
+                result = yield self.call(cmd, key, start, stop)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.%s]error, %s" %(cmd, traceback.format_exc()))
+        raise gen.Return(result)
+
+    #同RedisProxy.page_index_range: 一次往返读取分页索引的元数据和start到stop的_id
+    @gen.coroutine
+    def page_index_range(self, key, start, stop):
+        result = (None, [])
+        try:
+            meta_key = page_meta_key(key)
+            exists, meta, ttl, ids = yield self.pipeline([("EXISTS", key), ("HGETALL", meta_key), ("TTL", meta_key), ("ZRANGE", key, start, stop)])
+            meta = parse_page_meta(dict(zip(meta[::2], meta[1::2])), ttl)
+            if meta is not None and (exists or not meta["loaded"]):
+                result = (meta, ids)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.page_index_range]error, %s" %traceback.format_exc())
+        raise gen.Return(result)
+
+    #同RedisProxy.page_index_extend
+    @gen.coroutine
+    def page_index_extend(self, key, ids, offset, total, cache_time=0, chunk_size=1000):
+        meta_key = page_meta_key(key)
+        try:
+            commands = []
+            if offset == 0:
+                commands.append(("DEL", key, meta_key))
+            for i in xrange(0, len(ids), chunk_size):
+                args = ["ZADD", key]
+                for j, _id in enumerate(ids[i:i+chunk_size]):
+                    args += [offset + i + j, _id]
+                commands.append(tuple(args))
+            commands.append(("HMSET", meta_key, "total", total, "loaded", offset + len(ids)))
+            if cache_time and cache_time > 0:
+                commands.append(("EXPIRE", key, cache_time))
+                commands.append(("EXPIRE", meta_key, cache_time))
+            yield self.pipeline(commands, transaction=True)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.page_index_extend]error, %s" %traceback.format_exc())
+
+    def strict_zrange(self, key, start, stop, prefix="", withscores=False):
+        return self._zrange("ZRANGE", key, start, stop, prefix, withscores)
+
+    def strict_zrevrange(self, key, start, stop, prefix="", withscores=False):
+        return self._zrange("ZREVRANGE", key, start, stop, prefix, withscores)
+
+    @gen.coroutine
+    def strict_zcard(self, key, prefix=""):
+        if prefix:
+            key = key + "_" + prefix
+        result = 0
+        try:
+            result = yield self.call("ZCARD", key)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_zcard]error, %s" %traceback.format_exc())
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def strict_zrem(self, key, member, prefix=""):
+        if prefix:
+            key = key + "_" + prefix
+        try:
+            yield self.call("ZREM", key, *member)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_zrem]error, %s" %traceback.format_exc())
+
+    @gen.coroutine
+    def strict_hset(self, key, hkey, value, prefix="", pack=True, cache_time=0):
+        if prefix:
+            key = key + "_" + prefix
+        try:
+            if pack and value:
+                value = msgpack.packb(value)
+            if cache_time:
+                yield self.pipeline([("HSET", key, hkey, value), ("EXPIRE", key, cache_time)], transaction=True)
+            else:
+                yield self.call("HSET", key, hkey, value)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_hset]error, %s" %traceback.format_exc())
+
+    @gen.coroutine
+    def strict_hget(self, key, hkey, prefix="", pack=True):
+        if prefix:
+            key = key + "_" + prefix
+        result = None
+        try:
+            result = yield self.call("HGET", key, hkey)
+            if pack and result:
+                result = msgpack.unpackb(result, use_list = True)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_hget]error, %s" %traceback.format_exc())
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def strict_hdel(self, key, hkeys, prefix=""):
+        if prefix:
+            key = key + "_" + prefix
+        try:
+            hkeys = hkeys if isinstance(hkeys, list) else [hkeys]
+            yield self.call("HDEL", key, *hkeys)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_hdel]error, %s" %traceback.format_exc())
+
+    @gen.coroutine
+    def strict_hincrby(self, key, hkey, prefix="", increment=1):
+        if prefix:
+            key = key + "_" + prefix
+        result = None
+        try:
+            result = yield self.call("HINCRBY", key, hkey, increment)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_hincrby]error, %s" %traceback.format_exc())
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def exists(self, key, prefix=""):
+        if prefix:
+            key = key + "_" + prefix
+        result = None
+        try:
+            result = yield self.call("EXISTS", key)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.exists]error, %s" %traceback.format_exc())
+        raise gen.Return(bool(result))
+
+    @gen.coroutine
+    def delete(self, key, prefix=""):
+        if prefix:
+            key = key + "_" + prefix
+        result = True
+        try:
+            yield self.call("DEL", key)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.delete] error, %s" %traceback.format_exc())
+            result = False
+        raise gen.Return(result)
+
+    def clearCache(self, table, prefix="", query={}):
+        key = self.generateKey(table, prefix, query, pack=self.dal.serializer_for(table))
+        return self.clearCacheByKey(key)
+
+    @gen.coroutine
+    def clearCacheByKey(self, *keys):
+        result = True
+        try:
+            yield self.call("DEL", *keys)
+            yield self.dal.publish_invalidation(keys)
+            if self.dal.debug:
+                self.dal.logger.debug("[AsyncRedisProxy.clearCacheByKey]keys=%s" %(keys,))
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.clearCacheByKey] error, %s" %traceback.format_exc())
+            result = False
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def strict_pipeline_kw_sadd(self, kw_keys, members, cache_time=86400):
+        if not kw_keys or not members:
+            return
+        try:
+            commands = []
+            for kw_key in kw_keys:
+                commands.append(("SADD", kw_key) + tuple(members))
+                if cache_time:
+                    commands.append(("EXPIRE", kw_key, cache_time))
+            yield self.pipeline(commands)
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.strict_pipeline_kw_sadd]error, %s" %traceback.format_exc())
+
+    #pipeline中单条命令的错误以TornadisException返回,有错误时抛出第一个
+    def check_replies(self, replies):
+        for reply in replies:
+            if isinstance(reply, tornadis.TornadisException):
+                raise reply
+        return replies
+
+    #同RedisProxy.unlink_many: 一个pipeline,每条UNLINK/DEL不超过chunk_size个key,返回删除的key数
+    #只有redis不支持UNLINK时改用DEL,其他错误照常抛出
+    @gen.coroutine
+    def unlink_many(self, keys, chunk_size=1000):
+        keys = list(keys)
+        chunks = [tuple(keys[i:i+chunk_size]) for i in xrange(0, len(keys), chunk_size)]
+        result = [0]
+        if chunks and self.unlink_supported:
+            result = yield self.pipeline([("UNLINK",) + chunk for chunk in chunks])
+            errors = [reply for reply in result if isinstance(reply, tornadis.TornadisException)]
+            if errors:
+                if not command_unsupported(errors[0], "unlink"):
+                    raise errors[0]
+                self.unlink_supported = False
+                self.dal.logger.error("[AsyncRedisProxy.unlink_many]UNLINK unsupported, fallback to DEL, %s" %errors[0])
+        if chunks and not self.unlink_supported:
+            result = self.check_replies((yield self.pipeline([("DEL",) + chunk for chunk in chunks])))
+        raise gen.Return(sum(result))
+
+    #与RedisProxy.clear_kw_keys使用同一个lua脚本,返回(被删除的key数, 成员key列表)
+    #脚本不可用或出错时同RedisProxy: 先SMEMBERS读取成员,再分批UNLINK/DEL成员key和关键字集合
+    @gen.coroutine
+    def clear_kw_keys(self, kw_keys, return_members=False, chunk_size=1000):
+        if not kw_keys:
+            raise gen.Return((0, []))
+        if self.kw_clear_script:
+            del_cmd = "UNLINK" if self.unlink_supported else "DEL"
+            try:
+                count, members = yield self.call("EVAL", KW_CLEAR_SCRIPT, len(kw_keys), *(list(kw_keys) + [del_cmd, chunk_size, 1 if return_members else 0]))
+            except Exception, e:
+                self.kw_script_error(e)
+            else:
+                raise gen.Return((count, members))
+
+        result = (0, [])
+        try:
+            replies = self.check_replies((yield self.pipeline([("SMEMBERS", kw_key) for kw_key in kw_keys])))
+            members = list(set().union(*replies))
+            count = yield self.unlink_many(members, chunk_size)
+            yield self.unlink_many(kw_keys, chunk_size)
+            result = (count, members if return_members else [])
+        except Exception:
+            self.dal.logger.error("[AsyncRedisProxy.clear_kw_keys]error, %s" %traceback.format_exc())
+        raise gen.Return(result)
+
+    #同RedisProxy.kw_script_error: 脚本不被支持时停用并只记录一次日志,其他错误每次记录,脚本保持启用
+    def kw_script_error(self, error):
+        if not script_unsupported(error):
+            self.dal.logger.error("[AsyncRedisProxy.clear_kw_keys]script error, fallback to pipeline, %s" %traceback.format_exc())
+            return
+        if self.kw_clear_script:
+            self.kw_clear_script = False
+            self.dal.logger.error("[AsyncRedisProxy.clear_kw_keys]script error, disabled, fallback to pipeline, %s" %traceback.format_exc())
+
+class AsyncDal(object):
+    """
+        redis: tornadis.Client
+        mongodb: motor的数据库对象(MotorDatabase)
+        pubsub: tornadis.PubSubClient,可选
+        near_cache_invalidate: 为True时写操作通过NEARCACHE_CHANNEL广播失效消息,供开启了near_cache的Dal进程淘汰本地副本
+        hashed_keys: 与Dal的hashed_keys一致时两者才能共用缓存
+        compress_threshold/compress_codec/compress_level: 同Dal,读取时总能识别Dal写入的压缩值
+        serializers: 同Dal,按表选择序列化器
+        page_window: 同Dal,分页索引按窗口加载
+    """
+    def __init__(self, redis, mongodb, logger, debug=True, pubsub=None, near_cache_invalidate=False, hashed_keys=False,
+            compress_threshold=0, compress_codec="zlib", compress_level=None, serializers=None, page_window=5):
+        self.redis = redis
+        self.hashed_keys = hashed_keys
+        self.compressor = Compressor(compress_codec, compress_threshold, compress_level)
+        self.table_serializers = dict(serializers or {})
+        self.page_window = page_window
+        self.mongodb = mongodb
+        self.redis_proxy = AsyncRedisProxy(self)
+        self.pubsub = pubsub
+        self.logger = logger
+        self.debug = debug
+        self.near_cache_invalidate = near_cache_invalidate
+        self.inflight = {}
+
+    def get_mongodb(self):
+        return self.mongodb
+
+    def get_redis(self):
+        return self.redis
+
+    def serializer_for(self, table, pack=True):
+        return self.table_serializers.get(table, pack)
+
+    #同一个key的并发回源合并为一次,等待方拿到结果的深拷贝
+    @gen.coroutine
+    def load_once(self, key, load, copy_result=True):
+        future = self.inflight.get(key)
+        if future is not None:
+            result, error = yield future
+            if error is not None:
+                raise error
+            raise gen.Return(copy.deepcopy(result) if copy_result else result)
+
+        future = self.inflight[key] = Future()
+        result, error = None, None
+        try:
+            result = yield load()
+        except Exception, e:
+            error = e
+        finally:
+            del self.inflight[key]
+            future.set_result((result, error))
+        if error is not None:
+            raise error
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def publish_invalidation(self, keys=None, prefixes=None):
+        if self.near_cache_invalidate and (keys or prefixes):
+            yield self.pubsub_publish(NEARCACHE_CHANNEL, {"keys": list(keys or []), "prefixes": list(prefixes or [])})
+
+    @gen.coroutine
+    def pubsub_subscribe(self, *channels):
+        self.logger.debug("[AsyncDal.pubsub_subscribe]channels:%s" %(channels,))
+        yield self.pubsub.pubsub_subscribe(*channels)
+
+    @gen.coroutine
+    def pubsub_publish(self, key, msg, useJson=True):
+        result = 0
+        if key and msg:
+            data = msg
+            if useJson:
+                data = msgpack.packb(msg)
+            result = yield self.redis_proxy.call("PUBLISH", key, data)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def pubsub_listen_message(self, useJson=True):
+        channel, data = None, None
+        msg = yield self.pubsub.pubsub_pop_message()
+        if isinstance(msg, list) and len(msg) >= 3 and "message" == msg[0] and NEARCACHE_CHANNEL != msg[1]:
+            channel, data = msg[1], msg[2]
+            if useJson:
+                try:
+                    data = msgpack.unpackb(data, use_list = True)
+                except Exception:
+                    self.logger.error(traceback.format_exc())
+        raise gen.Return((channel, data))
+
+    @gen.coroutine
+    def update(self, table, prefix="", value={}, query={}, cache=True, cache_time=0, multi=False, upsert=True, cache_kw=None):
+        status = True
+        try:
+            result = yield self.get_mongodb()[table].update(query, value, multi=multi, upsert=upsert)
+            if self.debug:
+                self.logger.debug("[AsyncDal.update]table=%s, prefix=%s, query=%s, result=%s" %(table, prefix, query, result))
+            if result and cache:
+                yield self.redis_proxy.clearCache(table, prefix, query)
+            if cache_kw:
+                yield self.clearKwCache(cache_kw)
+        except Exception:
+            self.logger.error(traceback.format_exc())
+            status = False
+        raise gen.Return(status)
+
+    @gen.coroutine
+    def insert(self, table, prefix="", value={}, cache=True, cache_kw=None):
+        status = True
+        try:
+            result = yield self.get_mongodb()[table].insert(value)
+            if self.debug:
+                self.logger.debug("[AsyncDal.insert]table=%s, prefix=%s, result=%s" %(table, prefix, result))
+            if result and cache:
+                yield self.redis_proxy.clearCache(table, prefix)
+            if cache_kw:
+                yield self.clearKwCache(cache_kw)
+        except Exception:
+            self.logger.error(traceback.format_exc())
+            status = False
+        raise gen.Return(status)
+
+    @gen.coroutine
+    def insert_if_absent(self, table, prefix="", value={}, query={}, cache=True, cache_time=0, cache_kw=None):
+        status = True
+        try:
+            result = yield self.get_mongodb()[table].update(query, value, multi=False, upsert=True)
+            if self.debug:
+                self.logger.debug("[AsyncDal.insert_if_absent]table=%s, prefix=%s, query=%s, result=%s" %(table, prefix, query, result))
+            if result and cache:
+                yield self.redis_proxy.clearCache(table, prefix)
+            if cache_kw:
+                yield self.clearKwCache(cache_kw)
+        except Exception:
+            self.logger.error(traceback.format_exc())
+            status = False
+        raise gen.Return(status)
+
+    @gen.coroutine
+    def delete(self, table, query, prefix="", cache=True, cache_kw=None):
+        status = True
+        try:
+            result = yield self.get_mongodb()[table].remove(query)
+            if self.debug:
+                self.logger.debug("[AsyncDal.delete]table=%s, query=%s, prefix=%s, result=%s" %(table, query, prefix, result))
+            if result and cache:
+                yield self.redis_proxy.clearCache(table, prefix, query)
+            if cache_kw:
+                yield self.clearKwCache(cache_kw)
+        except Exception:
+            self.logger.error("[AsyncDal.delete]error %s" %traceback.format_exc())
+            status = False
+        raise gen.Return(status)
+
+    @gen.coroutine
+    def find_one(self, table, prefix="", query={}, cache=True, cache_time=3600, criteria=None, cache_kw=None, pack=True):
+        result = None
+        prefix = "find_one" if not prefix else "%s_find_one" %prefix
+        pack = self.serializer_for(table, pack)
+
+        @gen.coroutine
+        def _load():
+            if criteria:
+                result = yield self.get_mongodb()[table].find_one(query, criteria)
+            else:
+                result = yield self.get_mongodb()[table].find_one(query)
+
+            stringify_ids([result], pack)
+
+            if cache:
+                yield self.redis_proxy.set(table, prefix=prefix, value=result, query=query, cache_time=cache_time, criteria=criteria, cache_kw=cache_kw, pack=pack)
+            raise gen.Return(result)
+
+        try:
+            if cache:
+                result = yield self.redis_proxy.get(table, prefix, query, cache_time, criteria=criteria, pack=pack)
+                if result is None:
+                    key = self.redis_proxy.generateKey(table, prefix, query, criteria=criteria, pack=pack)
+                    result = yield self.load_once(key, _load)
+            else:
+                result = yield _load()
+        except Exception, e:
+            self.logger.error("[AsyncDal.find_one]error: %s, bt: %s" %(e, traceback.format_exc()))
+            result = None
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def nfind(self, table, prefix="", query={}, cache=True, cache_time=43200, sort=None, criteria=None, limit=None, cache_kw=None, pack=True):
+        result = None
+        pack = self.serializer_for(table, pack)
+
+        @gen.coroutine
+        def _load():
+            if criteria:
+                cursor = self.get_mongodb()[table].find(query, criteria)
+            else:
+                cursor = self.get_mongodb()[table].find(query)
+
+            if sort:
+                if isinstance(sort, tuple):
+                    cursor = cursor.sort(*sort)
+                else:
+                    cursor = cursor.sort(sort)
+
+            if limit and limit > 0:
+                cursor = cursor.limit(limit)
+
+            result = yield cursor.to_list(length=None)
+            stringify_ids(result, pack)
+
+            if cache:
+                yield self.redis_proxy.set(table, prefix=prefix, value=result, query=query, criteria=criteria, cache_time=cache_time, sort=sort, limit=limit, cache_kw=cache_kw, pack=pack)
+            raise gen.Return(result)
+
+        try:
+            if cache:
+                result = yield self.redis_proxy.get(table, prefix, query, cache_time, sort=sort, limit=limit, criteria=criteria, pack=pack)
+                if result is None:
+                    key = self.redis_proxy.generateKey(table, prefix, query, sort=sort, limit=limit, criteria=criteria, pack=pack)
+                    result = yield self.load_once(key, _load)
+            else:
+                result = yield _load()
+        except Exception, e:
+            self.logger.error("[AsyncDal.nfind]error: %s, bt: %s" %(e, traceback.format_exc()))
+            result = None
+        raise gen.Return(result)
+
+    #重新加载分页数据,写入的pagecache与Dal.load_page_data相同
+    @gen.coroutine
+    def load_page_data(self, table, prefix="", query={}, cache_time=43200, sort=None, cache_kw=None, criteria=None, need=None):
+        key = self.redis_proxy.generateKey(table, prefix, query, sort, name="pagecache", criteria=criteria, pack=True)
+        meta, rows = yield self._extend_page_index(table, key, query, sort, cache_time, cache_kw, None, need)
+        raise gen.Return(rows)
+
+    #同Dal._extend_page_index
+    @gen.coroutine
+    def _extend_page_index(self, table, key, query, sort, cache_time, cache_kw, meta, need=None):
+        if meta is None:
+            offset = 0
+            total = yield self.get_mongodb()[table].find(query).count()
+            ttl = cache_time
+        else:
+            offset = meta["loaded"]
+            total = meta["total"]
+            ttl = meta["ttl"]
+        limit = need - offset if need else 0
+        if need and limit <= 0:
+            raise gen.Return((meta, []))
+
+        fields = {"_id":1}
+        sort_field = "sort_field"
+        if sort:
+            sort_field = sort[0]
+            fields[sort_field] = 1
+
+        cursor = self.get_mongodb()[table].find(query, fields)
+        if sort:
+            if isinstance(sort, tuple):
+                cursor = cursor.sort(*sort)
+            else:
+                cursor = cursor.sort(sort)
+        if offset:
+            cursor = cursor.skip(offset)
+        if limit:
+            cursor = cursor.limit(limit)
+
+        rows = yield cursor.to_list(length=None)
+        for r in rows:
+            r["_id"] = str(r.get("_id"))
+            score = r.get(sort_field, 0.0) if sort else 0
+            if score:
+                try:
+                    score = float(score)
+                except (TypeError, ValueError):
+                    score = 0
+            r[sort_field] = score
+
+        if not limit or len(rows) < limit:
+            total = offset + len(rows)
+        yield self.redis_proxy.page_index_extend(key, [r["_id"] for r in rows], offset, total, ttl)
+        if offset == 0 and cache_kw:
+            yield self.cacheKeyword([key, page_meta_key(key)], query, cache_kw)
+        raise gen.Return(({"total": total, "loaded": offset + len(rows), "ttl": ttl}, rows))
+
+    #与Dal.find_many_by_ids相同: 一次MGET,未命中的一次$in查询,一个pipeline回写
+    @gen.coroutine
+    def find_many_by_ids(self, table, ids, criteria=None, cache_time=3600, cache_kw=None, prefix=""):
+        prefix = "find_one" if not prefix else "%s_find_one" %prefix
+        pack = self.serializer_for(table)
+        keys = [self.redis_proxy.generateKey(table, prefix, {"_id":_id}, criteria=criteria, pack=pack) for _id in ids]
+        items = yield self.redis_proxy.strict_mget(keys, pack=pack)
+        items = [unwrap_swr(item) for item in items]
+
+        miss_ids = list(set(ObjectId(_id) if ObjectId.is_valid(_id) else _id for _id, item in zip(ids, items) if item is None))
+        if miss_ids:
+            query = {"_id": {"$in": miss_ids}}
+            if criteria:
+                cursor = self.get_mongodb()[table].find(query, criteria)
+            else:
+                cursor = self.get_mongodb()[table].find(query)
+
+            loaded = {}
+            for r in stringify_ids((yield cursor.to_list(length=None)), pack):
+                loaded[str(r.get("_id"))] = r
+
+            key_value_dict = {}
+            for i, _id in enumerate(ids):
+                item = loaded.get(str(_id))
+                if items[i] is None and item is not None:
+                    items[i] = item
+                    key_value_dict[keys[i]] = item
+            yield self.redis_proxy.strict_pipeline_set(key_value_dict, cache_time=cache_time, pack=pack)
+
+        if cache_kw:
+            yield self.cacheKeyword(keys, {}, cache_kw, prefix="")
+        raise gen.Return(items)
+
+    #分页获取表数据,返回(result, page_count, current_count, total)
+    @gen.coroutine
+    def find_by_page(self, table, prefix="", query={}, cache_time=43200, sort=None, page=1, count=20, cache_kw=None, criteria=None):
+        result = []
+        total = 0
+        page_count = 0
+        current_count = 0
+        try:
+            key = self.redis_proxy.generateKey(table, prefix, query, sort, name="pagecache", criteria=criteria)
+            start, stop = get_range_by_page(page, count)
+            meta, sorted_id_result = yield self.redis_proxy.page_index_range(key, start, stop)
+
+            #同Dal.find_by_page: page<=0时读取全部,需要加载完整的索引
+            need = stop + 1 if page > 0 and count > 0 else None
+            if meta is None or (meta["loaded"] < meta["total"] and (need is None or meta["loaded"] < need)):
+                if need is not None:
+                    need += count * self.page_window
+                meta, _ = yield self.load_once("%s_%s" %(key, need), lambda: self._extend_page_index(table, key, query, sort, cache_time, cache_kw, meta, need), copy_result=False)
+                sorted_id_result = (yield self.redis_proxy.strict_zrange(key, start, stop)) or []
+            total = meta["total"]
+
+            current_count = len(sorted_id_result)
+            if sorted_id_result:
+                page_count = len(sorted_id_result)
+                items = yield self.find_many_by_ids(table, sorted_id_result, criteria=criteria, cache_time=300, cache_kw=cache_kw)
+                result = [item for item in items if item]
+        except Exception, e:
+            self.logger.error('[AsyncDal.find_by_page] error %s, bt: %s' %(e, traceback.format_exc()))
+        raise gen.Return((result, page_count, current_count, total))
+
+    #同Dal.find_after,返回(result, next_token)
+    @gen.coroutine
+    def find_after(self, table, query={}, sort=None, after=None, count=20, criteria=None, cache_time=300, cache_kw=None):
+        result = []
+        next_token = None
+        try:
+            sort_field, direction = keyset_sort(sort)
+            find_query = query
+            if after:
+                find_query = keyset_query(query, sort_field, direction, decode_page_token(after, sort_field, direction))
+
+            fields = {"_id": 1, sort_field: 1}
+            sort_spec = [(sort_field, direction)] if sort_field == "_id" else [(sort_field, direction), ("_id", direction)]
+            rows = yield self.get_mongodb()[table].find(find_query, fields).sort(sort_spec).limit(count + 1).to_list(length=None)
+            if len(rows) > count:
+                rows = rows[:count]
+                last = rows[-1]
+                next_token = encode_page_token(sort_field, direction, last.get(sort_field), last["_id"])
+
+            if rows:
+                items = yield self.find_many_by_ids(table, [r["_id"] for r in rows], criteria=criteria, cache_time=cache_time, cache_kw=cache_kw)
+                result = [item for item in items if item]
+        except Exception, e:
+            self.logger.error("[AsyncDal.find_after]error %s, bt: %s" %(e, traceback.format_exc()))
+        raise gen.Return((result, next_token))
+
+    @gen.coroutine
+    def clearCache(self, table, prefix="", query={}):
+        yield self.redis_proxy.clearCache(table, prefix, query)
+
+    @gen.coroutine
+    def cacheKeyword(self, key, query, cache_kw, prefix=""):
+        if cache_kw:
+            members = key if isinstance(key, list) else [key]
+            yield self.redis_proxy.strict_pipeline_kw_sadd(kw_keys(cache_kw, prefix, query), members, cache_time=86400)
+
+    @gen.coroutine
+    def clearKwCache(self, cache_kw, prefix=""):
+        if not cache_kw:
+            return
+        kw_list = kw_keys(cache_kw, prefix)
+        count, cachekey_list = yield self.redis_proxy.clear_kw_keys(kw_list, return_members=self.near_cache_invalidate)
+        if cachekey_list:
+            yield self.publish_invalidation(cachekey_list)
+        if self.debug:
+            self.logger.debug("[AsyncDal.clearKwCache]kw_list=%s, count=%s" %(kw_list, count))
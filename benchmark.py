@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import socket
+import random
+import shutil
+import logging
+import tempfile
+import argparse
+import threading
+import subprocess
+from langs import timer, LatencyHistogram
+from connpool import ConnectionPool
+from dal import Dal
+
+"""
+Dal基准测试,结果以JSON输出,便于对比不同版本
+    python benchmark.py --backend auto --threads 1,8 --doc-sizes 128,4096 --result-sizes 20,200 --output new.json
+    python benchmark.py --compare old.json --input new.json
+backend:
+    local: 在临时目录和空闲端口启动本机的redis-server和mongod,结束后关闭并删除数据
+    fake: 使用内存中的fakeredis和mongomock,只适合比较Dal本身的开销
+    auto: 找得到redis-server和mongod时使用local,否则使用fake
+每个用例在duration秒内由threads个线程循环调用,记录每次调用的耗时,输出ops和p50/p99/max(秒)
+Dal内部捕获异常后只记录错误日志,errors为调用抛出的异常数加上用例执行期间Dal记录的错误日志数
+update_kw用例的关键字集合大小由--kw-sizes指定,每次调用前重新填充关键字集合(不计入耗时),只用单线程
+"""
+TABLE = "bench_doc"
+HASH_TABLE = "bench_hash"
+GROUP_COUNT = 10
+
+class LocalServers(object):
+    def __init__(self):
+        self.tmp = tempfile.mkdtemp(prefix="dal_bench_")
+        self.procs = []
+        self.redis_port = None
+        self.mongo_port = None
+
+    @staticmethod
+    def available():
+        return bool(which("redis-server") and which("mongod"))
+
+    def start(self):
+        self.redis_port = free_port()
+        self.mongo_port = free_port()
+        devnull = open(os.devnull, "w")
+        self.procs.append(subprocess.Popen(["redis-server", "--port", str(self.redis_port), "--bind", "127.0.0.1",
+            "--save", "", "--appendonly", "no", "--dir", self.tmp], stdout=devnull, stderr=devnull))
+        dbpath = os.path.join(self.tmp, "mongo")
+        os.mkdir(dbpath)
+        self.procs.append(subprocess.Popen(["mongod", "--port", str(self.mongo_port), "--bind_ip", "127.0.0.1",
+            "--dbpath", dbpath, "--nounixsocket"], stdout=devnull, stderr=devnull))
+        import redis
+        import pymongo
+        redis_client = redis.StrictRedis(port=self.redis_port)
+        mongo_client = pymongo.MongoClient(port=self.mongo_port, serverSelectionTimeoutMS=500)
+        deadline = time.time() + 30
+        while True:
+            try:
+                redis_client.ping()
+                mongo_client.admin.command("ping")
+                break
+            except Exception:
+                if time.time() > deadline:
+                    self.stop()
+                    raise Exception("LocalServers error, redis-server/mongod not ready in 30s")
+                time.sleep(0.2)
+        return redis_client, mongo_client["dal_bench"]
+
+    def stop(self):
+        for proc in self.procs:
+            if proc.poll() is None:
+                proc.terminate()
+                proc.wait()
+        self.procs = []
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+def which(name):
+    for path in os.environ.get("PATH", "").split(os.pathsep):
+        candidate = os.path.join(path, name)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def fake_backend():
+    import fakeredis
+    import mongomock
+    return fakeredis.FakeStrictRedis(), mongomock.MongoClient()["dal_bench"]
+
+#统计Dal记录的错误日志数
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+ERROR_COUNTER = ErrorCounter()
+
+def make_dal(redis_client, mongo_db, threads):
+    logger = logging.getLogger("dal_bench")
+    if ERROR_COUNTER not in logger.handlers:
+        logger.addHandler(ERROR_COUNTER)
+    redis_pool = ConnectionPool(lambda num: redis_client, size=threads, name="redis")
+    mongodb_pool = ConnectionPool(lambda num: mongo_db, size=threads, name="mongodb")
+    return Dal(redis_pool, mongodb_pool, logger, debug=False)
+
+def make_doc(uid, doc_size):
+    return {"uid": uid, "g": uid % GROUP_COUNT, "name": "user_%s" %uid, "payload": "x" * doc_size}
+
+#doc_count条文档,每组(g)doc_count/GROUP_COUNT条,nfind/find_by_page按组查询
+def load_docs(dal, redis_client, doc_count, doc_size):
+    redis_client.flushdb()
+    mongo_db = dal.get_mongodb()
+    mongo_db[TABLE].drop()
+    mongo_db[HASH_TABLE].drop()
+    docs = [make_doc(uid, doc_size) for uid in xrange(doc_count)]
+    mongo_db[TABLE].insert_many(docs)
+    mongo_db[HASH_TABLE].insert_many([dict(doc, _id=doc["uid"]) for doc in docs])
+    mongo_db[TABLE].create_index("uid")
+    mongo_db[TABLE].create_index([("g", 1), ("uid", 1)])
+
+def run_case(name, params, func, threads, duration, prepare=None, max_ops=None):
+    hists = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = timer() + duration
+
+    def _loop(seed):
+        rnd = random.Random(seed)
+        hist = LatencyHistogram()
+        ops = 0
+        while timer() < deadline and (max_ops is None or ops < max_ops):
+            arg = prepare(rnd) if prepare else rnd
+            begin = timer()
+            try:
+                func(arg)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+            hist.record(timer() - begin)
+            ops += 1
+        with lock:
+            hists.append(hist)
+
+    logged_errors = ERROR_COUNTER.count
+    begin = timer()
+    workers = [threading.Thread(target=_loop, args=(i,)) for i in xrange(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = timer() - begin
+    errors[0] += ERROR_COUNTER.count - logged_errors
+
+    hist = LatencyHistogram()
+    for h in hists:
+        hist.merge(h)
+    #只累计调用耗时,prepare的耗时不计入吞吐
+    busy = hist.total / threads if prepare else elapsed
+    summary = hist.summary()
+    result = {"case": name, "params": dict(params, threads=threads), "count": hist.count, "errors": errors[0],
+        "ops": round(hist.count / busy, 1) if busy else 0.0,
+        "p50": summary["p50"], "p99": summary["p99"], "max": summary["max"]}
+    sys.stderr.write("%-22s %-60s ops=%-10s p50=%.6f p99=%.6f errors=%s\n" %(name, json.dumps(result["params"], sort_keys=True),
+        result["ops"], result["p50"], result["p99"], result["errors"]))
+    return result
+
+#每组取result_size条文档缓存为一个hash
+def hash_get_group(dal, group, result_size):
+    query = {"g": group, "uid": {"$lt": result_size * GROUP_COUNT}}
+    return dal.hash_get_all(HASH_TABLE, "g%s_%s" %(group, result_size), query, "uid")
+
+def bench_docs(dal, args, doc_size, threads):
+    results = []
+    params = {"doc_size": doc_size}
+    docs = args.docs
+
+    #预热缓存,find_one测的是缓存命中
+    for uid in xrange(docs):
+        dal.find_one(TABLE, query={"uid": uid}, criteria={"_id": 0})
+    results.append(run_case("find_one", params, lambda rnd: dal.find_one(TABLE, query={"uid": rnd.randrange(docs)}, criteria={"_id": 0}),
+        threads, args.duration))
+    results.append(run_case("find_one_nocache", params, lambda rnd: dal.find_one(TABLE, query={"uid": rnd.randrange(docs)}, cache=False, criteria={"_id": 0}),
+        threads, args.duration))
+
+    for result_size in args.result_sizes:
+        case_params = dict(params, result_size=result_size)
+        results.append(run_case("nfind", case_params,
+            lambda rnd: dal.nfind(TABLE, query={"g": rnd.randrange(GROUP_COUNT)}, sort=("uid", 1), limit=result_size, criteria={"_id": 0}),
+            threads, args.duration))
+        results.append(run_case("find_by_page", case_params,
+            lambda rnd: dal.find_by_page(TABLE, query={"g": rnd.randrange(GROUP_COUNT)}, sort=("uid", 1), page=rnd.randint(1, 3), count=result_size),
+            threads, args.duration))
+        results.append(run_case("hash_get_all", case_params, lambda rnd: hash_get_group(dal, rnd.randrange(GROUP_COUNT), result_size),
+            threads, args.duration))
+    return results
+
+def bench_strict(dal, args, doc_size, threads):
+    results = []
+    proxy = dal.redis_proxy
+    value = {"payload": "x" * doc_size}
+    batch = args.batch
+    params = {"doc_size": doc_size, "batch": batch}
+
+    def _keys(rnd, name):
+        base = rnd.randrange(args.docs)
+        return ["bench_%s_%s" %(name, base + i) for i in xrange(batch)]
+
+    results.append(run_case("strict_pipeline_set", params,
+        lambda rnd: proxy.strict_pipeline_set(dict((key, value) for key in _keys(rnd, "str")), cache_time=600), threads, args.duration))
+    results.append(run_case("strict_mget", params, lambda rnd: proxy.strict_mget(_keys(rnd, "str")), threads, args.duration))
+    results.append(run_case("strict_pipeline_hset", params,
+        lambda rnd: proxy.strict_pipeline_hset("bench_hash_%s" %rnd.randrange(100), dict((key, value) for key in _keys(rnd, "f"))), threads, args.duration))
+    results.append(run_case("strict_pipeline_sadd", params,
+        lambda rnd: proxy.strict_pipeline_sadd("bench_set_%s" %rnd.randrange(100), _keys(rnd, "m")), threads, args.duration))
+    results.append(run_case("strict_pipeline_zadd", params,
+        lambda rnd: proxy.strict_pipeline_zadd("bench_zset_%s" %rnd.randrange(100), [(key, i) for i, key in enumerate(_keys(rnd, "m"))]),
+        threads, args.duration))
+    return results
+
+#update带cache_kw时会清除关键字集合中的所有key,耗时与集合大小有关;每次调用前重新填充集合
+def bench_update_kw(dal, args):
+    results = []
+    proxy = dal.redis_proxy
+    for kw_size in args.kw_sizes:
+        keys = ["bench_kw_member_%s" %i for i in xrange(kw_size)]
+        cache_kw = "bench_kw_%s" %kw_size
+
+        def _prepare(rnd):
+            for i in xrange(0, len(keys), 10000):
+                proxy.strict_pipeline_set(dict((key, 1) for key in keys[i:i+10000]), cache_time=600, pack=False)
+            dal.cacheKeyword(keys, {}, cache_kw)
+            return rnd
+
+        max_ops = max(5, 100000 // max(kw_size, 1))
+        results.append(run_case("update_kw", {"kw_size": kw_size},
+            lambda rnd: dal.update(TABLE, value={"$set": {"name": "u%s" %rnd.random()}}, query={"uid": rnd.randrange(args.docs)}, cache_kw=cache_kw),
+            1, args.duration, prepare=_prepare, max_ops=max_ops))
+    return results
+
+def run(args):
+    servers = None
+    backend = args.backend
+    if backend == "auto":
+        backend = "local" if LocalServers.available() else "fake"
+    if backend == "local":
+        servers = LocalServers()
+        redis_client, mongo_db = servers.start()
+    else:
+        redis_client, mongo_db = fake_backend()
+
+    results = []
+    try:
+        for doc_size in args.doc_sizes:
+            for threads in args.threads:
+                dal = make_dal(redis_client, mongo_db, threads)
+                load_docs(dal, redis_client, args.docs, doc_size)
+                results += bench_docs(dal, args, doc_size, threads)
+                results += bench_strict(dal, args, doc_size, threads)
+        dal = make_dal(redis_client, mongo_db, 1)
+        load_docs(dal, redis_client, args.docs, args.doc_sizes[0])
+        results += bench_update_kw(dal, args)
+    finally:
+        if servers is not None:
+            servers.stop()
+
+    return {"meta": {"backend": backend, "time": int(time.time()), "python": sys.version.split()[0],
+        "duration": args.duration, "docs": args.docs}, "results": results}
+
+def case_id(result):
+    return "%s %s" %(result["case"], json.dumps(result["params"], sort_keys=True))
+
+#对比两次结果,ops下降或p99上升超过threshold的用例视为退化,返回退化的用例数
+def compare(old, new, threshold=0.1):
+    old_results = dict((case_id(r), r) for r in old["results"])
+    regressions = 0
+    for result in new["results"]:
+        base = old_results.get(case_id(result))
+        if base is None:
+            continue
+        ops_ratio = result["ops"] / base["ops"] if base["ops"] else 0.0
+        p99_ratio = result["p99"] / base["p99"] if base["p99"] else 0.0
+        regressed = ops_ratio < 1 - threshold or p99_ratio > 1 + threshold
+        regressions += regressed
+        print "%s %-70s ops %8.3fx  p99 %8.3fx" %("!" if regressed else " ", case_id(result), ops_ratio, p99_ratio)
+    return regressions
+
+def int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+def main():
+    parser = argparse.ArgumentParser(description="Dal benchmark")
+    parser.add_argument("--backend", choices=["auto", "local", "fake"], default="auto")
+    parser.add_argument("--threads", type=int_list, default=[1, 8])
+    parser.add_argument("--doc-sizes", type=int_list, default=[128, 4096])
+    parser.add_argument("--result-sizes", type=int_list, default=[20, 200])
+    parser.add_argument("--kw-sizes", type=int_list, default=[10, 1000, 100000])
+    parser.add_argument("--docs", type=int, default=2000)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=2.0)
+    parser.add_argument("--output", help="结果JSON写入的文件,默认输出到stdout")
+    parser.add_argument("--input", help="不运行基准测试,读取已有的结果JSON(与--compare一起使用)")
+    parser.add_argument("--compare", help="与旧结果JSON对比")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.input:
+        with open(args.input) as f:
+            result = json.load(f)
+    else:
+        result = run(args)
+        data = json.dumps(result, indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(data)
+        else:
+            print data
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        sys.exit(1 if compare(old, result, args.threshold) else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import zlib
+import threading
+from langs import timer, LatencyHistogram
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+"""
+缓存值压缩: 序列化后的值超过threshold字节时压缩,压缩后的值以MAGIC和一个字节的codec编号开头
+MAGIC(0xc1)是msgpack保留不用的字节,也不可能是json的第一个字节,所以读取时可以和未压缩的值区分,
+未开启压缩的读取方也能读出压缩过的值,新旧值可以在灰度期间共存
+"""
+MAGIC = "\xc1"
+
+def _zlib_compress(data, level):
+    return zlib.compress(data, 6 if level is None else level)
+
+def _lz4_compress(data, level):
+    return lz4_frame.compress(data, compression_level=level or 0)
+
+def _zstd_compress(data, level):
+    return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+
+def _zstd_decompress(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+#codec名称: (编号, 压缩函数, 解压函数, 是否可用)
+CODECS = {
+    "zlib": ("z", _zlib_compress, zlib.decompress, True),
+    "lz4": ("4", _lz4_compress, lz4_frame.decompress if lz4_frame else None, lz4_frame is not None),
+    "zstd": ("s", _zstd_compress, _zstd_decompress, zstandard is not None),
+}
+DECOMPRESSORS = dict((codec_id, decompress_func) for codec_id, _, decompress_func, available in CODECS.itervalues() if available)
+
+def is_compressed(data):
+    return bool(data) and data[0] == MAGIC
+
+#不记录统计的解压,data不是压缩格式时原样返回
+def decompress(data):
+    if not is_compressed(data):
+        return data
+    decompress_func = DECOMPRESSORS.get(data[1:2])
+    if decompress_func is None:
+        raise Exception("decompress error, unsupported codec %r" %data[1:2])
+    return decompress_func(data[2:])
+
+"""
+Compressor保存压缩配置和统计
+    codec: zlib/lz4/zstd, lz4和zstd需要安装对应的包
+    threshold: 序列化后的值超过该字节数时才压缩, 0表示不压缩(仍然可以解压)
+    level: 压缩级别, None使用codec的默认值
+    min_ratio: 压缩后与原值的大小比超过该值时认为不值得压缩,保存原值
+"""
+class Compressor(object):
+    def __init__(self, codec="zlib", threshold=0, level=None, min_ratio=0.9):
+        if codec not in CODECS:
+            raise Exception("Compressor error, unknown codec %s" %codec)
+        codec_id, compress_func, _, available = CODECS[codec]
+        if threshold and not available:
+            raise Exception("Compressor error, codec %s is not installed" %codec)
+        self.codec = codec
+        self.header = MAGIC + codec_id
+        self.compress_func = compress_func
+        self.threshold = threshold
+        self.level = level
+        self.min_ratio = min_ratio
+        self.lock = threading.Lock()
+        self.compressed = 0
+        self.incompressible = 0
+        self.decompressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_hist = LatencyHistogram()
+        self.decompress_hist = LatencyHistogram()
+
+    def compress(self, data):
+        if not self.threshold or len(data) <= self.threshold:
+            return data
+        begin = timer()
+        result = self.header + self.compress_func(data, self.level)
+        cost = timer() - begin
+        with self.lock:
+            self.compress_hist.record(cost)
+            if len(result) > len(data) * self.min_ratio:
+                self.incompressible += 1
+                return data
+            self.compressed += 1
+            self.bytes_in += len(data)
+            self.bytes_out += len(result)
+        return result
+
+    def decompress(self, data):
+        if not is_compressed(data):
+            return data
+        begin = timer()
+        result = decompress(data)
+        cost = timer() - begin
+        with self.lock:
+            self.decompressed += 1
+            self.decompress_hist.record(cost)
+        return result
+
+    def get_stat(self):
+        with self.lock:
+            compress_cost = self.compress_hist.summary()
+            decompress_cost = self.decompress_hist.summary()
+            return {"codec": self.codec, "threshold": self.threshold, "compressed": self.compressed,
+                "incompressible": self.incompressible, "decompressed": self.decompressed,
+                "bytes_in": self.bytes_in, "bytes_out": self.bytes_out,
+                "ratio": round(float(self.bytes_out) / self.bytes_in, 4) if self.bytes_in else 1.0,
+                "compress_p99": compress_cost["p99"], "compress_max": compress_cost["max"],
+                "decompress_p99": decompress_cost["p99"], "decompress_max": decompress_cost["max"]}
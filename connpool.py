@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import weakref
+import threading
+from contextlib import contextmanager
+from langs import timer, LatencyHistogram
+
+"""
+ConnectionPool把按编号取连接的旧连接池(redis_pool.get_redis(num), mongodb_pool.get_mongo_db(num),
+ddb_pool.get(num))适配为:
+    get(): 线程亲和,线程第一次调用时绑定到当前绑定线程最少的编号,之后一直使用该编号,不加锁;
+        线程退出后解除绑定; 绑定的编号被其他线程独占时,改绑到未被独占的编号中绑定线程最少的
+    checkout()/checkin()/connection(): 独占使用某个编号,最多size个线程同时持有,超时抛出异常;
+        优先选择绑定线程最少的空闲编号,持有期间同一线程的get()返回独占的连接
+"""
+#线程亲和绑定的编号,保存在threading.local中,线程退出时被回收,通过弱引用的回调解除绑定
+class _Affinity(object):
+    __slots__ = ("slot", "ref", "__weakref__")
+
+    def __init__(self):
+        self.slot = None
+        self.ref = None
+
+class ConnectionPool(object):
+    def __init__(self, get_func, size=None, name="", timeout=1.0, start=1, max_probe=1024):
+        self.get_func = get_func
+        self.size = size
+        self.name = name
+        self.timeout = timeout
+        self.start = start
+        self.max_probe = max_probe
+        self.cond = threading.Condition(threading.Lock())
+        self.local = threading.local()
+        self.free = None
+        self.bound = None
+        self.held = set()
+        self.affinity_refs = {}
+        self.in_use = 0
+        self.max_in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_hist = LatencyHistogram()
+
+    #旧连接池没有提供大小时,从start开始探测可以取到连接的编号
+    def _init_slots(self):
+        with self.cond:
+            if self.free is not None:
+                return
+            size = self.size
+            if not size:
+                size = 0
+                while size < self.max_probe:
+                    try:
+                        if self.get_func(self.start + size) is None:
+                            break
+                    except Exception:
+                        break
+                    size += 1
+            if not size:
+                raise Exception("ConnectionPool(%s) error, no connection in pool" %self.name)
+            self.size = size
+            self.free = range(self.start, self.start + size)
+            self.bound = dict((slot, 0) for slot in self.free)
+
+    #当前线程使用的编号: 独占的编号优先,否则为亲和绑定的编号
+    def slot(self):
+        slot = getattr(self.local, "checkout", None)
+        if slot is not None:
+            return slot
+        affinity = getattr(self.local, "affinity", None)
+        if affinity is not None and affinity.slot not in self.held:
+            return affinity.slot
+        if self.free is None:
+            self._init_slots()
+        with self.cond:
+            if affinity is None:
+                affinity = _Affinity()
+                affinity.ref = weakref.ref(affinity, self._unbind)
+            elif affinity.slot is not None:
+                self.bound[affinity.slot] -= 1
+            slots = [s for s in self.bound if s not in self.held] or self.bound.keys()
+            affinity.slot = min(slots, key=lambda s: (self.bound[s], s))
+            self.bound[affinity.slot] += 1
+            self.affinity_refs[affinity.ref] = affinity.slot
+        self.local.affinity = affinity
+        return affinity.slot
+
+    def _unbind(self, ref):
+        with self.cond:
+            slot = self.affinity_refs.pop(ref, None)
+            if slot is not None:
+                self.bound[slot] -= 1
+
+    def get(self):
+        return self.get_func(self.slot())
+
+    def checkout(self, timeout=None):
+        if self.free is None:
+            self._init_slots()
+        if timeout is None:
+            timeout = self.timeout
+        begin = timer()
+        with self.cond:
+            if not self.free:
+                self.waits += 1
+                deadline = begin + timeout
+                while not self.free:
+                    remaining = deadline - timer()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise Exception("ConnectionPool(%s) checkout timeout, size=%s" %(self.name, self.size))
+                    self.cond.wait(remaining)
+            slot = min(self.free, key=lambda s: (self.bound[s], s))
+            self.free.remove(slot)
+            self.held.add(slot)
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            self.checkouts += 1
+            self.wait_hist.record(timer() - begin)
+        self.local.checkout = slot
+        return slot
+
+    def checkin(self, slot):
+        if getattr(self.local, "checkout", None) == slot:
+            self.local.checkout = None
+        with self.cond:
+            self.held.discard(slot)
+            self.free.append(slot)
+            self.in_use -= 1
+            self.cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        if getattr(self.local, "checkout", None) is not None:
+            yield self.get()
+            return
+        slot = self.checkout(timeout)
+        try:
+            yield self.get_func(slot)
+        finally:
+            self.checkin(slot)
+
+    def get_stat(self):
+        with self.cond:
+            wait = self.wait_hist.summary()
+            return {"size": self.size, "in_use": self.in_use, "max_in_use": self.max_in_use, "checkouts": self.checkouts,
+                "waits": self.waits, "timeouts": self.timeouts, "wait_p99": wait["p99"], "wait_max": wait["max"],
+                "bound_threads": dict(self.bound or {})}
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import time
+import Queue
+import threading
+import traceback
+import msgpack
+from langs import timer, LatencyHistogram
+
+"""
+PubSubConsumer批量消费pubsub消息
+    监听线程每次从pubsub最多取batch_size条消息(pubsub.listen()没有消息时返回None),不解码,按channel哈希分给workers个处理线程;
+    同一个channel的消息总是由同一个线程按顺序处理,解码(useJson时msgpack)和handler(channel, data)都在处理线程中执行
+    每个处理线程的队列最多queue_size条,队列满时监听线程阻塞等待,不再读取新消息(背压),由redis/pubsub客户端的缓冲区暂存
+    get_stat返回收到/处理/失败的消息数、队列深度、排队耗时(lag)和handler耗时
+"""
+class PubSubConsumer(object):
+    def __init__(self, dal, handler, workers=4, batch_size=100, queue_size=1000, idle_wait=0.01, useJson=True, name="pubsub"):
+        self.dal = dal
+        self.handler = handler
+        self.batch_size = batch_size
+        self.idle_wait = idle_wait
+        self.useJson = useJson
+        self.name = name
+        self.queues = [Queue.Queue(queue_size) for _ in xrange(workers)]
+        self.lock = threading.Lock()
+        self.received = 0
+        self.processed = 0
+        self.errors = 0
+        self.batches = 0
+        self.blocked = 0
+        self.max_depth = 0
+        self.lag_hist = LatencyHistogram()
+        self.handler_hist = LatencyHistogram()
+        self.closed = False
+        self.threads = []
+
+    def start(self):
+        for i, queue in enumerate(self.queues):
+            self.threads.append(self._start_thread(self._work, "%s_worker_%s" %(self.name, i), queue))
+        self.listener = self._start_thread(self._listen, "%s_listener" %self.name)
+        return self
+
+    def _start_thread(self, target, name, *args):
+        thread = threading.Thread(target=target, name=name, args=args)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def _listen(self):
+        while not self.closed:
+            try:
+                messages = self.dal.pubsub_listen_batch(self.batch_size)
+            except Exception:
+                self.dal.logger.error("[PubSubConsumer._listen]error, %s" %traceback.format_exc())
+                time.sleep(self.idle_wait)
+                continue
+            if not messages:
+                time.sleep(self.idle_wait)
+                continue
+            now = timer()
+            with self.lock:
+                self.received += len(messages)
+                self.batches += 1
+            for channel, data in messages:
+                queue = self.queues[hash(channel) % len(self.queues)]
+                item = (channel, data, now)
+                try:
+                    queue.put_nowait(item)
+                except Queue.Full:
+                    with self.lock:
+                        self.blocked += 1
+                    queue.put(item)
+            depth = sum(queue.qsize() for queue in self.queues)
+            if depth > self.max_depth:
+                self.max_depth = depth
+
+    def _work(self, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            channel, data, received = item
+            begin = timer()
+            if self.useJson:
+                try:
+                    data = msgpack.unpackb(data, use_list = True)
+                except Exception:
+                    self.dal.logger.error("[PubSubConsumer._work]decode error, channel=%s, %s" %(channel, traceback.format_exc()))
+            failed = False
+            try:
+                self.handler(channel, data)
+            except Exception:
+                failed = True
+                self.dal.logger.error("[PubSubConsumer._work]handler error, channel=%s, %s" %(channel, traceback.format_exc()))
+            end = timer()
+            with self.lock:
+                self.processed += 1
+                if failed:
+                    self.errors += 1
+                self.lag_hist.record(begin - received)
+                self.handler_hist.record(end - begin)
+
+    #停止监听,等待处理线程处理完已入队的消息
+    def stop(self, timeout=None):
+        if self.closed:
+            return
+        self.closed = True
+        self.listener.join(timeout)
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def get_stat(self):
+        depths = [queue.qsize() for queue in self.queues]
+        with self.lock:
+            lag = self.lag_hist.summary()
+            handler_cost = self.handler_hist.summary()
+            return {"received": self.received, "processed": self.processed, "errors": self.errors,
+                "batches": self.batches, "blocked": self.blocked, "depth": sum(depths), "max_worker_depth": max(depths),
+                "max_depth": self.max_depth, "lag_p50": lag["p50"], "lag_p99": lag["p99"], "lag_max": lag["max"],
+                "handler_p50": handler_cost["p50"], "handler_p99": handler_cost["p99"], "handler_max": handler_cost["max"]}
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import time
+import atexit
+import threading
+import traceback
+
+"""
+CounterAggregator在进程内合并计数器的增量,定期用一个pipeline写入redis(INCRBY/HINCRBY)
+    interval: 后台线程刷新的间隔(秒)
+    max_events: 累计的增量次数达到该值时立即唤醒后台线程刷新
+    max_keys: 待刷新的key数达到该值时由调用方线程同步刷新,内存占用有上限;
+        刷新失败时增量合并回待刷新列表,超出max_keys的部分丢弃并计入dropped;
+        上一次刷新失败后interval秒内调用方不再同步刷新,待刷新列表已满时新的key直接丢弃并计入dropped,
+        redis故障期间不会在每次add中重试
+    开启分片时每个节点一个pipeline,只有出错节点的增量合并回去,已写入其他节点的增量不会重复写入;
+        redis拒绝的单条命令(如key的类型不符)重试也不会成功,直接丢弃并计入dropped
+进程退出时(atexit)会刷新一次,也可以调用flush()立即刷新
+"""
+class CounterAggregator(object):
+    def __init__(self, dal, interval=0.1, max_events=1000, max_keys=10000):
+        self.dal = dal
+        self.interval = interval
+        self.max_events = max_events
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = {}
+        self.events = 0
+        self.total_events = 0
+        self.flushes = 0
+        self.flushed_keys = 0
+        self.dropped = 0
+        self.errors = 0
+        self.failed_at = 0
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.worker = threading.Thread(target=self._loop, name="CounterAggregator")
+        self.worker.setDaemon(True)
+        self.worker.start()
+        atexit.register(self.close)
+
+    #hkey为None时为INCRBY key,否则为HINCRBY key hkey
+    def add(self, key, amount=1, hkey=None):
+        with self.lock:
+            field = (key, hkey)
+            full = len(self.pending) >= self.max_keys
+            if full and field not in self.pending and self.failing():
+                self.dropped += 1
+                return
+            self.pending[field] = self.pending.get(field, 0) + amount
+            self.events += 1
+            self.total_events += 1
+            full = len(self.pending) >= self.max_keys and not self.failing()
+            if self.events >= self.max_events:
+                self.wakeup.set()
+        if full:
+            self.flush(force=False)
+
+    def failing(self):
+        return time.time() - self.failed_at < self.interval
+
+    #force为False时(调用方线程的同步刷新),上一次刷新失败后interval秒内不刷新
+    def flush(self, force=True):
+        with self.flush_lock:
+            if not force and self.failing():
+                return 0
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                self.events = 0
+            items = [(field, amount) for field, amount in pending.iteritems() if amount]
+            if not items:
+                return 0
+            try:
+                failed = [item for group in self.dal.fan_out(self._write, self.dal.group_by_shard(items, lambda item: item[0][0])) for item in group]
+            except Exception:
+                self.dal.logger.error("[CounterAggregator.flush]error, %s" %traceback.format_exc())
+                failed = items
+            self.flushed_keys += len(items) - len(failed)
+            if failed:
+                self.errors += 1
+                self.failed_at = time.time()
+                self._restore(failed)
+            else:
+                self.failed_at = 0
+                self.flushes += 1
+            if self.dal.debug:
+                self.dal.logger.debug("[CounterAggregator.flush]keys=%s, failed=%s" %(len(items), len(failed)))
+            return len(items) - len(failed)
+
+    #写入一个节点的增量,返回需要重试的增量: 节点出错时为该节点的全部增量
+    def _write(self, client, items):
+        try:
+            pipe_cmd = client.pipeline(transaction=False)
+            for (key, hkey), amount in items:
+                if hkey is None:
+                    pipe_cmd.incrby(key, amount)
+                else:
+                    pipe_cmd.hincrby(key, hkey, amount)
+            results = pipe_cmd.execute(raise_on_error=False)
+        except Exception:
+            self.dal.logger.error("[CounterAggregator._write]error, %s" %traceback.format_exc())
+            return items
+        rejected = [(item, result) for item, result in zip(items, results) if isinstance(result, Exception)]
+        if rejected:
+            with self.lock:
+                self.dropped += len(rejected)
+            self.dal.logger.error("[CounterAggregator._write]rejected %s, first: %s, %s" %(len(rejected), rejected[0][0][0], rejected[0][1]))
+        return []
+
+    #刷新失败的增量合并回去,下次刷新时重试
+    def _restore(self, items):
+        with self.lock:
+            for field, amount in items:
+                if field in self.pending or len(self.pending) < self.max_keys:
+                    self.pending[field] = self.pending.get(field, 0) + amount
+                else:
+                    self.dropped += 1
+
+    def _loop(self):
+        while not self.closed:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.dal.logger.error("[CounterAggregator._loop]error, %s" %traceback.format_exc())
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        if self.worker is not threading.current_thread():
+            self.worker.join(self.interval + 1)
+        self.flush()
+
+    def get_stat(self):
+        with self.lock:
+            return {"pending": len(self.pending), "events": self.total_events, "flushes": self.flushes,
+                "flushed_keys": self.flushed_keys, "dropped": self.dropped, "errors": self.errors}
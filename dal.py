@@ -1,17 +1,266 @@
 #!/usr/bin/env python
 #-*- coding:utf-8 -*-
 
+import copy
 import json
+import math
+import base64
+import hashlib
+import datetime
+import time
+import random
+import Queue
 import traceback
 import threading
+import itertools
+from contextlib import contextmanager
 import msgpack
 import pymongo
 from bson import ObjectId
-from langs import enum, ctime, StatNameSpace
+from langs import enum, ctime, StatNameSpace, SingleFlight, LRUCache
+from connpool import ConnectionPool
+from compress import Compressor, decompress
+from serializer import get_serializer
+from counter import CounterAggregator
+from shard import HashRing, shard_tag
+from consumer import PubSubConsumer
+from optrace import OpTracer, TracedRedis, TracedMongo
+from multiprocessing.pool import ThreadPool
 
 CACHETYPE = enum("string", "hash", "list", "set")
 NAME="dal"
 REDIS_STAT_NAME="redis"
+NEARCACHE_CHANNEL="dal_nearcache_invalidate"
+#stale-while-revalidate缓存值的包装字段: {SWR_FIELD: 软过期时间, "d": 回源耗时, "v": 原始值}
+SWR_FIELD="__swr__"
+SWR_JITTER=0.1
+#iter_find的chunk比清单key多保留的秒数,保证读到清单后有足够时间读完所有chunk
+ITER_CHUNK_GRACE=300
+
+#redis返回的错误表示命令不被支持(未知命令、被禁用、没有权限)时返回True,连接中断、超时等临时错误返回False
+#Dal不直接依赖redis-py,tornadis以ClientError返回同样的错误信息,按错误信息判断
+UNSUPPORTED_ERRORS = ("unknown command", "disabled", "not allowed", "noperm")
+
+def command_unsupported(error, command):
+    message = str(error).lower()
+    return command.lower() in message and any(text in message for text in UNSUPPORTED_ERRORS)
+
+#lua脚本不可用: 客户端没有脚本接口(AttributeError),NOSCRIPT,或EVAL/EVALSHA不被支持
+def script_unsupported(error):
+    if isinstance(error, AttributeError):
+        return True
+    return str(error).upper().startswith("NOSCRIPT") or command_unsupported(error, "eval")
+
+#KEYS为关键字集合; ARGV[1]删除命令(UNLINK/DEL), ARGV[2]每次删除的key数, ARGV[3]为1时返回被删除的成员key
+KW_CLEAR_SCRIPT = """
+local del = ARGV[1]
+local chunk = tonumber(ARGV[2])
+local ret = {}
+local n = 0
+for _, kw in ipairs(KEYS) do
+    local members = redis.call('SMEMBERS', kw)
+    for i = 1, #members, chunk do
+        n = n + redis.call(del, unpack(members, i, math.min(i + chunk - 1, #members)))
+    end
+    if ARGV[3] == '1' then
+        for _, m in ipairs(members) do ret[#ret + 1] = m end
+    end
+    redis.call(del, kw)
+end
+return {n, ret}
+"""
+
+"""
+以下为Dal与AsyncDal共用的key生成和序列化方法,保证两者可以读写同一份缓存
+"""
+def generate_key(table, prefix="", query={}, sort=None, limit=None, name="tablecache", criteria=None, pack=True, hashed=False):
+    if hashed:
+        return generate_hashed_key(table, prefix, query, sort=sort, limit=limit, name=name, criteria=criteria, pack=pack)
+
+    key = "%s_%s" %(name,table)
+
+    if prefix:
+        key = "%s_%s" %(key, prefix) 
+
+    if query:
+        key = key + "_" + "_".join(sorted(["%s_%s" %(key,value) for key,value in query.iteritems()], key=lambda a:a))
+
+    if sort and isinstance(sort, tuple):
+        key = key + "_$sort_" + "_".join([ "%s" %val for val in sort])
+
+    if criteria:
+        key = key + "_$criteria_" + "_".join(sorted(["%s_%s" %(key,value) for key,value in criteria.iteritems()], key=lambda a:a))
+
+    if limit:
+        key = key + "_$limit_%s" %(limit)
+
+    key = key + "_$pack_%s" %(pack_flag(pack))
+
+    return key
+
+#key中的序列化标记: 旧格式为1(msgpack)/0(json),注册表中的其他序列化器使用名称
+def pack_flag(pack):
+    if isinstance(pack, basestring):
+        return pack
+    return 1 if pack else 0
+
+#可读的key前缀,哈希key和按前缀扫描都以它开头
+def key_prefix(table, prefix="", name="tablecache"):
+    key = "%s_%s" %(name,table)
+    if prefix:
+        key = "%s_%s" %(key, prefix)
+    return key
+
+#集合语义的操作符,其列表按内容排序后再参与哈希
+SET_OPERATORS = frozenset(["$in", "$nin", "$all"])
+
+#把查询转换为确定的结构: dict按key排序,$in等列表排序;ObjectId与字符串形式的_id等价,与旧key规则一致
+def canonical(value, set_like=False):
+    if isinstance(value, dict):
+        return dict((k, canonical(v, k in SET_OPERATORS)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        items = [canonical(v) for v in value]
+        if set_like:
+            items.sort(key=lambda v: json.dumps(v, sort_keys=True))
+        return items
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return {"$date": value.isoformat()}
+    if value is None or isinstance(value, (str, unicode, int, long, float, bool)):
+        return value
+    return {"$repr": repr(value)}
+
+#热点查询形状的key缓存,以参数的repr为key,命中时跳过规范化和哈希
+KEY_MEMO = LRUCache(maxsize=10000, ttl=0)
+
+#哈希key: 可读前缀 + 查询形状规范化后的md5,长度固定
+def generate_hashed_key(table, prefix="", query={}, sort=None, limit=None, name="tablecache", criteria=None, pack=True):
+    memo_key = (name, table, prefix, repr(query), repr(sort), limit, repr(criteria), pack)
+    key = KEY_MEMO.get(memo_key)
+    if key is not None:
+        return key
+    shape = json.dumps([canonical(query or {}), canonical(sort), canonical(criteria or {}), limit or 0, pack_flag(pack)],
+        sort_keys=True, separators=(",", ":"))
+    key = "%s_%s" %(key_prefix(table, prefix, name), hashlib.md5(shape).hexdigest())
+    KEY_MEMO.set(memo_key, key)
+    return key
+
+#缓存值的序列化: pack为True时使用msgpack,False时使用json,字符串为serializer中注册的序列化器名称
+#传入compressor时超过阈值的值会被压缩
+def encode_value(value, pack=True, compressor=None):
+    data = get_serializer(pack).dumps(value)
+    if compressor is not None:
+        data = compressor.compress(data)
+    return data
+
+#压缩过的值总是先解压,没有compressor时不记录解压统计
+def decode_value(data, pack=True, compressor=None):
+    if compressor is not None:
+        data = compressor.decompress(data)
+    else:
+        data = decompress(data)
+    return get_serializer(pack).loads(data)
+
+#旧格式的序列化器不支持ObjectId,缓存前把_id转成str; native的序列化器原样保存,读写都不需要转换
+def stringify_ids(items, pack=True):
+    if get_serializer(pack).native:
+        return items
+    for r in items:
+        if r and "_id" in r:
+            r["_id"] = str(r.get("_id"))
+    return items
+
+#去掉stale-while-revalidate的包装,普通读取方也能读取swr模式写入的缓存
+def unwrap_swr(result):
+    if isinstance(result, dict) and SWR_FIELD in result:
+        return result.get("v")
+    return result
+
+#根据cache_kw计算关键字集合的key; query中有同名字段时(字符串/tuple形式)使用字段的值
+def kw_keys(cache_kw, prefix="", query=None):
+    if prefix is None:
+        prefix = ""
+    kw_list = []
+    if isinstance(cache_kw,(str,unicode)):
+        cache_kw = (cache_kw,)
+    if isinstance(cache_kw,tuple):
+        for kw in cache_kw:
+            vkey = query.get(kw) if query and kw in query else kw
+            kw_list.append("%s%s" %(prefix,vkey))
+    elif isinstance(cache_kw,dict):
+        for kw,value in cache_kw.iteritems():
+            kw_list.append("%s%s_%s" %(prefix,kw,value))
+    return kw_list
+
+#检查bulk_write的一项,合法时返回None,否则返回错误信息
+def bulk_op_error(op):
+    if not isinstance(op, dict):
+        return "op must be a dict, got %s" %type(op).__name__
+    name = op.get("op")
+    if name not in ("insert", "update", "insert_if_absent", "delete"):
+        return "unknown op %s" %name
+    if not isinstance(op.get("query") or {}, dict):
+        return "%s query must be a dict" %name
+    if "delete" == name:
+        return None
+    value = op.get("value")
+    if not isinstance(value, dict):
+        return "%s value must be a dict" %name
+    if "insert" != name:
+        operators = [k.startswith("$") for k in value]
+        if not operators or any(operators) != all(operators):
+            return "%s value must be a document or only $ operators" %name
+    return None
+
+#分页索引: pagecache ZSET的成员为_id,分值为在mongodb排序结果中的位置,总是按ZRANGE读取;
+#"<key>_meta"hash记录total(缓存的count)和loaded(已加载的数量),loaded小于total时索引只加载了前面一部分
+def page_meta_key(key):
+    return "%s_meta" %key
+
+def parse_page_meta(meta, ttl=-1):
+    if not meta or "total" not in meta:
+        return None
+    return {"total": int(meta["total"]), "loaded": int(meta.get("loaded", 0)), "ttl": ttl}
+
+#find_after的续页token: bson_msgpack编码的{"s": 排序字段, "d": 方向, "v": 最后一条的排序值, "i": 最后一条的_id},urlsafe base64
+def encode_page_token(sort_field, direction, value, _id):
+    data = get_serializer("bson_msgpack").dumps({"s": sort_field, "d": direction, "v": value, "i": _id})
+    return base64.urlsafe_b64encode(data).rstrip("=")
+
+def decode_page_token(token, sort_field, direction):
+    token = str(token)
+    data = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    after = get_serializer("bson_msgpack").loads(data)
+    if not isinstance(after, dict) or after.get("s") != sort_field or after.get("d") != direction:
+        raise ValueError("page token does not match sort %s %s" %(sort_field, direction))
+    return after
+
+#keyset分页: 排序值在after之后,排序值相同时按_id在after之后
+def keyset_query(query, sort_field, direction, after):
+    op = "$gt" if direction > 0 else "$lt"
+    if sort_field == "_id":
+        predicate = {"_id": {op: after["i"]}}
+    else:
+        predicate = {"$or": [{sort_field: {op: after["v"]}}, {sort_field: after["v"], "_id": {op: after["i"]}}]}
+    if not query:
+        return predicate
+    return {"$and": [query, predicate]}
+
+def keyset_sort(sort):
+    if not sort:
+        return "_id", 1
+    return sort[0], (-1 if len(sort) > 1 and sort[1] < 0 else 1)
+
+def get_range_by_page(page, count):
+    if page <= 0:
+        begin_i = 0
+        end_i = -1
+    else:
+        begin_i = (page - 1) * count
+        end_i = begin_i + count - 1
+    
+    return (begin_i, end_i)
 
 """
 @author xiejueheng
@@ -23,53 +272,60 @@ Dal提供访问mongodb和redis的简便方法，不需捕捉任何异常
 class RedisProxy(object):
     def __init__(self, dal):
         self.dal = dal
-        
-    def generateKey(self, table, prefix="", query={}, sort=None, limit=None, name="tablecache", criteria=None, pack=True):
-        key = "%s_%s" %(name,table)
-        
-        if prefix:
-            key = "%s_%s" %(key, prefix) 
-        
-        if query:
-            key = key + "_" + "_".join(sorted(["%s_%s" %(key,value) for key,value in query.iteritems()], key=lambda a:a))
-        
-        if sort and isinstance(sort, tuple):
-            key = key + "_$sort_" + "_".join([ "%s" %val for val in sort])
-        
-        if criteria:
-            key = key + "_$criteria_" + "_".join(sorted(["%s_%s" %(key,value) for key,value in criteria.iteritems()], key=lambda a:a))
+        self.unlink_supported = True
+        #None为未加载, False为脚本不可用(旧版本redis或不支持EVALSHA的代理),之后直接使用pipeline;
+        #连接中断等临时错误只在当次调用使用pipeline,不停用脚本
+        self.kw_clear_script = None
+
+    #返回table可用的进程内近端缓存,未开启时返回None
+    def get_near_cache(self, table):
+        near_cache = self.dal.near_cache
+        if near_cache is None:
+            return None
+        if self.dal.near_cache_tables and table not in self.dal.near_cache_tables:
+            return None
+        return near_cache
 
-        if limit:
-            key = key + "_$limit_%s" %(limit)
+    #近端缓存读写时都复制一份,调用方修改返回值或写入的值不会影响其他读取方
+    def near_get(self, near_cache, key):
+        result = near_cache.get(key)
+        return copy.deepcopy(result) if result is not None else None
 
-        if pack:
-            key = key +"_$pack_1"
-        else:
-            key = key +"_$pack_0"
-            
+    def near_set(self, near_cache, key, value, ttl=None):
+        near_cache.set(key, copy.deepcopy(value), ttl)
+        
+    #开启分片时分页索引的key带hash tag,与其元数据page_meta_key在同一节点,可以在一个事务pipeline中写入
+    def generateKey(self, table, prefix="", query={}, sort=None, limit=None, name="tablecache", criteria=None, pack=True):
+        key = generate_key(table, prefix, query, sort=sort, limit=limit, name=name, criteria=criteria, pack=pack, hashed=self.dal.hashed_keys)
+        if name == "pagecache":
+            return self.dal.shard_key(key)
         return key
+
+    #按前缀扫描时使用的前缀: 哈希key无法按查询条件匹配,只能使用table和prefix组成的可读前缀
+    def scanPrefix(self, table, prefix="", query={}):
+        if self.dal.hashed_keys:
+            return key_prefix(table, prefix) + "_"
+        return self.generateKey(table, prefix, query)
     
     @ctime(REDIS_STAT_NAME)
-    def strict_set(self, key, value, cache_time=0):
+    def strict_set(self, key, value, cache_time=0, pack=True):
         try:
-            packb = msgpack.packb(value)
-            result = self.dal.get_redis().set(key, packb)
+            packb = encode_value(value, pack, self.dal.compressor) if pack else value
+            result = self.dal.get_redis(key=key).set(key, packb, ex=cache_time or None)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_set]key=%s, value=%s, cache_time=%s, result=%s" %(key, value, cache_time, result))
-            if cache_time:
-                self.dal.get_redis().expire(key, cache_time)
         except Exception:
             self.dal.logger.error("[RedisProxy.strict_set]error, %s" %traceback.format_exc())
     
     @ctime(REDIS_STAT_NAME)
     def strict_get(self, key, pack=True):
         try:
-            result = self.dal.get_redis().get(key)
+            result = self.dal.get_redis(key=key).get(key)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_get]key=%s" %(key))
             if result:
                 if pack:
-                    return msgpack.unpackb(result, use_list = True)
+                    return decode_value(result, pack, self.dal.compressor)
                 else:
                     return result
             else:
@@ -77,13 +333,61 @@ class RedisProxy(object):
         except Exception:
             self.dal.logger.error("[RedisProxy.strict_get]error, %s" %traceback.format_exc())
             return None
-    
+
+    #一次MGET批量读取,返回与keys顺序一致的列表,未命中的位置为None
+    @ctime(REDIS_STAT_NAME)
+    def strict_mget(self, keys, pack=True):
+        if not keys:
+            return []
+        try:
+            groups = self.dal.group_by_shard(keys)
+            if len(groups) == 1:
+                result = groups[0][0].mget(keys)
+            else:
+                #按节点分组并行MGET,再按keys的顺序合并
+                values = {}
+                for pairs in self.dal.fan_out(lambda client, shard_keys: zip(shard_keys, client.mget(shard_keys)), groups):
+                    values.update(pairs)
+                result = [values.get(key) for key in keys]
+            if self.dal.debug:
+                self.dal.logger.debug("[RedisProxy.strict_mget]keys=%s" %(len(keys)))
+            if pack:
+                return [decode_value(value, pack, self.dal.compressor) if value else None for value in result]
+            else:
+                return result
+        except Exception:
+            self.dal.logger.error("[RedisProxy.strict_mget]error, %s" %traceback.format_exc())
+            return [None] * len(keys)
+
+    #一个pipeline批量写入key_value_dict,cache_time作为SET的EX参数
+    @ctime(REDIS_STAT_NAME)
+    def strict_pipeline_set(self, key_value_dict, cache_time=0, pack=True):
+        if not key_value_dict:
+            return
+        def _set(client, items):
+            pipe_cmd = client.pipeline(transaction=False)
+            for key, value in items:
+                if pack:
+                    value = encode_value(value, pack, self.dal.compressor)
+                if cache_time:
+                    pipe_cmd.set(key, value, ex=self.dal.jitter_ttl(cache_time))
+                else:
+                    pipe_cmd.set(key, value)
+            pipe_cmd.execute()
+
+        try:
+            self.dal.fan_out(_set, self.dal.group_by_shard(key_value_dict.iteritems(), lambda item: item[0]))
+            if self.dal.debug:
+                self.dal.logger.debug("[RedisProxy.strict_pipeline_set]keys=%s, cache_time=%s" %(len(key_value_dict), cache_time))
+        except Exception:
+            self.dal.logger.error("[RedisProxy.strict_pipeline_set]error, %s" %traceback.format_exc())
+
     @ctime(REDIS_STAT_NAME)
     def strict_setex(self, key, seconds, value, pack=True):
         try:
             if pack:
                 value = msgpack.packb(value)
-            result = self.dal.get_redis().setex(key,seconds,value)
+            result = self.dal.get_redis(key=key).setex(key,seconds,value)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_setex]key=%s, seconds=%s, result=%s" %(key, seconds, result))
         except Exception:
@@ -92,64 +396,81 @@ class RedisProxy(object):
     @ctime(REDIS_STAT_NAME)
     def strict_setnx(self, key, value, cache_time=43200):
         try:
-            result = self.dal.get_redis().setnx(key,value)
+            result = self.dal.get_redis(key=key).set(key, value, ex=cache_time or None, nx=True)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_setnx]key=%s,result=%s" %(key, result))
-            if cache_time:
-                self.dal.get_redis().expire(key, cache_time)
+            return bool(result)
         except Exception:
             self.dal.logger.error("[RedisProxy.strict_setnx]error, %s" %traceback.format_exc())
+            return False
     
     @ctime(REDIS_STAT_NAME)
-    def strict_incr(self,key):
+    #开启了计数器合并(Dal的counter_interval)时,aggregate为True的增量在进程内合并后批量写入,不返回结果
+    def strict_incr(self,key,aggregate=True):
+        if aggregate and self.dal.counter is not None:
+            self.dal.counter.add(key, 1)
+            return
         try:
-            result = self.dal.get_redis().incr(key)
+            result = self.dal.get_redis(key=key).incr(key)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_incr]key=%s, result=%s" %(key,result))
         except Exception:
             self.dal.logger.error("[RedisProxy.strict_incr]error, %s" %traceback.format_exc())
     
     @ctime(REDIS_STAT_NAME)
-    def strict_incrby(self,key,increment):
+    def strict_incrby(self,key,increment,aggregate=True):
+        if aggregate and self.dal.counter is not None:
+            self.dal.counter.add(key, increment)
+            return
         try:
-            result = self.dal.get_redis().incr(key,increment)
+            result = self.dal.get_redis(key=key).incr(key,increment)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_incrby]key=%s, increment=%s, result=%s" %(key,increment,result))
         except Exception:
             self.dal.logger.error("[RedisProxy.strict_incrby]error, %s" %traceback.format_exc())
 
     @ctime(REDIS_STAT_NAME)
-    def set(self, table, prefix="", value={}, query={}, cache_time=3600,sort=None,limit=None,cache_kw=None,criteria=None,pack=True):
+    def set(self, table, prefix="", value={}, query={}, cache_time=3600,sort=None,limit=None,cache_kw=None,criteria=None,pack=True,xx=False):
         key = self.generateKey(table, prefix, query, sort=sort, limit=limit, criteria=criteria, pack=pack)
         
         try:
-            if pack:
-                result = self.dal.get_redis().set(key, msgpack.packb(value))
-            else:
-                result = self.dal.get_redis().set(key, json.dumps(value))
+            cache_time = self.dal.jitter_ttl(cache_time)
+            result = self.dal.get_redis(key=key).set(key, encode_value(value, pack, self.dal.compressor), ex=cache_time or None, xx=xx)
+            if xx and not result:
+                return
 
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.set]key=%s, result=%s" %(key, result))
-            if cache_time:
-                self.dal.get_redis().expire(key, cache_time)
+            near_cache = self.get_near_cache(table)
+            if near_cache is not None and value is not None:
+                self.near_set(near_cache, key, value, cache_time or None)
             if cache_kw:
                 self.dal.cacheKeyword(key,query,cache_kw)
         except Exception:
             self.dal.logger.error("[RedisProxy.set]error, %s" %traceback.format_exc())
 
     @ctime(REDIS_STAT_NAME)
-    def get(self, table, prefix="", query={}, cache_time=0, sort=None, limit=None, criteria=None, pack=True):
+    def get(self, table, prefix="", query={}, cache_time=0, sort=None, limit=None, criteria=None, pack=True, swr=False):
         key = self.generateKey(table, prefix, query, sort=sort, limit=limit, criteria=criteria, pack=pack)
         status = None
         result = None
         try:
-            status = self.dal.get_redis().exists(key)
+            near_cache = self.get_near_cache(table)
+            if near_cache is not None:
+                result = self.near_get(near_cache, key)
+                if result is not None:
+                    status = "near"
+                    return result if swr else unwrap_swr(result)
+
+            result = self.dal.get_redis(key=key).get(key)
+            status = result is not None
             if status:
-                result = self.dal.get_redis().get(key)
-                if pack:
-                    return msgpack.unpackb(result, use_list = True)
-                elif result:
-                    return json.loads(result, "UTF-8")
+                if not result:
+                    return None
+                result = decode_value(result, pack, self.dal.compressor)
+                if near_cache is not None and result is not None:
+                    self.near_set(near_cache, key, result)
+                return result if swr else unwrap_swr(result)
             return None
         except Exception:
             self.dal.logger.error("[RedisProxy.get]error, result=%s, %s" %(result, traceback.format_exc()))
@@ -165,7 +486,7 @@ class RedisProxy(object):
         try:
             if pack:
                 value = msgpack.packb(value)
-            result = self.dal.get_redis().lpush(key, value)
+            result = self.dal.get_redis(key=key).lpush(key, value)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_lpush]key=%s,result=%s" %(key, result))
         except Exception:
@@ -177,7 +498,7 @@ class RedisProxy(object):
             key = key + "_" + prefix
         
         try:
-            result = self.dal.get_redis().lrange(key, start, stop)
+            result = self.dal.get_redis(key=key).lrange(key, start, stop)
             if pack:
                 return [msgpack.packb(r) for r in result]
             else:
@@ -190,7 +511,7 @@ class RedisProxy(object):
         if prefix:
             key = key + "_" + prefix
         try:
-            pipe_cmd = self.dal.get_redis().pipeline()
+            pipe_cmd = self.dal.get_redis(key=key).pipeline()
             for value in sets:
                 if pack and value:
                     packb = msgpack.packb(value)
@@ -207,7 +528,7 @@ class RedisProxy(object):
             key = key + "_" + prefix
             
         try:
-            result = self.dal.get_redis().scard(key)
+            result = self.dal.get_redis(key=key).scard(key)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_scard]key=%s,result=%s" %(key, result))
             return result
@@ -220,7 +541,7 @@ class RedisProxy(object):
             key = key + "_" + prefix
             
         try:
-            result = self.dal.get_redis().sismember(key, member)
+            result = self.dal.get_redis(key=key).sismember(key, member)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_sismember]key=%s,result=%s" %(key, result))
             return result
@@ -236,7 +557,7 @@ class RedisProxy(object):
             key = key + "_" + prefix
         
         try:
-            pipe_cmd = self.dal.get_redis().pipeline()
+            pipe_cmd = self.dal.get_redis(key=key).pipeline()
             for hkey, value in key_value_dict.iteritems():
                 if pack and value:
                     packb = msgpack.packb(value)
@@ -253,9 +574,9 @@ class RedisProxy(object):
             key = key + "_" + prefix
         try:
             if isinstance(member, list):
-                result = self.dal.get_redis().srem(key, *member)
+                result = self.dal.get_redis(key=key).srem(key, *member)
             else:
-                result = self.dal.get_redis().srem(key, member)
+                result = self.dal.get_redis(key=key).srem(key, member)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_srem]key=%s,result=%s" %(key, result))
         except Exception:
@@ -266,13 +587,19 @@ class RedisProxy(object):
         if prefix:
             key = key + "_" + prefix
         try:
-            if pack:
-                packb = msgpack.packb(member)
+            if isinstance(member, list):
+                packb = [msgpack.packb(m) for m in member] if pack else member
+            elif pack:
+                packb = [msgpack.packb(member)]
             else:
-                packb = member
-            result = self.dal.get_redis().sadd(key, packb)  
+                packb = [member]
             if cache_time:
-                self.dal.get_redis().expire(key, cache_time)
+                pipe_cmd = self.dal.get_redis(key=key).pipeline()
+                pipe_cmd.sadd(key, *packb)
+                pipe_cmd.expire(key, cache_time)
+                result = pipe_cmd.execute()[0]
+            else:
+                result = self.dal.get_redis(key=key).sadd(key, *packb)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_sadd]key=%s,result=%s" %(key, result))
         except Exception:
@@ -285,7 +612,7 @@ class RedisProxy(object):
         try:
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_sinter]key=%s" %(key))
-            result = self.dal.get_redis().sinter(key)
+            result = self.dal.get_redis(key=key).sinter(key)
             if pack and result:
                 return [ msgpack.unpackb(value, use_list = True) for value in result ]
             else:
@@ -299,7 +626,7 @@ class RedisProxy(object):
             key = key + "_" + prefix
             
         try:
-            result = self.dal.get_redis().zrange(key, start, stop, withscores=withscores)
+            result = self.dal.get_redis(key=key).zrange(key, start, stop, withscores=withscores)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_zrange]key=%s" %(key))
             return result
@@ -312,7 +639,7 @@ class RedisProxy(object):
             key = key + "_" + prefix
             
         try:
-            result = self.dal.get_redis().zrevrange(key, start, stop, withscores=withscores)
+            result = self.dal.get_redis(key=key).zrevrange(key, start, stop, withscores=withscores)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_zreverange]key=%s" %(key))
             return result
@@ -324,7 +651,7 @@ class RedisProxy(object):
         if prefix:
             key = key + "_" + prefix
         try:
-            result = self.dal.get_redis().zrangebyscore(key, start, stop, withscores=withscores)
+            result = self.dal.get_redis(key=key).zrangebyscore(key, start, stop, withscores=withscores)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_zrangebyscore]key=%s" %(key))
             return result
@@ -337,7 +664,7 @@ class RedisProxy(object):
             key = key + "_" + prefix
             
         try:
-            result = self.dal.get_redis().zcard(key)
+            result = self.dal.get_redis(key=key).zcard(key)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_zcard]key=%s, result=%s" %(key, result))
             return result
@@ -351,9 +678,13 @@ class RedisProxy(object):
             key = key + "_" + prefix
             
         try:
-            result = self.dal.get_redis().zadd(key, score, value)
             if cache_time:
-                self.dal.get_redis().expire(key, cache_time)
+                pipe_cmd = self.dal.get_redis(key=key).pipeline()
+                pipe_cmd.zadd(key, score, value)
+                pipe_cmd.expire(key, cache_time)
+                result = pipe_cmd.execute()[0]
+            else:
+                result = self.dal.get_redis(key=key).zadd(key, score, value)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_zadd]key=%s, result=%s" %(key, result))
         except Exception:
@@ -364,20 +695,63 @@ class RedisProxy(object):
         if prefix:
             key = key + "_" + prefix
         try:
-            pipe_cmd = self.dal.get_redis().pipeline()
+            pipe_cmd = self.dal.get_redis(key=key).pipeline()
             for score,value in sets:
                 pipe_cmd.zadd(key,value,score)
             pipe_cmd.execute()
         except Exception:
             self.dal.logger.error("[RedisProxy.strict_pipeline_zadd]error, %s" %traceback.format_exc())
         
+    #一次往返读取分页索引的元数据和start到stop的_id,索引不存在或已失效时返回(None, [])
+    @ctime(REDIS_STAT_NAME)
+    def page_index_range(self, key, start, stop):
+        try:
+            meta_key = page_meta_key(key)
+            pipe_cmd = self.dal.get_redis(key=key).pipeline(transaction=False)
+            pipe_cmd.exists(key)
+            pipe_cmd.hgetall(meta_key)
+            pipe_cmd.ttl(meta_key)
+            pipe_cmd.zrange(key, start, stop)
+            exists, meta, ttl, ids = pipe_cmd.execute()
+            meta = parse_page_meta(meta, ttl)
+            if meta is None or (meta["loaded"] and not exists):
+                return None, []
+            return meta, ids
+        except Exception:
+            self.dal.logger.error("[RedisProxy.page_index_range]error, %s" %traceback.format_exc())
+            return None, []
+
+    #从offset开始追加一段分页索引,offset为0时重建; 按chunk_size分批ZADD,与元数据在一个事务pipeline中写入
+    #追加时沿用索引剩余的过期时间,整个索引一起过期
+    @ctime(REDIS_STAT_NAME)
+    def page_index_extend(self, key, ids, offset, total, cache_time=0, chunk_size=1000):
+        meta_key = page_meta_key(key)
+        try:
+            pipe_cmd = self.dal.get_redis(key=key).pipeline()
+            if offset == 0:
+                pipe_cmd.delete(key, meta_key)
+            for i in xrange(0, len(ids), chunk_size):
+                args = []
+                for j, _id in enumerate(ids[i:i+chunk_size]):
+                    args += [offset + i + j, _id]
+                pipe_cmd.zadd(key, *args)
+            pipe_cmd.hmset(meta_key, {"total": total, "loaded": offset + len(ids)})
+            if cache_time and cache_time > 0:
+                pipe_cmd.expire(key, cache_time)
+                pipe_cmd.expire(meta_key, cache_time)
+            pipe_cmd.execute()
+            if self.dal.debug:
+                self.dal.logger.debug("[RedisProxy.page_index_extend]key=%s, offset=%s, ids=%s, total=%s" %(key, offset, len(ids), total))
+        except Exception:
+            self.dal.logger.error("[RedisProxy.page_index_extend]error, %s" %traceback.format_exc())
+
     @ctime(REDIS_STAT_NAME)
     def strict_zrem(self, key, member, prefix=""):
         if prefix:
             key = key + "_" + prefix
             
         try:
-            result = self.dal.get_redis().zrem(key, *member)
+            result = self.dal.get_redis(key=key).zrem(key, *member)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_zrem]key=%s, result=%s" %(key, result))
         except Exception:
@@ -393,9 +767,13 @@ class RedisProxy(object):
             else:
                 packb = value
                 
-            result = self.dal.get_redis().hset(key, hkey, packb)
             if cache_time:
-                self.dal.get_redis().expire(key, cache_time)
+                pipe_cmd = self.dal.get_redis(key=key).pipeline()
+                pipe_cmd.hset(key, hkey, packb)
+                pipe_cmd.expire(key, cache_time)
+                result = pipe_cmd.execute()[0]
+            else:
+                result = self.dal.get_redis(key=key).hset(key, hkey, packb)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_hset]key=%s, hkey=%s, result=%s" %(key, hkey, result))
         except Exception:
@@ -406,7 +784,7 @@ class RedisProxy(object):
         if prefix:
             key = key + "_" + prefix
         try:
-            result = self.dal.get_redis().hget(key, hkey)
+            result = self.dal.get_redis(key=key).hget(key, hkey)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_hget]key=%s, hkey=%s" %(key, hkey))
             if pack and result:
@@ -422,7 +800,7 @@ class RedisProxy(object):
             key = key + "_" + prefix
         
         try:
-            result = self.dal.get_redis().hmget(key, hkeys)
+            result = self.dal.get_redis(key=key).hmget(key, hkeys)
             if pack and result:
                 return [msgpack.unpackb(value, use_list = True) for value in result if value]
             else:
@@ -436,7 +814,7 @@ class RedisProxy(object):
             key = key + "_" + prefix
             
         try:
-            result = self.dal.get_redis().hdel(key, hkeys)
+            result = self.dal.get_redis(key=key).hdel(key, hkeys)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_hdel]key=%s, result=%s" %(key, result))
         except Exception:
@@ -448,7 +826,7 @@ class RedisProxy(object):
             key = key + "_" + prefix
             
         try:
-            result = self.dal.get_redis().hkeys(key)
+            result = self.dal.get_redis(key=key).hkeys(key)
             return result
         except Exception:
             self.dal.logger.error("[RedisProxy.strict_hexists]error, %s" %traceback.format_exc())
@@ -458,7 +836,7 @@ class RedisProxy(object):
         if prefix:
             key = key + "_" + prefix
         try:
-            result = self.dal.get_redis().hexists(key, hkey)
+            result = self.dal.get_redis(key=key).hexists(key, hkey)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.strict_hexists]key=%s, hkey=%s, result=%s" %(key, hkey, result))
             return result
@@ -466,84 +844,120 @@ class RedisProxy(object):
             self.dal.logger.error("[RedisProxy.strict_hexists]error, %s" %traceback.format_exc())
             
     @ctime(REDIS_STAT_NAME)
-    def strict_hincrby(self, key, hkey, prefix="", increment=1):
+    def strict_hincrby(self, key, hkey, prefix="", increment=1, aggregate=True):
         if prefix:
             key = key + "_" + prefix
+        if aggregate and self.dal.counter is not None:
+            self.dal.counter.add(key, increment, hkey)
+            return
         try:
-            result = self.dal.get_redis().hincrby(key, hkey)    
+            result = self.dal.get_redis(key=key).hincrby(key, hkey, increment)
             if self.dal.debug:
-                self.dal.logger.debug("[RedisProxy.strict_hexists]key=%s, hkey=%s, result=%s" %(key, hkey, result))
+                self.dal.logger.debug("[RedisProxy.strict_hincrby]key=%s, hkey=%s, increment=%s, result=%s" %(key, hkey, increment, result))
             return result
         except Exception:
             self.dal.logger.error("[RedisProxy.strict_hincrby]error, %s" %traceback.format_exc())
     
     @ctime(REDIS_STAT_NAME)
-    def hashset(self, table, prefix="", value={}, query={}, cache_time=43200, hkey=None):
-        key = self.generateKey(table, prefix, query, pack = False)
+    def hashset(self, table, prefix="", value={}, query={}, cache_time=43200, hkey=None, pack=False):
+        key = self.generateKey(table, prefix, query, pack = pack)
         try:
             #packb = msgpack.packb(value)
-            result = self.dal.get_redis().hset(key, hkey, json.dumps(value))
             if cache_time:
-                self.dal.get_redis().expire(key, cache_time)
+                pipe_cmd = self.dal.get_redis(key=key).pipeline()
+                pipe_cmd.hset(key, hkey, encode_value(value, pack, self.dal.compressor))
+                pipe_cmd.expire(key, cache_time)
+                result = pipe_cmd.execute()[0]
+            else:
+                result = self.dal.get_redis(key=key).hset(key, hkey, encode_value(value, pack, self.dal.compressor))
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.hashset]key=%s, hkey=%s, value=%s, result=%s" %(key, hkey, value, result))
         except Exception:
             self.dal.logger.error("[RedisProxy.hashset]error, %s" %traceback.format_exc())
-            self.dal.get_redis().delete(key)
+            self.dal.get_redis(key=key).delete(key)
         
     @ctime(REDIS_STAT_NAME)
-    def hashget(self, table, prefix="", query={}, cache_time=0, hkey=None):
-        key = self.generateKey(table, prefix, query, pack = False)
+    def hashget(self, table, prefix="", query={}, cache_time=0, hkey=None, pack=False):
+        key = self.generateKey(table, prefix, query, pack = pack)
         try:
-            result = self.dal.get_redis().hget(key, hkey)
+            result = self.dal.get_redis(key=key).hget(key, hkey)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.hashget]key=%s, hkey=%s, result=%s" %(key, hkey, result))
                     
             if result:
                 #return msgpack.unpackb(result, use_list = True)
-                return json.loads(result)
+                return decode_value(result, pack, self.dal.compressor)
             return None
         except Exception:
             self.dal.logger.error("[RedisProxy.hashget]error, %s" %traceback.format_exc())
-            self.dal.get_redis().delete(key)
+            self.dal.get_redis(key=key).delete(key)
 
     @ctime(REDIS_STAT_NAME)
-    def hash_get_all(self, table, prefix=""):
-        key = self.generateKey(table, prefix, {}, pack = False)
+    def hash_get_all(self, table, prefix="", scan_threshold=1000, scan_count=1000, pack=False):
+        key = self.generateKey(table, prefix, {}, pack = pack)
         try:
-            key_exists = self.dal.get_redis().exists(key)
-            if not key_exists:
+            hash_len = self.dal.get_redis(key=key).hlen(key)
+            if not hash_len:
                 return None
-            members = self.dal.get_redis().hkeys(key)
             if self.dal.debug:
-                self.dal.logger.debug("[RedisProxy.hash_get_all]table=%s, prefix=%s" %(table, prefix))
+                self.dal.logger.debug("[RedisProxy.hash_get_all]table=%s, prefix=%s, hlen=%s" %(table, prefix, hash_len))
 
-            result = []
-            for hash_field in members:
-                result_str = self.dal.get_redis().hget(key, hash_field)
-
-                if result_str:
-                    result.append(json.loads(result_str))
+            if hash_len <= scan_threshold:
+                values = self.dal.get_redis(key=key).hgetall(key).itervalues()
+            else:
+                values = (value for _, value in self.dal.get_redis(key=key).hscan_iter(key, count=scan_count))
+            result = [decode_value(result_str, pack, self.dal.compressor) for result_str in values if result_str]
         except Exception, e:
-            self.dal.get_redis().delete(key)
+            self.dal.get_redis(key=key).delete(key)
             self.dal.logger.error("[RedisProxy.hash_get_all] error, %s, bt:%s" %(e, traceback.format_exc()))
             return None
 
         return result
 
+    #以HSCAN分批遍历hash,逐条yield,适合字段很多的大hash
+    def iter_hash_get_all(self, table, prefix="", scan_count=1000, pack=False):
+        key = self.generateKey(table, prefix, {}, pack = pack)
+        try:
+            for _, result_str in self.dal.get_redis(key=key).hscan_iter(key, count=scan_count):
+                if result_str:
+                    yield decode_value(result_str, pack, self.dal.compressor)
+        except Exception, e:
+            self.dal.logger.error("[RedisProxy.iter_hash_get_all] error, %s, bt:%s" %(e, traceback.format_exc()))
+
+    #一个事务pipeline写入整个hash: 按chunk_size分批HMSET,最后EXPIRE一次
+    @ctime(REDIS_STAT_NAME)
+    def hashset_many(self, table, prefix="", mapping={}, query={}, cache_time=43200, chunk_size=1000, pack=False):
+        key = self.generateKey(table, prefix, query, pack = pack)
+        if not mapping:
+            return key
+        try:
+            pipe_cmd = self.dal.get_redis(key=key).pipeline()
+            items = mapping.items()
+            for i in xrange(0, len(items), chunk_size):
+                pipe_cmd.hmset(key, dict((hkey, encode_value(value, pack, self.dal.compressor)) for hkey, value in items[i:i+chunk_size]))
+            if cache_time:
+                pipe_cmd.expire(key, cache_time)
+            pipe_cmd.execute()
+            if self.dal.debug:
+                self.dal.logger.debug("[RedisProxy.hashset_many]key=%s, fields=%s" %(key, len(mapping)))
+        except Exception:
+            self.dal.logger.error("[RedisProxy.hashset_many]error, %s" %traceback.format_exc())
+            self.dal.get_redis(key=key).delete(key)
+        return key
+
     @ctime(REDIS_STAT_NAME)
-    def hashdel(self, table, prefix="", hkey=None):
-        key = self.generateKey(table, prefix, {}, pack = False)
+    def hashdel(self, table, prefix="", hkey=None, pack=False):
+        key = self.generateKey(table, prefix, {}, pack = pack)
         try:
-            key_exists = self.dal.get_redis().exists(key)
+            key_exists = self.dal.get_redis(key=key).exists(key)
             if key_exists:
-                type_str = self.dal.get_redis().type(key)
+                type_str = self.dal.get_redis(key=key).type(key)
                 if 'hash' != type_str:
                     self.dal.logger.error('[RedisProxy.hashdel]key=%s, prefix=%s,hkey=%s, not hash_type(%s)'
                         %(key, prefix, hkey, type_str))
                     return
 
-            self.dal.get_redis().hdel(key, hkey)
+            self.dal.get_redis(key=key).hdel(key, hkey)
         except Exception, e:
             self.dal.logger.error('hash del error')
         
@@ -560,7 +974,7 @@ class RedisProxy(object):
             return self.hashget(*params, **dict_params)
     
     def clearCache(self, table, prefix="", query={}):
-        key = self.generateKey(table, prefix, query)
+        key = self.generateKey(table, prefix, query, pack=self.dal.serializer_for(table))
         return self.clearCacheByKey(key)
     
     @ctime(REDIS_STAT_NAME)
@@ -568,26 +982,85 @@ class RedisProxy(object):
         try:
             if prefix:
                 key = key + "_" + prefix
-            return self.dal.get_redis().exists(key)
+            return self.dal.get_redis(key=key).exists(key)
         except Exception:
             self.dal.logger.error("[RedisProxy.exists]error, %s" %traceback.format_exc())   
     
-    def keys(self, table, prefix="", query={}):
+    def keys(self, table, prefix="", query={}, count=1000):
         try:
-            key = "%s*" %(self.generateKey(table, prefix, query))
-            result = self.dal.get_redis().keys(key)
+            key = "%s*" %(self.scanPrefix(table, prefix, query))
+            result = [k for client in self.dal.shard_clients() for k in client.scan_iter(match=key, count=count)]
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.keys]key=%s, result=%s" %(key, result))
             return result
         except Exception:
             self.dal.logger.error("[RedisProxy.keys]error, %s" %traceback.format_exc())
+
+    #以SCAN增量遍历匹配的key,每次yield不超过batch_size个key,不会像KEYS一样阻塞redis
+    def scan_keys(self, table, prefix="", query={}, count=1000, batch_size=500):
+        match = "%s*" %(self.scanPrefix(table, prefix, query))
+        batch = []
+        for client in self.dal.shard_clients():
+            for key in client.scan_iter(match=match, count=count):
+                batch.append(key)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    #UNLINK在后台线程释放内存,redis 4.0以下不支持时退化为DEL
+    @ctime(REDIS_STAT_NAME)
+    def unlink(self, *keys):
+        if not keys:
+            return 0
+        try:
+            return sum(self.dal.fan_out(self._unlink, self.dal.group_by_shard(keys)))
+        except Exception:
+            self.dal.logger.error("[RedisProxy.unlink] error, %s" %traceback.format_exc())
+            return 0
+
+    #按节点分组删除大量key,每个节点一个pipeline,每条UNLINK/DEL不超过chunk_size个key,返回删除的key数
+    @ctime(REDIS_STAT_NAME)
+    def unlink_many(self, keys, chunk_size=1000):
+        keys = list(keys)
+        if not keys:
+            return 0
+        try:
+            return sum(self.dal.fan_out(lambda client, shard_keys: self._unlink(client, shard_keys, chunk_size), self.dal.group_by_shard(keys)))
+        except Exception:
+            self.dal.logger.error("[RedisProxy.unlink_many] error, %s" %traceback.format_exc())
+            return 0
+
+    def _unlink(self, client, keys, chunk_size=0):
+        chunks = [keys[i:i+chunk_size] for i in xrange(0, len(keys), chunk_size)] if chunk_size else [keys]
+        if self.unlink_supported:
+            try:
+                if len(chunks) == 1:
+                    return client.execute_command("UNLINK", *keys)
+                pipe_cmd = client.pipeline(transaction=False)
+                for chunk in chunks:
+                    pipe_cmd.execute_command("UNLINK", *chunk)
+                return sum(pipe_cmd.execute())
+            except Exception, e:
+                #只有redis不支持UNLINK(旧版本)或客户端没有通用命令接口时改用DEL,连接中断等错误照常抛出
+                if not (isinstance(e, AttributeError) or command_unsupported(e, "unlink")):
+                    raise
+                self.unlink_supported = False
+                self.dal.logger.error("[RedisProxy.unlink]UNLINK unsupported, fallback to DEL, %s" %traceback.format_exc())
+        if len(chunks) == 1:
+            return client.delete(*keys)
+        pipe_cmd = client.pipeline(transaction=False)
+        for chunk in chunks:
+            pipe_cmd.delete(*chunk)
+        return sum(pipe_cmd.execute())
     
     @ctime(REDIS_STAT_NAME)
     def delete(self, key, prefix=""):
         if prefix:
             key = key + "_" + prefix
         try:
-            result = self.dal.get_redis().delete(key)
+            result = self.dal.get_redis(key=key).delete(key)
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.delete]key=%s, result=%s" %(key, result))
             return True
@@ -595,9 +1068,125 @@ class RedisProxy(object):
             self.dal.logger.error("[RedisProxy.delete] error, %s" %traceback.format_exc())
             return False
 
+    #一个pipeline为所有关键字集合添加成员key并设置过期时间
+    @ctime(REDIS_STAT_NAME)
+    def strict_pipeline_kw_sadd(self, kw_keys, members, cache_time=86400):
+        if not kw_keys or not members:
+            return
+        def _sadd(client, shard_kw_keys):
+            pipe_cmd = client.pipeline(transaction=False)
+            for kw_key in shard_kw_keys:
+                pipe_cmd.sadd(kw_key, *members)
+                if cache_time:
+                    pipe_cmd.expire(kw_key, cache_time)
+            pipe_cmd.execute()
+
+        try:
+            self.dal.fan_out(_sadd, self.dal.group_by_shard(kw_keys))
+            if self.dal.debug:
+                self.dal.logger.debug("[RedisProxy.strict_pipeline_kw_sadd]kw_keys=%s, members=%s" %(kw_keys, len(members)))
+        except Exception:
+            self.dal.logger.error("[RedisProxy.strict_pipeline_kw_sadd]error, %s" %traceback.format_exc())
+
+    #读取关键字集合的所有成员key,按节点分组并行SMEMBERS
+    def kw_members(self, kw_keys):
+        def _smembers(client, shard_kw_keys):
+            pipe_cmd = client.pipeline(transaction=False)
+            for kw_key in shard_kw_keys:
+                pipe_cmd.smembers(kw_key)
+            return set().union(*pipe_cmd.execute())
+
+        return list(set().union(*self.dal.fan_out(_smembers, self.dal.group_by_shard(kw_keys))))
+
+    #清除关键字集合及其中所有成员key,一次lua脚本在服务端完成;脚本不可用时退化为分批pipeline
+    #开启分片时成员key可能在其他节点,不使用脚本: 先并行读取成员,再按节点分组并行删除
+    #返回(被删除的key数, 成员key列表),成员key列表只在return_members=True时返回
+    @ctime(REDIS_STAT_NAME)
+    def clear_kw_keys(self, kw_keys, return_members=False, chunk_size=1000):
+        if not kw_keys:
+            return 0, []
+        if self.dal.shard_ring is None and self.kw_clear_script is not False:
+            del_cmd = "UNLINK" if self.unlink_supported else "DEL"
+            try:
+                client = self.dal.get_redis()
+                if self.kw_clear_script is None:
+                    self.kw_clear_script = client.register_script(KW_CLEAR_SCRIPT)
+                count, members = self.kw_clear_script(keys=kw_keys, args=[del_cmd, chunk_size, 1 if return_members else 0], client=client)
+                if self.dal.debug:
+                    self.dal.logger.debug("[RedisProxy.clear_kw_keys]kw_keys=%s, count=%s" %(kw_keys, count))
+                return count, members
+            except Exception, e:
+                self.kw_script_error("clear_kw_keys", e)
+
+        try:
+            members = self.kw_members(kw_keys)
+            count = self.unlink_many(members, chunk_size)
+            self.unlink(*kw_keys)
+            return count, members if return_members else []
+        except Exception:
+            self.dal.logger.error("[RedisProxy.clear_kw_keys]error, %s" %traceback.format_exc())
+            return 0, []
+
+    #脚本不被支持时停用并只记录一次日志,之后的关键字失效不再尝试脚本; 其他错误每次记录,脚本保持启用
+    def kw_script_error(self, caller, error):
+        if not script_unsupported(error):
+            self.dal.logger.error("[RedisProxy.%s]script error, fallback to pipeline, %s" %(caller, traceback.format_exc()))
+            return
+        if self.kw_clear_script is False:
+            return
+        self.kw_clear_script = False
+        self.dal.logger.error("[RedisProxy.%s]script error, disabled, fallback to pipeline, %s" %(caller, traceback.format_exc()))
+
+    #批量写入后的合并失效: 普通key的删除和关键字集合的清除放在同一个pipeline中,一次往返
+    @ctime(REDIS_STAT_NAME)
+    def clear_keys_and_kw(self, keys, kw_keys, return_members=False, chunk_size=1000):
+        keys = list(keys or [])
+        kw_keys = list(kw_keys or [])
+        if not keys and not kw_keys:
+            return 0, []
+        if self.dal.shard_ring is None and (not kw_keys or self.kw_clear_script is not False):
+            del_cmd = "UNLINK" if self.unlink_supported else "DEL"
+            try:
+                client = self.dal.get_redis()
+                pipe_cmd = client.pipeline(transaction=False)
+                for i in xrange(0, len(keys), chunk_size):
+                    pipe_cmd.execute_command(del_cmd, *keys[i:i+chunk_size])
+                if kw_keys:
+                    if self.kw_clear_script is None:
+                        self.kw_clear_script = client.register_script(KW_CLEAR_SCRIPT)
+                    self.kw_clear_script(keys=kw_keys, args=[del_cmd, chunk_size, 1 if return_members else 0], client=pipe_cmd)
+                result = pipe_cmd.execute()
+                count = sum(result[:-1] if kw_keys else result)
+                members = []
+                if kw_keys:
+                    count += result[-1][0]
+                    members = result[-1][1]
+                if self.dal.debug:
+                    self.dal.logger.debug("[RedisProxy.clear_keys_and_kw]keys=%s, kw_keys=%s, count=%s" %(len(keys), kw_keys, count))
+                return count, members
+            except Exception, e:
+                if kw_keys:
+                    self.kw_script_error("clear_keys_and_kw", e)
+                else:
+                    self.dal.logger.error("[RedisProxy.clear_keys_and_kw]pipeline error, fallback, %s" %traceback.format_exc())
+
+        #分片或脚本不可用时: 先读取关键字集合的成员,与普通key一起按节点分组并行删除
+        try:
+            members = self.kw_members(kw_keys) if kw_keys else []
+            count = self.unlink_many(keys + members, chunk_size)
+            if kw_keys:
+                self.unlink(*kw_keys)
+            if self.dal.debug:
+                self.dal.logger.debug("[RedisProxy.clear_keys_and_kw]keys=%s, kw_keys=%s, count=%s" %(len(keys), kw_keys, count))
+            return count, members if return_members else []
+        except Exception:
+            self.dal.logger.error("[RedisProxy.clear_keys_and_kw]error, %s" %traceback.format_exc())
+            return 0, []
+
     def clearCacheByKey(self, *keys):
         try:
-            result = self.dal.get_redis().delete(*keys)
+            self.dal.invalidate_near_cache(keys=keys)
+            result = sum(self.dal.fan_out(lambda client, shard_keys: client.delete(*shard_keys), self.dal.group_by_shard(keys)))
             if self.dal.debug:
                 self.dal.logger.debug("[RedisProxy.clearCacheByKey]keys=%s, result=%s" %(keys, result))
             return True
@@ -606,9 +1195,64 @@ class RedisProxy(object):
             return False
 
 class Dal(object):
-    def __init__(self, redis_pool, mongodb_pool, logger, debug=True, pubsub=None, ddb_pool=None, reset_ddb_conn=None):
+    """
+        near_cache: 可选的进程内近端缓存(langs.LRUCache),缓存RedisProxy.get/set的结果
+        near_cache_tables: 只对这些表启用近端缓存,为空时对所有表启用
+        写操作会通过pubsub的NEARCACHE_CHANNEL广播失效消息,其他进程在pubsub_listen_message中淘汰本地副本
+        single_flight: 缓存未命中时同一进程内相同key的回源合并为一次
+        cache_lease_time: 大于0时回源前先抢redis租约(SET NX),未抢到的进程最多等待cache_lease_wait秒读取缓存
+        ttl_jitter: 缓存过期时间随机缩短的最大比例,避免同时写入的key同时过期
+        swr_tables: 默认开启stale-while-revalidate的表,find_one/nfind也可以用swr参数单独开启;
+            缓存值带软过期时间,过软过期后仍返回旧值并由后台线程刷新,redis中的过期时间额外保留cache_time*swr_stale_ratio
+        pool_size: 旧连接池的连接数,为空时自动探测; 连接池也可以直接传入connpool.ConnectionPool
+        pool_timeout: Dal.connection()独占连接时的最长等待时间
+        hashed_keys: 为True时缓存key为"tablecache_<table>_<prefix>_<md5>",查询形状规范化后哈希,长度固定;
+            切换该选项相当于换了一套缓存key,旧key只能等过期
+        compress_threshold: 大于0时set/strict_set/hashset等写入的值序列化后超过该字节数则用compress_codec压缩;
+            读取总是识别压缩头,灰度时先升级所有读取方再开启压缩
+        compress_codec: zlib/lz4/zstd; compress_level: 压缩级别,None为codec默认值
+        serializers: {table: 序列化器名称},按表选择serializer中注册的序列化器,覆盖调用方的pack参数;
+            native的序列化器(如"bson_msgpack")直接缓存ObjectId/datetime/Decimal128,这些表返回的_id不再转成str
+        page_window: find_by_page的分页索引只加载到请求页之后page_window页,翻到未加载的位置时再继续加载
+        counter_interval: 大于0时strict_incr/strict_incrby/strict_hincrby的增量在进程内合并,每counter_interval秒
+            或累计counter_max_events次增量时用一个pipeline写入; 待写入的key超过counter_max_keys时调用方同步写入.
+            合并后这些方法不再返回结果,需要结果时传aggregate=False
+        shard_replicas: add_redis(name, client, shard=True)注册的redis按一致性哈希分片,每个节点在环上的虚拟节点数;
+            开启分片后RedisProxy按key选择redis,分页索引的key带hash tag与其元数据在同一节点,
+            MGET/批量写入/删除/关键字失效按节点分组,由shard_workers个线程并行执行; 未注册分片节点时仍使用redis_pool
+        publish_queue_size: pubsub_publish_many(background=True)后台发送队列的长度,队列满时丢弃
+        trace_ops: 为True时包装get_redis/get_mongodb返回的客户端,把redis往返/命令数/字节数和mongodb查询数
+            归到最外层的Dal操作上,get_stat输出每个操作的扇出分布(STAT-fanout),见optrace
+    """
+    def __init__(self, redis_pool, mongodb_pool, logger, debug=True, pubsub=None, ddb_pool=None, reset_ddb_conn=None, near_cache=None, near_cache_tables=None,
+            single_flight=True, cache_lease_time=0, cache_lease_wait=1.0, ttl_jitter=0.0, swr_tables=None, swr_stale_ratio=1.0, swr_beta=1.0, swr_queue_size=1024,
+            pool_size=None, pool_timeout=1.0, hashed_keys=False, compress_threshold=0, compress_codec="zlib", compress_level=None, serializers=None, page_window=5,
+            counter_interval=0, counter_max_events=1000, counter_max_keys=10000, shard_replicas=160, shard_workers=8,
+            publish_queue_size=10000, trace_ops=False):
         self.redis_pool = redis_pool
         self.redis_proxy = RedisProxy(self)
+        self.hashed_keys = hashed_keys
+        self.compressor = Compressor(compress_codec, compress_threshold, compress_level)
+        self.table_serializers = dict(serializers or {})
+        self.page_window = page_window
+        self.counter = None
+        self.shard_ring = None
+        self.shard_replicas = shard_replicas
+        self.shard_workers = shard_workers
+        self.shard_pool = None
+        self.shard_lock = threading.Lock()
+        self.pubsub_consumers = []
+        self.op_tracer = None
+        if trace_ops:
+            #ctime的钩子是进程级的,多个Dal共用一个OpTracer
+            self.op_tracer = StatNameSpace.op_tracer or OpTracer()
+            StatNameSpace.op_tracer = self.op_tracer
+        self.publish_queue = Queue.Queue(publish_queue_size)
+        self.publish_worker = None
+        self.publish_lock = threading.Lock()
+        self.publish_stat = {"queued": 0, "sent": 0, "pipelines": 0, "dropped": 0, "errors": 0}
+        for name in self.table_serializers.itervalues():
+            get_serializer(name)
         self.mongodb_pool = mongodb_pool
         self.redis_list = {}
         self.ddb_pool = ddb_pool
@@ -616,35 +1260,144 @@ class Dal(object):
         self.pubsub = pubsub 
         self.logger = logger
         self.debug = debug
-
-    def add_redis(self,name,redisPool):
+        self.redis_conn_pool = self.adapt_pool(redis_pool, lambda num: redis_pool.get_redis(num), "redis", pool_size, pool_timeout)
+        self.mongodb_conn_pool = self.adapt_pool(mongodb_pool, lambda num: mongodb_pool.get_mongo_db(num), "mongodb", pool_size, pool_timeout)
+        self.ddb_conn_pool = self.adapt_pool(ddb_pool, lambda num: ddb_pool.get(num), "ddb", pool_size, pool_timeout)
+        self.near_cache = near_cache
+        self.near_cache_tables = set(near_cache_tables) if near_cache_tables else None
+        self.single_flight = SingleFlight()
+        self.single_flight_enabled = single_flight
+        self.cache_lease_time = cache_lease_time
+        self.cache_lease_wait = cache_lease_wait
+        self.ttl_jitter = ttl_jitter
+        self.swr_tables = set(swr_tables) if swr_tables else set()
+        self.swr_stale_ratio = swr_stale_ratio
+        self.swr_beta = swr_beta
+        self.swr_queue = Queue.Queue(swr_queue_size)
+        self.swr_pending = set()
+        self.swr_lock = threading.Lock()
+        self.swr_worker = None
+        if self.near_cache is not None and self.pubsub:
+            self.pubsub_subscribe(NEARCACHE_CHANNEL)
+        if counter_interval > 0:
+            self.counter = CounterAggregator(self, counter_interval, counter_max_events, counter_max_keys)
+
+    #shard为True时加入一致性哈希环,weight为节点权重; 新增节点只会让约1/N的key换到新节点上
+    def add_redis(self,name,redisPool,shard=False,weight=1):
         self.redis_list[name] = redisPool
+        if shard:
+            with self.shard_lock:
+                if self.shard_ring is None:
+                    self.shard_ring = HashRing(self.shard_replicas)
+            self.shard_ring.add_node(name, weight)
+
+    def remove_shard(self, name):
+        if self.shard_ring is not None:
+            self.shard_ring.remove_node(name)
+            if not len(self.shard_ring):
+                self.shard_ring = None
+
+    #key所在的分片节点名称,未开启分片时返回None
+    def shard_for(self, key):
+        if self.shard_ring is None:
+            return None
+        return self.shard_ring.get_node(key)
+
+    #需要与其他key放在同一节点的key(如分页索引)加上hash tag,未开启分片时原样返回
+    def shard_key(self, key):
+        if self.shard_ring is None:
+            return key
+        return shard_tag(key)
+
+    #按分片节点分组,返回[(redis_client, items)]; get_key从item中取出key,默认item本身就是key
+    def group_by_shard(self, items, get_key=None):
+        if self.shard_ring is None:
+            return [(self.get_redis(), list(items))]
+        groups = {}
+        for item in items:
+            name = self.shard_ring.get_node(get_key(item) if get_key else item)
+            groups.setdefault(name, []).append(item)
+        return [(self.get_redis(name), group) for name, group in groups.iteritems()]
+
+    #所有分片节点的redis,用于SCAN等需要遍历全部key的操作
+    def shard_clients(self):
+        if self.shard_ring is None:
+            return [self.get_redis()]
+        return [self.get_redis(name) for name in self.shard_ring.nodes()]
+
+    #对group_by_shard的每个分组执行func(client, items),多个分组时并行执行,返回各分组结果的列表
+    #func中不能再调用fan_out,否则可能占满线程池
+    def fan_out(self, func, groups):
+        if len(groups) <= 1:
+            return [func(client, items) for client, items in groups]
+        if self.shard_pool is None:
+            with self.shard_lock:
+                if self.shard_pool is None:
+                    self.shard_pool = ThreadPool(self.shard_workers)
+        tracer = self.op_tracer
+        if tracer is None:
+            return self.shard_pool.map(lambda group: func(*group), groups)
+
+        #线程池中的调用仍然归到调用方的操作上
+        ctx = tracer.current()
+        def _run(group):
+            tracer.attach(ctx)
+            try:
+                return func(*group)
+            finally:
+                tracer.detach()
+        return self.shard_pool.map(_run, groups)
+
+    #立即写入合并中的计数器增量
+    def flush_counters(self):
+        if self.counter is not None:
+            return self.counter.flush()
+        return 0
+
+    #table配置了序列化器时使用配置的序列化器,否则使用调用方的pack
+    def serializer_for(self, table, pack=True):
+        return self.table_serializers.get(table, pack)
+
+    def adapt_pool(self, pool, get_func, name, size, timeout):
+        if pool is None or isinstance(pool, ConnectionPool):
+            return pool
+        return ConnectionPool(get_func, size=size, name=name, timeout=timeout)
+
+    #在with块内独占redis和mongodb连接各一个,块内的Dal调用都使用这两个连接
+    @contextmanager
+    def connection(self, timeout=None):
+        with self.redis_conn_pool.connection(timeout):
+            with self.mongodb_conn_pool.connection(timeout):
+                yield self
 
     def get_mongodb(self):
-        num = 1
-        if "." in threading.currentThread().name:
-            num = threading.currentThread().name.split(".")[1]
-        mongo_db = self.mongodb_pool.get_mongo_db(int(num))
+        mongo_db = self.mongodb_conn_pool.get()
         if None == mongo_db:
             raise Exception("Dal.getDBClient error,get mongodb from pool error ")    
+        elif self.op_tracer is not None:
+            return TracedMongo(mongo_db, self.op_tracer)
         else:
             return mongo_db
         
-    def get_redis(self,name=None):
+    #开启分片时传入key返回key所在节点的redis
+    def get_redis(self,name=None,key=None):
+        if key is not None and not name and self.shard_ring is not None:
+            name = self.shard_ring.get_node(key)
         if name:
             redis_client = self.redis_list.get(name)
             if None == redis_client:
                 self.logger.error("Dal.get_redis error,get %s redis_client from pool error " %name)    
                 return None
+            elif self.op_tracer is not None:
+                return TracedRedis(redis_client, self.op_tracer)
             else:
                 return redis_client
 
-        num = 1
-        if "." in threading.currentThread().name:
-            num = threading.currentThread().name.split(".")[1]
-        redis_client = self.redis_pool.get_redis(int(num))
+        redis_client = self.redis_conn_pool.get()
         if None == redis_client:
             raise Exception("Dal.get_redis error,get redis_client from pool error ")    
+        elif self.op_tracer is not None:
+            return TracedRedis(redis_client, self.op_tracer)
         else:
             return redis_client
         
@@ -652,17 +1405,15 @@ class Dal(object):
         if not self.ddb_pool:
             raise Exception("Dal.ddb_client error,ddb_pool init failed")
         
-        num = 1
-        if "." in threading.currentThread().name:
-            num = threading.currentThread().name.split(".")[1]
-        ddb_client = self.ddb_pool.get(int(num))
+        num = self.ddb_conn_pool.slot()
+        ddb_client = self.ddb_conn_pool.get_func(num)
         if None == ddb_client:
             raise Exception("Dal.ddb_client error,get ddb_client from pool error ")    
         else:
             if not ddb_client.IsConnAlive():
                 if self.reset_ddb_conn:
                     self.reset_ddb_conn(num)
-                    ddb_client = self.ddb_pool.get(int(num))
+                    ddb_client = self.ddb_conn_pool.get_func(num)
                 else:
                     self.logger("get_ddb error: no reset_ddb_conn func")
             return ddb_client
@@ -681,8 +1432,79 @@ class Dal(object):
             return self.get_redis().publish(key, data)
         return 0
     
+    #批量发布[(channel, msg)]: 同一个msg对象只编码一次,按chunk_size分批用pipeline发送
+    #返回与messages顺序一致的接收者数列表; background为True时放入后台发送队列,立即返回是否入队成功
+    def pubsub_publish_many(self, messages, useJson=True, chunk_size=500, background=False):
+        messages = list(messages)
+        if background:
+            return self._submit_publish(messages, useJson, chunk_size)
+
+        counts = [0] * len(messages)
+        encoded = {}
+        payloads = []
+        for i, (key, msg) in enumerate(messages):
+            if not key or not msg:
+                continue
+            data = msg
+            if useJson:
+                #广播时各channel通常共享同一个msg对象,按id缓存编码结果
+                data = encoded.get(id(msg))
+                if data is None:
+                    data = encoded[id(msg)] = msgpack.packb(msg)
+            payloads.append((i, key, data))
+
+        try:
+            client = self.get_redis()
+            for start in xrange(0, len(payloads), chunk_size):
+                chunk = payloads[start:start+chunk_size]
+                pipe_cmd = client.pipeline(transaction=False)
+                for _, key, data in chunk:
+                    pipe_cmd.publish(key, data)
+                for (i, _, _), count in zip(chunk, pipe_cmd.execute()):
+                    counts[i] = count
+                with self.publish_lock:
+                    self.publish_stat["sent"] += len(chunk)
+                    self.publish_stat["pipelines"] += 1
+            if self.debug:
+                self.logger.debug("[Dal.pubsub_publish_many]messages=%s, encoded=%s" %(len(payloads), len(encoded)))
+        except Exception:
+            with self.publish_lock:
+                self.publish_stat["errors"] += 1
+            self.logger.error("[Dal.pubsub_publish_many]error, %s" %traceback.format_exc())
+        return counts
+
+    def _submit_publish(self, messages, useJson, chunk_size):
+        with self.publish_lock:
+            try:
+                self.publish_queue.put_nowait((useJson, chunk_size, messages))
+            except Queue.Full:
+                self.publish_stat["dropped"] += len(messages)
+                return False
+            self.publish_stat["queued"] += len(messages)
+            if self.publish_worker is None:
+                self.publish_worker = threading.Thread(target=self._publish_loop, name="dal_publish")
+                self.publish_worker.setDaemon(True)
+                self.publish_worker.start()
+        return True
+
+    #后台发送: 一次取出队列中积压的所有请求,参数相同的相邻请求合并成一批发送
+    def _publish_loop(self):
+        while True:
+            batch = [self.publish_queue.get()]
+            while True:
+                try:
+                    batch.append(self.publish_queue.get_nowait())
+                except Queue.Empty:
+                    break
+            for (useJson, chunk_size), items in itertools.groupby(batch, lambda item: item[:2]):
+                try:
+                    self.pubsub_publish_many([m for _, _, messages in items for m in messages], useJson, chunk_size)
+                except Exception:
+                    self.logger.error("[Dal._publish_loop]error, %s" %traceback.format_exc())
+
     def pubsub_listen_message(self, useJson=True):
-        self.logger.debug("[Dal.pubsub_listen_message]useJson:%s" %(useJson))
+        if self.debug:
+            self.logger.debug("[Dal.pubsub_listen_message]useJson:%s" %(useJson))
         result = self.pubsub.listen()
         if not result:
             return None, None
@@ -691,6 +1513,9 @@ class Dal(object):
             channel = result.get("channel")
             data  = result.get("data")
             if "message" == rtype:
+                if NEARCACHE_CHANNEL == channel:
+                    self.on_near_cache_message(data)
+                    return None, None
                 if useJson:
                     try:
                         data = msgpack.unpackb(data, use_list = True)
@@ -698,8 +1523,148 @@ class Dal(object):
                         self.logger.error(traceback.format_exc())
                 return (channel, data)
         return None, None
+
+    #最多读取max_count条消息,返回未解码的[(channel, data)]; pubsub没有消息时立即返回
+    #近端缓存的失效消息在这里处理,不返回给调用方
+    def pubsub_listen_batch(self, max_count=100):
+        messages = []
+        while len(messages) < max_count:
+            result = self.pubsub.listen()
+            if not result:
+                break
+            if not isinstance(result, dict) or "message" != result.get("type"):
+                continue
+            channel = result.get("channel")
+            if NEARCACHE_CHANNEL == channel:
+                self.on_near_cache_message(result.get("data"))
+                continue
+            messages.append((channel, result.get("data")))
+        if self.debug and messages:
+            self.logger.debug("[Dal.pubsub_listen_batch]messages=%s" %(len(messages)))
+        return messages
+
+    #启动后台消费: 批量读取消息,按channel分给workers个线程解码并调用handler(channel, data),同一channel内保持顺序
+    #参数见consumer.PubSubConsumer,返回consumer,可调用stop()停止
+    def pubsub_consume(self, handler, workers=4, batch_size=100, queue_size=1000, idle_wait=0.01, useJson=True):
+        consumer = PubSubConsumer(self, handler, workers, batch_size, queue_size, idle_wait, useJson,
+            name="pubsub_%s" %len(self.pubsub_consumers))
+        self.pubsub_consumers.append(consumer)
+        return consumer.start()
+
+    #淘汰本地近端缓存,并广播给其他进程
+    def invalidate_near_cache(self, keys=None, prefixes=None, publish=True):
+        if self.near_cache is None or not (keys or prefixes):
+            return
+        keys = list(keys or [])
+        prefixes = list(prefixes or [])
+        self.near_cache.invalidate(keys, prefixes)
+        if publish:
+            try:
+                self.pubsub_publish(NEARCACHE_CHANNEL, {"keys": keys, "prefixes": prefixes})
+            except Exception:
+                self.logger.error("[Dal.invalidate_near_cache]error, %s" %traceback.format_exc())
+
+    def on_near_cache_message(self, data):
+        if self.near_cache is None:
+            return
+        try:
+            msg = msgpack.unpackb(data, use_list = True)
+            count = self.near_cache.invalidate(msg.get("keys"), msg.get("prefixes"))
+            if self.debug:
+                self.logger.debug("[Dal.on_near_cache_message]keys=%s, prefixes=%s, evicted=%s" %(len(msg.get("keys") or []), len(msg.get("prefixes") or []), count))
+        except Exception:
+            self.logger.error("[Dal.on_near_cache_message]error, %s" %traceback.format_exc())
         
     
+    #缓存未命中时的回源: 同一进程内相同key只有一个线程执行load,其余线程等待并共享结果;
+    #开启cache_lease_time时由抢到redis租约的进程回源,其他进程等待read_cache读到新值,超时后自行回源
+    def load_once(self, key, load, read_cache=None, copy_result=True):
+        if not self.single_flight_enabled:
+            return self._load_with_lease(key, load, read_cache)
+        return self.single_flight.do(key, lambda: self._load_with_lease(key, load, read_cache), copy_result=copy_result)
+
+    def _load_with_lease(self, key, load, read_cache):
+        if not self.cache_lease_time or read_cache is None:
+            return load()
+
+        lease_key = "lease_%s" %key
+        if self.redis_proxy.strict_setnx(lease_key, 1, cache_time=self.cache_lease_time):
+            self.single_flight.incr("lease_acquired")
+            try:
+                return load()
+            finally:
+                self.redis_proxy.delete(lease_key)
+
+        self.single_flight.incr("lease_waits")
+        deadline = time.time() + self.cache_lease_wait
+        while time.time() < deadline:
+            time.sleep(0.02)
+            #租约已释放仍读不到缓存时,执行方没有写入可读的值(如文档不存在),不再等待,自行回源
+            released = not self.redis_proxy.exists(lease_key)
+            result = read_cache()
+            if result is not None:
+                self.single_flight.incr("lease_hits")
+                return result
+            if released:
+                self.single_flight.incr("lease_released")
+                return load()
+        self.single_flight.incr("lease_timeouts")
+        return load()
+
+    #随机缩短过期时间,jitter为最大缩短比例,默认使用ttl_jitter
+    def jitter_ttl(self, cache_time, jitter=None):
+        if jitter is None:
+            jitter = self.ttl_jitter
+        if not cache_time or not jitter:
+            return cache_time
+        return max(1, int(cache_time * (1 - random.random() * jitter)))
+
+    def swr_enabled(self, table, swr=None):
+        if swr is None:
+            return table in self.swr_tables
+        return swr
+
+    #包装成带软过期时间的缓存值,返回(缓存值, redis中的过期时间)
+    def wrap_swr(self, value, cache_time, delta):
+        soft_time = self.jitter_ttl(cache_time, max(self.ttl_jitter, SWR_JITTER))
+        return {SWR_FIELD: time.time() + soft_time, "d": delta, "v": value}, int(soft_time + cache_time * self.swr_stale_ratio)
+
+    #读取带软过期时间的缓存值: 已过软过期,或按回源耗时概率性提前(XFetch)时提交后台刷新,本次仍返回缓存值
+    def read_swr(self, key, envelope, refresh):
+        if not isinstance(envelope, dict) or SWR_FIELD not in envelope:
+            return envelope
+        delta = envelope.get("d") or 0
+        if time.time() - delta * self.swr_beta * math.log(random.random() or 1e-10) >= envelope.get(SWR_FIELD):
+            self.submit_refresh(key, refresh)
+        return envelope.get("v")
+
+    def submit_refresh(self, key, refresh):
+        with self.swr_lock:
+            if key in self.swr_pending:
+                return
+            try:
+                self.swr_queue.put_nowait((key, refresh))
+            except Queue.Full:
+                self.single_flight.incr("swr_dropped")
+                return
+            self.swr_pending.add(key)
+            if self.swr_worker is None:
+                self.swr_worker = threading.Thread(target=self._swr_loop, name="dal_swr")
+                self.swr_worker.setDaemon(True)
+                self.swr_worker.start()
+        self.single_flight.incr("swr_refresh")
+
+    def _swr_loop(self):
+        while True:
+            key, refresh = self.swr_queue.get()
+            try:
+                self.load_once(key, refresh)
+            except Exception:
+                self.logger.error("[Dal._swr_loop]refresh %s error, %s" %(key, traceback.format_exc()))
+            finally:
+                with self.swr_lock:
+                    self.swr_pending.discard(key)
+
     @ctime(NAME)
     def update(self, table, prefix="", value={}, query={}, cache=True, cache_time=0, multi=False,upsert=True, cache_kw=None):
         try:
@@ -745,30 +1710,164 @@ class Dal(object):
             self.logger.error(traceback.format_exc())
             return False
     
+    #批量写入: ops中每一项为dict,"op"为insert/update/insert_if_absent/delete,其余字段与对应的单条方法参数相同:
+    #    {"op": "insert", "value": doc}
+    #    {"op": "update", "query": q, "value": v, "multi": False, "upsert": True}
+    #    {"op": "insert_if_absent", "query": q, "value": v}
+    #    {"op": "delete", "query": q}
+    #每项还可以带"prefix"和"cache_kw"; 整批通过一次mongodb bulk操作写入,所有涉及的缓存key和cache_kw去重后在最后一次清除
+    #ordered为True时遇到错误即停止,之后的项不执行; 返回统计和与ops顺序一致的每项结果{"ok", "error", "_id"}
+    #不合法的项(未知的op,缺少value等)不会执行,记为错误: ordered时停在该项,否则跳过,不抛出异常
     @ctime(NAME)
-    def find_one(self, table, prefix="", query={}, cache=True, cache_time=3600, criteria=None, cache_kw=None, pack=True):
+    def bulk_write(self, table, ops, ordered=False, prefix="", cache=True, cache_kw=None):
+        results = [{"ok": False, "error": "not executed", "_id": None} for _ in ops]
+        summary = {"inserted": 0, "upserted": 0, "matched": 0, "modified": 0, "removed": 0, "errors": 0, "invalidated": 0, "results": results}
+        if not ops:
+            return summary
+
         try:
-            prefix = "find_one" if not prefix else "%s_find_one" %prefix
+            collection = self.get_mongodb()[table]
+            bulk = collection.initialize_ordered_bulk_op() if ordered else collection.initialize_unordered_bulk_op()
+        except Exception, e:
+            #还没有写入任何数据,不需要清除缓存
+            self.logger.error("[Dal.bulk_write]error, %s" %traceback.format_exc())
+            for r in results:
+                r["error"] = str(e)
+            summary["errors"] = len(results)
+            return summary
+
+        #bulk中第n个操作对应的ops下标
+        index_map = []
+        for i, op in enumerate(ops):
+            error = bulk_op_error(op)
+            if error is None:
+                try:
+                    self._add_bulk_op(bulk, op)
+                    index_map.append(i)
+                except Exception, e:
+                    error = str(e)
+            if error is not None:
+                results[i]["error"] = error
+                if ordered:
+                    break
+
+        bulk_result = None
+        if index_map:
+            try:
+                bulk_result = bulk.execute()
+            except pymongo.errors.BulkWriteError, e:
+                bulk_result = e.details
+            except Exception, e:
+                self.logger.error("[Dal.bulk_write]error, %s" %traceback.format_exc())
+                for i in index_map:
+                    results[i]["error"] = str(e)
+
+        if bulk_result is not None:
+            summary["inserted"] = bulk_result.get("nInserted", 0)
+            summary["upserted"] = bulk_result.get("nUpserted", 0)
+            summary["matched"] = bulk_result.get("nMatched", 0)
+            summary["modified"] = bulk_result.get("nModified", 0)
+            summary["removed"] = bulk_result.get("nRemoved", 0)
+            errors = dict((index_map[err["index"]], err.get("errmsg")) for err in bulk_result.get("writeErrors", []))
+            stop = min(errors) if ordered and errors else len(ops)
+            upserted = dict((index_map[u["index"]], u["_id"]) for u in bulk_result.get("upserted", []))
+            for i in index_map:
+                op = ops[i]
+                if i in errors:
+                    results[i] = {"ok": False, "error": errors[i], "_id": None}
+                elif i < stop:
+                    _id = op["value"].get("_id") if "insert" == op.get("op") else upserted.get(i)
+                    results[i] = {"ok": True, "error": None, "_id": _id}
+        summary["errors"] = len([r for r in results if not r["ok"]])
+
+        #执行失败时无法确定哪些已经写入,执行过的项全部清除
+        executed = set(index_map) if bulk_result is None else set()
+        keys = set()
+        kw_list = set(kw_keys(cache_kw))
+        pack = self.serializer_for(table)
+        for i, (op, r) in enumerate(zip(ops, results)):
+            if not (r["ok"] or i in executed):
+                continue
             if cache:
-                result = self.redis_proxy.read_by_cache_type(CACHETYPE.string ,table, prefix, query, cache_time, criteria=criteria, pack=pack)
-                if result is not None:
-                    return result
-
-            if criteria:
-                result=self.get_mongodb()[table].find_one(query,criteria)
+                op_prefix = op.get("prefix", prefix)
+                query = (op.get("query") or {}) if op.get("op") in ("update", "delete") else {}
+                keys.add(self.redis_proxy.generateKey(table, op_prefix, query, pack=pack))
+            if op.get("cache_kw"):
+                kw_list.update(kw_keys(op["cache_kw"]))
+        if keys or kw_list:
+            self.invalidate_near_cache(keys=keys)
+            count, members = self.redis_proxy.clear_keys_and_kw(keys, kw_list, return_members=self.near_cache is not None)
+            if members:
+                self.invalidate_near_cache(keys=members)
+            summary["invalidated"] = count
+        if self.debug:
+            self.logger.debug("[Dal.bulk_write]table=%s, ops=%s, ordered=%s, keys=%s, kw=%s, errors=%s" %(table, len(ops), ordered, len(keys), len(kw_list), summary["errors"]))
+        return summary
+
+    def _add_bulk_op(self, bulk, op):
+        name = op.get("op")
+        if "insert" == name:
+            bulk.insert(op["value"])
+        elif name in ("update", "insert_if_absent"):
+            finder = bulk.find(op.get("query") or {})
+            if op.get("upsert", True):
+                finder = finder.upsert()
+            value = op["value"]
+            if not any(k.startswith("$") for k in value):
+                finder.replace_one(value)
+            elif op.get("multi"):
+                finder.update(value)
             else:
-                result=self.get_mongodb()[table].find_one(query)
+                finder.update_one(value)
+        else:
+            bulk.find(op.get("query") or {}).remove()
+
+    #批量插入,见bulk_write
+    def insert_many(self, table, values, prefix="", cache=True, cache_kw=None, ordered=False):
+        return self.bulk_write(table, [{"op": "insert", "value": value} for value in values], ordered=ordered, prefix=prefix, cache=cache, cache_kw=cache_kw)
+
+    #批量执行多条update,updates为(query, value)的列表,见bulk_write
+    def update_many(self, table, updates, prefix="", multi=False, upsert=True, cache=True, cache_kw=None, ordered=False):
+        ops = [{"op": "update", "query": query, "value": value, "multi": multi, "upsert": upsert} for query, value in updates]
+        return self.bulk_write(table, ops, ordered=ordered, prefix=prefix, cache=cache, cache_kw=cache_kw)
+
+    @ctime(NAME)
+    def find_one(self, table, prefix="", query={}, cache=True, cache_time=3600, criteria=None, cache_kw=None, pack=True, swr=None):
+        try:
+            prefix = "find_one" if not prefix else "%s_find_one" %prefix
+            swr = self.swr_enabled(table, swr)
+            pack = self.serializer_for(table, pack)
 
-            if result and "_id" in result:
-                result["_id"] = str(result.get("_id"))
+            def _load(refresh=False):
+                begin = time.time()
+                if criteria:
+                    result=self.get_mongodb()[table].find_one(query,criteria)
+                else:
+                    result=self.get_mongodb()[table].find_one(query)
+
+                stringify_ids([result], pack)
+
+                if cache:
+                    if self.debug:
+                        self.logger.debug("[Dal.find_one]write_by_cache_type table=%s, prefix=%s, query=%s" %(table, prefix, query))
+
+                    value, ttl = self.wrap_swr(result, cache_time, time.time() - begin) if swr else (result, cache_time)
+                    self.redis_proxy.write_by_cache_type(CACHETYPE.string, table, prefix=prefix, value=value, query=query, cache_time=ttl, criteria=criteria, cache_kw=cache_kw, pack=pack, xx=refresh)
+                return result
 
             if cache:
-                if self.debug:
-                    self.logger.debug("[Dal.find_one]write_by_cache_type table=%s, prefix=%s, query=%s" %(table, prefix, query))
-                
-                self.redis_proxy.write_by_cache_type(CACHETYPE.string, table, prefix=prefix, value=result, query=query, cache_time=cache_time, criteria=criteria, cache_kw=cache_kw, pack=pack)
-            
-            return result
+                result = self.redis_proxy.read_by_cache_type(CACHETYPE.string ,table, prefix, query, cache_time, criteria=criteria, pack=pack, swr=swr)
+                key = None
+                if swr and result is not None:
+                    key = self.redis_proxy.generateKey(table, prefix, query, criteria=criteria, pack=pack)
+                    result = self.read_swr(key, result, lambda: _load(refresh=True))
+                if result is not None:
+                    return result
+
+                key = key or self.redis_proxy.generateKey(table, prefix, query, criteria=criteria, pack=pack)
+                return self.load_once(key, _load,
+                    lambda: self.redis_proxy.read_by_cache_type(CACHETYPE.string ,table, prefix, query, cache_time, criteria=criteria, pack=pack))
+            return _load()
         except Exception, e:
             self.logger.error("[Dal.find_one]error: %s, bt: %s" %(e, traceback.format_exc()))
             return None
@@ -834,41 +1933,51 @@ class Dal(object):
         new find 遵循pymongo的查询规则,取代find
     """
     @ctime(NAME)
-    def nfind(self, table, prefix="", query={}, cache=True, cache_time=43200, sort=None, criteria=None, limit=None, cache_kw=None, pack=True):
+    def nfind(self, table, prefix="", query={}, cache=True, cache_time=43200, sort=None, criteria=None, limit=None, cache_kw=None, pack=True, swr=None):
         result = None
         try:
-            if cache:
-                result = self.redis_proxy.read_by_cache_type(CACHETYPE.string ,table, prefix, query, cache_time, sort=sort, limit=limit, criteria=criteria, pack=pack)
-                if result is not None:
-                    return result
-            
-            if criteria:
-                cursor = self.get_mongodb()[table].find(query,criteria)
-            else:
-                cursor = self.get_mongodb()[table].find(query)
+            swr = self.swr_enabled(table, swr)
+            pack = self.serializer_for(table, pack)
 
-            if sort:
-                if isinstance(sort, tuple):
-                    cursor = cursor.sort(*sort)
+            def _load(refresh=False):
+                begin = time.time()
+                if criteria:
+                    cursor = self.get_mongodb()[table].find(query,criteria)
                 else:
-                    cursor = cursor.sort(sort)
-                    
-            if limit and limit > 0:
-                cursor = cursor.limit(limit)
-                
-            result = list(cursor)
-            
-            for r in result:
-                if "_id" in r:
-                    r["_id"] = str(r.get("_id"))
+                    cursor = self.get_mongodb()[table].find(query)
+
+                if sort:
+                    if isinstance(sort, tuple):
+                        cursor = cursor.sort(*sort)
+                    else:
+                        cursor = cursor.sort(sort)
+
+                if limit and limit > 0:
+                    cursor = cursor.limit(limit)
+
+                result = stringify_ids(list(cursor), pack)
+
+                if cache:
+                    if self.debug:
+                        self.logger.debug("[Dal.nfind]write_by_cache_type table=%s, prefix=%s, query=%s" %(table, prefix, query))
+
+                    value, ttl = self.wrap_swr(result, cache_time, time.time() - begin) if swr else (result, cache_time)
+                    self.redis_proxy.write_by_cache_type(CACHETYPE.string, table, prefix=prefix, value=value, query=query,criteria=criteria,cache_time=ttl,sort=sort,limit=limit,cache_kw=cache_kw, pack=pack, xx=refresh)
+                return result
 
             if cache:
-                if self.debug:
-                    self.logger.debug("[Dal.nfind]write_by_cache_type table=%s, prefix=%s, query=%s" %(table, prefix, query))
+                result = self.redis_proxy.read_by_cache_type(CACHETYPE.string ,table, prefix, query, cache_time, sort=sort, limit=limit, criteria=criteria, pack=pack, swr=swr)
+                key = None
+                if swr and result is not None:
+                    key = self.redis_proxy.generateKey(table, prefix, query, sort=sort, limit=limit, criteria=criteria, pack=pack)
+                    result = self.read_swr(key, result, lambda: _load(refresh=True))
+                if result is not None:
+                    return result
 
-                self.redis_proxy.write_by_cache_type(CACHETYPE.string, table, prefix=prefix, value=result, query=query,criteria=criteria,cache_time=cache_time,sort=sort,limit=limit,cache_kw=cache_kw, pack=pack)
-            
-            return result
+                key = key or self.redis_proxy.generateKey(table, prefix, query, sort=sort, limit=limit, criteria=criteria, pack=pack)
+                return self.load_once(key, _load,
+                    lambda: self.redis_proxy.read_by_cache_type(CACHETYPE.string ,table, prefix, query, cache_time, sort=sort, limit=limit, criteria=criteria, pack=pack))
+            return _load()
         except Exception, e:
             self.logger.error("[Dal.nfind]error: %s, bt: %s" %(e, traceback.format_exc()))
             return None
@@ -876,6 +1985,88 @@ class Dal(object):
             if self.debug:
                 self.logger.debug("[Dal.find]finally table=%s, prefix=%s, query=%s, cache=%s, cache_time=%s, criteria=%s" %(table, prefix, query, cache, cache_time, criteria))
     
+    #流式查询: 按batch_size从mongodb游标分批读取,内存中最多只有一批结果; batches为True时每次yield一批,否则逐条yield
+    #cache为True时每批写入一个chunk key,全部写完后再写入清单key,之后的读取按chunk逐个从redis流式读取;
+    #中途停止迭代时不会写入清单,不会留下不完整的缓存
+    def iter_find(self, table, prefix="", query={}, cache=False, cache_time=43200, sort=None, criteria=None, limit=None, batch_size=1000, batches=False, cache_kw=None, pack=True):
+        prefix = "iter_find" if not prefix else "%s_iter_find" %prefix
+        pack = self.serializer_for(table, pack)
+        load = lambda skip: self._iter_cursor(table, query, sort, criteria, limit, batch_size, pack, skip)
+        source = None
+        if cache:
+            key = self.redis_proxy.generateKey(table, prefix, query, sort=sort, limit=limit, criteria=criteria, pack=pack)
+            manifest = self.redis_proxy.strict_get(key)
+            #chunk总是序列化后保存,pack只选择序列化器(False为json)
+            codec = get_serializer(pack).name
+            if manifest:
+                source = self._iter_chunks(key, manifest, codec, load)
+            else:
+                source = self._iter_and_cache(key, load(0), cache_time, codec, query, cache_kw)
+        else:
+            source = load(0)
+
+        for batch in source:
+            if batches:
+                yield batch
+            else:
+                for r in batch:
+                    yield r
+
+    def _iter_cursor(self, table, query, sort, criteria, limit, batch_size, pack, skip=0):
+        if limit and limit > 0 and skip >= limit:
+            return
+        if criteria:
+            cursor = self.get_mongodb()[table].find(query, criteria)
+        else:
+            cursor = self.get_mongodb()[table].find(query)
+        if sort:
+            if isinstance(sort, tuple):
+                cursor = cursor.sort(*sort)
+            else:
+                cursor = cursor.sort(sort)
+        if skip:
+            cursor = cursor.skip(skip)
+        if limit and limit > 0:
+            cursor = cursor.limit(limit - skip)
+        cursor = cursor.batch_size(batch_size)
+
+        batch = []
+        for r in cursor:
+            batch.append(r)
+            if len(batch) >= batch_size:
+                yield stringify_ids(batch, pack)
+                batch = []
+        if batch:
+            yield stringify_ids(batch, pack)
+
+    def _iter_and_cache(self, key, source, cache_time, pack, query, cache_kw):
+        chunks = 0
+        count = 0
+        for batch in source:
+            self.redis_proxy.strict_set("%s_%s" %(key, chunks), batch, cache_time + ITER_CHUNK_GRACE, pack=pack)
+            chunks += 1
+            count += len(batch)
+            yield batch
+
+        self.redis_proxy.strict_set(key, {"chunks": chunks, "count": count}, self.jitter_ttl(cache_time))
+        if cache_kw:
+            self.cacheKeyword([key] + ["%s_%s" %(key, i) for i in xrange(chunks)], query, cache_kw)
+        if self.debug:
+            self.logger.debug("[Dal.iter_find]cached key=%s, chunks=%s, count=%s" %(key, chunks, count))
+
+    def _iter_chunks(self, key, manifest, pack, load):
+        offset = 0
+        for i in xrange(manifest.get("chunks", 0)):
+            batch = self.redis_proxy.strict_get("%s_%s" %(key, i), pack=pack)
+            if batch is None:
+                #chunk已过期或被淘汰,从已读取的位置回源mongodb继续
+                self.logger.error("[Dal.iter_find]chunk missing, key=%s, chunk=%s, offset=%s" %(key, i, offset))
+                for batch in load(offset):
+                    yield batch
+                return
+            offset += len(batch)
+            yield batch
+
     @ctime(NAME)
     def delete(self, table, query, prefix="", cache=True, cache_type=CACHETYPE.string, cache_kw=None):
         try:
@@ -896,22 +2087,20 @@ class Dal(object):
     def hash_get_one(self, table_name, prefix, query, fields = {"_id":0}, cache=True, reload=False):
         result = None
         try:
+            pack = self.serializer_for(table_name, False)
             if cache:
                 if False == reload:
-                    result = self.redis_proxy.hashget(table_name, prefix, query={}, hkey = '%s'%(query))
+                    result = self.redis_proxy.hashget(table_name, prefix, query={}, hkey = '%s'%(query), pack = pack)
                     if result is not None:
                         return result
 
             result = self.get_mongodb()[table_name].find_one(query, fields)
-            if result and '_id' in result:
-                id = str(result.get('_id'))
-                result.pop('_id', None)
-                result['_id'] = id
+            stringify_ids([result], pack)
 
             if cache and result is not None:
                 self.check_utf8_dict(query)
                 self.redis_proxy.hashset(table_name, query = {}, prefix = prefix, 
-                    value = result, hkey = '%s'%(query))
+                    value = result, hkey = '%s'%(query), pack = pack)
         except Exception, e:
             self.logger.error("[Dal.hash_get_one]error %s, bt:%s" %(e,traceback.format_exc()))
 
@@ -939,7 +2128,7 @@ class Dal(object):
             db_ret = self.get_mongodb()[table_name].update(query, update_fields, upsert=True)
             if cache:
                 self.check_utf8_dict(query)
-                self.redis_proxy.hashdel(table_name, prefix, hkey='%s'%(query))
+                self.redis_proxy.hashdel(table_name, prefix, hkey='%s'%(query), pack=self.serializer_for(table_name, False))
         except Exception, e:
             self.logger.error('[Dal.hash_set_one]error %s, bt: %s' %(e, traceback.format_exc()))
             return False
@@ -961,20 +2150,19 @@ class Dal(object):
     def hash_get_all(self, table_name, prefix, query, index_key, fields={"_id":0}, cache=True, reload=False, cache_time = 43200, cache_kw = None):
         result = []
         try:
+            pack = self.serializer_for(table_name, False)
             if cache:
                 #如果要设置缓存
                 if False == reload:
                     #读取缓存中的数据
-                    redis_ret = self.redis_proxy.hash_get_all(table_name, prefix)
+                    redis_ret = self.redis_proxy.hash_get_all(table_name, prefix, pack = pack)
                     if redis_ret is not None:
                         return redis_ret 
 
             cursor = self.get_mongodb()[table_name].find(query, fields)
+            mapping = {}
             for db_item in cursor:
-                if '_id' in db_item:
-                    id = str(db_item.get('_id'))
-                    db_item.pop('_id', None)
-                    db_item['_id'] = id
+                stringify_ids([db_item], pack)
 
                 if cache:
                     hkeyvalue = {}
@@ -982,33 +2170,22 @@ class Dal(object):
                         continue
 
                     hkeyvalue[index_key] = db_item[index_key]
-                    self.redis_proxy.hashset(table_name, query={}, prefix = prefix,
-                        value = db_item, cache_time = cache_time, hkey='%s'%(hkeyvalue))
-
-                else:
-                    pass                 
+                    mapping['%s'%(hkeyvalue)] = db_item
 
                 result.append(db_item)
 
-            hash_key = self.redis_proxy.generateKey(table_name, prefix = prefix, query = query, pack=False)
-            if cache_time:
-                self.get_redis().expire(hash_key, cache_time)
-            if cache_kw:
-                self.cacheKeyword(hash_key,{},cache_kw,prefix="")
+            if cache:
+                #整个hash一次pipeline写入,与RedisProxy.hash_get_all读取的是同一个key
+                hash_key = self.redis_proxy.hashset_many(table_name, prefix = prefix, mapping = mapping, cache_time = self.jitter_ttl(cache_time), pack = pack)
+                if cache_kw:
+                    self.cacheKeyword(hash_key,{},cache_kw,prefix="")
         except Exception, e:
             self.logger.error('[Dal.hash_get_all] error %s, bt: %s' %(e, traceback.format_exc()))
 
         return result
     
     def get_range_by_page(self, page, count):
-        if page <= 0:
-            begin_i = 0
-            end_i = -1
-        else:
-            begin_i = (page - 1) * count
-            end_i = begin_i + count - 1
-        
-        return (begin_i, end_i)
+        return get_range_by_page(page, count)
 
     #--------------sorted-set部分---------------------------
     #获取全部列表
@@ -1031,15 +2208,32 @@ class Dal(object):
 
     #--------------sorted-set部分---------------------------
 
-    #重新加载分页数据
+    #重新加载分页数据: need为需要加载的数量,None时加载全部
     @ctime(NAME)
-    def load_page_data(self, table, prefix="", query={}, cache_time=43200, sort=None, cache_kw=None, criteria=None):
+    def load_page_data(self, table, prefix="", query={}, cache_time=43200, sort=None, cache_kw=None, criteria=None, need=None):
         key = self.redis_proxy.generateKey(table, prefix, query, sort, name="pagecache", criteria=criteria, pack=True)
+        meta, rows = self._extend_page_index(table, key, query, sort, cache_time, cache_kw, None, need)
+        return rows
+
+    #加载分页索引的一个窗口: meta为None时重建并用count缓存total,否则从meta["loaded"]处继续加载到need
+    #返回(新的元数据, 本次加载的行)
+    def _extend_page_index(self, table, key, query, sort, cache_time, cache_kw, meta, need=None):
+        if meta is None:
+            offset = 0
+            total = self.get_mongodb()[table].find(query).count()
+            ttl = self.jitter_ttl(cache_time)
+        else:
+            offset = meta["loaded"]
+            total = meta["total"]
+            ttl = meta["ttl"]
+        limit = need - offset if need else 0
+        if need and limit <= 0:
+            return meta, []
+
         fields = {"_id":1}
         if sort:
-            fields[sort[0]] = 1
-        if sort:
-            sort_field =sort[0]
+            sort_field = sort[0]
+            fields[sort_field] = 1
         else:
             sort_field = "sort_field"
 
@@ -1049,9 +2243,13 @@ class Dal(object):
                 cursor = cursor.sort(*sort)
             else:
                 cursor = cursor.sort(sort)
-        
-        sorted_id_result = list(cursor)
-        for r in sorted_id_result:
+        if offset:
+            cursor = cursor.skip(offset)
+        if limit:
+            cursor = cursor.limit(limit)
+
+        rows = list(cursor.batch_size(1000))
+        for r in rows:
             r["_id"] = str(r.get("_id"))
             if sort:
                 score = r.get(sort_field, 0.0)
@@ -1061,16 +2259,72 @@ class Dal(object):
             if score:
                 try:
                     score = float(score)
-                except ValueError:
+                except (TypeError, ValueError):
                     score = 0
             r[sort_field] = score
-        
-        z_id_score_list = [(r.get("_id"),0.0 if not sort else r.get(sort_field)) for r in sorted_id_result]
-        self.redis_proxy.strict_pipeline_zadd(key, z_id_score_list)
-        self.get_redis().expire(key, cache_time)
+
+        #没有取满说明已经到了结果末尾,用实际数量修正缓存的count
+        if not limit or len(rows) < limit:
+            total = offset + len(rows)
+        self.redis_proxy.page_index_extend(key, [r["_id"] for r in rows], offset, total, ttl)
+        if offset == 0 and cache_kw:
+            self.cacheKeyword([key, page_meta_key(key)], query, cache_kw)
+        if self.debug:
+            self.logger.debug("[Dal._extend_page_index]key=%s, offset=%s, loaded=%s, total=%s" %(key, offset, len(rows), total))
+        return {"total": total, "loaded": offset + len(rows), "ttl": ttl}, rows
+
+    #按_id列表批量读取文档,与find_one(query={"_id": _id})共用缓存key: 近端缓存之后一次MGET,未命中的一次$in查询,一个pipeline回写
+    #返回结果与ids顺序一致,不存在的文档位置为None; prefix和criteria与find_one的参数含义相同
+    @ctime(NAME)
+    def find_many_by_ids(self, table, ids, criteria=None, cache_time=3600, cache_kw=None, prefix=""):
+        prefix = "find_one" if not prefix else "%s_find_one" %prefix
+        pack = self.serializer_for(table)
+        keys = [self.redis_proxy.generateKey(table, prefix, {"_id":_id}, criteria=criteria, pack=pack) for _id in ids]
+        items = [None] * len(keys)
+        near_cache = self.redis_proxy.get_near_cache(table)
+        if near_cache is not None:
+            for i, key in enumerate(keys):
+                items[i] = unwrap_swr(self.redis_proxy.near_get(near_cache, key))
+
+        remote = [i for i, item in enumerate(items) if item is None]
+        if remote:
+            values = self.redis_proxy.strict_mget([keys[i] for i in remote], pack=pack)
+            for i, value in zip(remote, values):
+                if value is not None:
+                    items[i] = unwrap_swr(value)
+                    if near_cache is not None:
+                        self.redis_proxy.near_set(near_cache, keys[i], value)
+
+        #合法的ObjectId按ObjectId查询,其他类型的_id按原值查询
+        miss_ids = list(set(ObjectId(_id) if ObjectId.is_valid(_id) else _id for _id, item in zip(ids, items) if item is None))
+        if miss_ids:
+            query = {"_id": {"$in": miss_ids}}
+            if criteria:
+                cursor = self.get_mongodb()[table].find(query, criteria)
+            else:
+                cursor = self.get_mongodb()[table].find(query)
+
+            loaded = {}
+            for r in stringify_ids(list(cursor), pack):
+                loaded[str(r.get("_id"))] = r
+
+            key_value_dict = {}
+            for i, _id in enumerate(ids):
+                item = loaded.get(str(_id))
+                if items[i] is None and item is not None:
+                    items[i] = item
+                    key_value_dict[keys[i]] = item
+            self.redis_proxy.strict_pipeline_set(key_value_dict, cache_time=cache_time, pack=pack)
+            if near_cache is not None:
+                for key, item in key_value_dict.iteritems():
+                    self.redis_proxy.near_set(near_cache, key, item)
+
+            if self.debug:
+                self.logger.debug("[Dal.find_many_by_ids]table=%s, ids=%s, miss=%s, loaded=%s" %(table, len(ids), len(miss_ids), len(loaded)))
+
         if cache_kw:
-            self.cacheKeyword(key,query,cache_kw)
-        return sorted_id_result
+            self.cacheKeyword(keys, {}, cache_kw, prefix="")
+        return items
 
     #分页获取表数据
     @ctime(NAME)
@@ -1080,30 +2334,18 @@ class Dal(object):
         page_count = 0
         current_count = 0
         try:
-            sorted_id_result = None
             key = self.redis_proxy.generateKey(table, prefix, query, sort, name="pagecache", criteria=criteria)
             start, stop = self.get_range_by_page(page, count)
-            
-            if self.redis_proxy.exists(key):
-                total = self.redis_proxy.strict_zcard(key)
+            meta, sorted_id_result = self.redis_proxy.page_index_range(key, start, stop)
 
-                esc = True
-                if sort and len(sort) > 1 and sort[1] < 0:
-                    esc = False
-
-                if esc:
-                    sorted_id_result = self.redis_proxy.strict_zrange(key, start, stop, prefix)
-                else:
-                    sorted_id_result = self.redis_proxy.strict_zrevrange(key, start, stop, prefix)
-            else:
-                sorted_id_result = self.load_page_data(table, prefix, query, cache_time, sort, cache_kw=cache_kw, criteria=criteria)
-                if cache_kw:
-                    self.cacheKeyword(key,query,cache_kw)
-                total = len(sorted_id_result)
-                if count > 0:
-                    sorted_id_result = [r.get("_id") for r in sorted_id_result][start:stop+1]
-                else:
-                    sorted_id_result = [r.get("_id") for r in sorted_id_result]
+            #索引不存在,或者请求的位置还没有加载时,加载到请求页之后page_window页; page<=0时读取全部,需要加载完整的索引
+            need = stop + 1 if page > 0 and count > 0 else None
+            if meta is None or (meta["loaded"] < meta["total"] and (need is None or meta["loaded"] < need)):
+                if need is not None:
+                    need += count * self.page_window
+                meta = self.load_once("%s_%s" %(key, need), lambda: self._extend_page_index(table, key, query, sort, cache_time, cache_kw, meta, need)[0], copy_result=False)
+                sorted_id_result = self.redis_proxy.strict_zrange(key, start, stop) or []
+            total = meta["total"]
 
             current_count = len(sorted_id_result)
             if self.debug:
@@ -1113,80 +2355,96 @@ class Dal(object):
                 return result,page_count,current_count,total
             
             page_count = len(sorted_id_result)
-            for _id in sorted_id_result:
-                item = self.find_one(table, query={"_id":ObjectId(_id)},criteria=criteria,cache=True,cache_time=300)
-                find_one_key=self.redis_proxy.generateKey(table, "find_one",{"_id":_id},criteria=criteria,pack=True)
-                self.cacheKeyword(find_one_key,{},cache_kw,prefix="")
-                if item:
-                    result.append(item)
-            
+            items = self.find_many_by_ids(table, sorted_id_result, criteria=criteria, cache_time=300, cache_kw=cache_kw)
+            result = [item for item in items if item]
+
             return result,page_count,current_count,total
         except Exception, e:
             self.logger.error('[Dal.find_by_page] error %s, bt: %s' %(e, traceback.format_exc()))
             return result,page_count,current_count,total
 
+    #keyset分页: 用排序字段的范围条件加_id决胜取下一页,不使用skip,深翻页的耗时与页码无关,并发插入也不会让页边界错位
+    #after为上一次返回的token,None表示第一页; 返回(result, next_token),没有下一页时next_token为None
+    #文档通过find_many_by_ids读取,与find_one共用缓存; 排序字段需要有(sort_field, _id)的复合索引,且所有文档中的类型一致
     @ctime(NAME)
-    def clearCachesByKeys(self, table, prefix="", query={}):
-        keys = self.redis_proxy.keys(table, prefix, query)
-        if keys:
-            self.redis_proxy.clearCacheByKey(*keys)
+    def find_after(self, table, query={}, sort=None, after=None, count=20, criteria=None, cache_time=300, cache_kw=None):
+        result = []
+        next_token = None
+        try:
+            sort_field, direction = keyset_sort(sort)
+            find_query = query
+            if after:
+                find_query = keyset_query(query, sort_field, direction, decode_page_token(after, sort_field, direction))
+
+            fields = {"_id": 1, sort_field: 1}
+            sort_spec = [(sort_field, direction)] if sort_field == "_id" else [(sort_field, direction), ("_id", direction)]
+            rows = list(self.get_mongodb()[table].find(find_query, fields).sort(sort_spec).limit(count + 1))
+            if len(rows) > count:
+                rows = rows[:count]
+                last = rows[-1]
+                next_token = encode_page_token(sort_field, direction, last.get(sort_field), last["_id"])
+
+            if rows:
+                items = self.find_many_by_ids(table, [r["_id"] for r in rows], criteria=criteria, cache_time=cache_time, cache_kw=cache_kw)
+                result = [item for item in items if item]
+            if self.debug:
+                self.logger.debug("[Dal.find_after]table=%s, query=%s, sort=%s, after=%s, count=%s, result=%s" %(table, query, sort, after, count, len(result)))
+        except Exception, e:
+            self.logger.error("[Dal.find_after]error %s, bt: %s" %(e, traceback.format_exc()))
+        return result, next_token
+
+    #以SCAN+UNLINK分批清除匹配的缓存key,返回进度统计{"scanned","deleted","batches","done","error"}
+    #background=True时在后台线程执行,立即返回会持续更新的进度dict
+    @ctime(NAME)
+    def clearCachesByKeys(self, table, prefix="", query={}, count=1000, batch_size=500, background=False):
+        progress = {"scanned": 0, "deleted": 0, "batches": 0, "done": False, "error": None}
+        self.invalidate_near_cache(prefixes=[self.redis_proxy.scanPrefix(table, prefix, query)])
+
+        def _clear():
+            try:
+                for keys in self.redis_proxy.scan_keys(table, prefix, query, count=count, batch_size=batch_size):
+                    progress["scanned"] += len(keys)
+                    progress["deleted"] += self.redis_proxy.unlink(*keys) or 0
+                    progress["batches"] += 1
+            except Exception, e:
+                progress["error"] = str(e)
+                self.logger.error("[Dal.clearCachesByKeys]error, %s" %traceback.format_exc())
+            finally:
+                progress["done"] = True
+                if self.debug:
+                    self.logger.debug("[Dal.clearCachesByKeys]table=%s, prefix=%s, query=%s, progress=%s" %(table, prefix, query, progress))
+
+        if background:
+            t = threading.Thread(target=_clear, name="clearCachesByKeys")
+            t.setDaemon(True)
+            t.start()
+        else:
+            _clear()
+        return progress
 
     @ctime(NAME)
     def clearCache(self, table, prefix="", query={}):
         self.redis_proxy.clearCache(table, prefix, query)
 
-    #缓存关联的key集合
+    #缓存关联的key集合,key可以是单个key或key列表
     def cacheKeyword(self,key,query,cache_kw,prefix=""):
         cache_time=86400
-        if prefix is None:
-            prefix = ""
         if cache_kw:
-            if isinstance(cache_kw,(str,unicode)):
-                vkey = query.get(cache_kw) if cache_kw in query else cache_kw
-                cache_key = prefix+vkey
-                self.redis_proxy.strict_sadd(cache_key,key,pack=False,cache_time=cache_time)
-            elif isinstance(cache_kw,tuple):
-                for kw in cache_kw:
-                    vkey = query.get(cache_kw) if cache_kw in query else cache_kw
-                    cache_key = prefix+vkey
-                    self.redis_proxy.strict_sadd(cache_key,key,pack=False,cache_time=cache_time)
-            elif isinstance(cache_kw,dict):
-                for key,value in cache_kw.iteritems():
-                    cache_key =  "%s%s_%s" %(prefix,key,value)
-                    self.redis_proxy.strict_sadd(cache_key,key,pack=False,cache_time=cache_time)
+            members = key if isinstance(key, list) else [key]
+            self.redis_proxy.strict_pipeline_kw_sadd(kw_keys(cache_kw,prefix,query),members,cache_time=cache_time)
 
     #清除关联的key集合
     @ctime(NAME)
     def clearKwCache(self,cache_kw,prefix=""):
         if not cache_kw:
             return
-        if prefix is None:
-            prefix = ""
-
-        kw_list = []
-        cachekey_list = []
-        if isinstance(cache_kw,(str,unicode)):
-            cache_key = prefix + cache_kw
-            cachekey_list = self.redis_proxy.strict_sinter(cache_key,pack=False)
-            kw_list.append(cache_key)
-        elif isinstance(cache_kw,tuple):
-            for kw in cache_kw:
-                cache_key = prefix + kw
-                cachekey_list = cachekey_list + self.redis_proxy.strict_sinter(cache_key,pack=False)
-                kw_list.append(cache_key)
-        elif isinstance(cache_kw,dict):
-            for key,value in cache_kw.iteritems():
-                cache_key = "%s%s_%s" %(prefix,key,value)
-                cachekey_list = cachekey_list + self.redis_proxy.strict_sinter(cache_key,pack=False)
-                kw_list.append(cache_key)
-
-        if cachekey_list and kw_list:
-            for key in cachekey_list:
-                self.redis_proxy.delete(key)
-            for kw in kw_list:
-                self.redis_proxy.delete(kw)
-            del cachekey_list
-            del kw_list
+
+        kw_list = kw_keys(cache_kw,prefix)
+        count, cachekey_list = self.redis_proxy.clear_kw_keys(kw_list, return_members=self.near_cache is not None)
+        if cachekey_list:
+            self.invalidate_near_cache(keys=cachekey_list)
+        if self.debug:
+            self.logger.debug("[Dal.clearKwCache]kw_list=%s, count=%s" %(kw_list, count))
 
 
     def get_stat(self,func):
@@ -1202,6 +2460,55 @@ class Dal(object):
         if stat_infos:
             self.logger.info(stat_infos)
 
+        stat_infos = "STAT-singleflight-%s" %(self.single_flight.get_stat())
+        if func:
+            func(stat_infos)
+        self.logger.info(stat_infos)
+
+        for conn_pool in (self.redis_conn_pool, self.mongodb_conn_pool, self.ddb_conn_pool):
+            if conn_pool is not None and conn_pool.size:
+                stat_infos = "STAT-pool-%s-%s" %(conn_pool.name, conn_pool.get_stat())
+                if func:
+                    func(stat_infos)
+                self.logger.info(stat_infos)
+
+        for consumer in self.pubsub_consumers:
+            stat_infos = "STAT-%s-%s" %(consumer.name, consumer.get_stat())
+            if func:
+                func(stat_infos)
+            self.logger.info(stat_infos)
+
+        if self.publish_worker is not None or self.publish_stat["sent"]:
+            with self.publish_lock:
+                stat_infos = "STAT-publish-%s" %(dict(self.publish_stat, pending=self.publish_queue.qsize()))
+            if func:
+                func(stat_infos)
+            self.logger.info(stat_infos)
+
+        if self.op_tracer is not None:
+            stat_infos = "STAT-fanout-%s" %(self.op_tracer.get_stat())
+            if func:
+                func(stat_infos)
+            self.logger.info(stat_infos)
+
+        if self.counter is not None:
+            stat_infos = "STAT-counter-%s" %(self.counter.get_stat())
+            if func:
+                func(stat_infos)
+            self.logger.info(stat_infos)
+
+        if self.compressor.threshold or self.compressor.decompressed:
+            stat_infos = "STAT-compress-%s" %(self.compressor.get_stat())
+            if func:
+                func(stat_infos)
+            self.logger.info(stat_infos)
+
+        if self.near_cache is not None:
+            stat_infos = "STAT-nearcache-%s" %(self.near_cache.get_stat())
+            if func:
+                func(stat_infos)
+            self.logger.info(stat_infos)
+
 #测试代码
 if '__main__' == __name__:
     import sys
@@ -1,7 +1,14 @@
 #!/usr/bin/env python
 #-*- coding:utf-8 -*-
 
+import copy
+import math
 import time
+import timeit
+import weakref
+import functools
+import threading
+from collections import OrderedDict
 
 def enum(*sequential, **named):
     enums = dict(zip(sequential, range(len(sequential))), **named)
@@ -14,58 +21,311 @@ def safe_int(value, default=None):
     except Exception:
         return default
 
+#计时器: python3使用perf_counter,python2使用timeit.default_timer(当前平台精度最高的时钟)
+timer = getattr(time, "perf_counter", None) or timeit.default_timer
+
+#HDR风格的对数-线性直方图,以微秒为单位记录耗时;每个2的幂区间再分成2**SUB_BITS个桶,相对误差约3%
+class LatencyHistogram(object):
+    SUB_BITS = 5
+    SUB_COUNT = 1 << SUB_BITS
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @classmethod
+    def bucket_index(cls, us):
+        if us < (cls.SUB_COUNT << 1):
+            return us
+        shift = us.bit_length() - cls.SUB_BITS - 1
+        return shift * cls.SUB_COUNT + (us >> shift)
+
+    #桶内的最大值(微秒)
+    @classmethod
+    def bucket_value(cls, index):
+        if index < (cls.SUB_COUNT << 1):
+            return index
+        shift = index // cls.SUB_COUNT - 1
+        return ((index - shift * cls.SUB_COUNT + 1) << shift) - 1
+
+    def record(self, seconds):
+        index = self.bucket_index(int(seconds * 1000000))
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        return self
+
+    #返回self减去更早的快照other后的直方图;max取剩余桶中的最大值
+    def diff(self, other):
+        result = LatencyHistogram()
+        for index, count in self.counts.iteritems():
+            count -= other.counts.get(index, 0)
+            if count > 0:
+                result.counts[index] = count
+        result.count = self.count - other.count
+        result.total = self.total - other.total
+        if result.counts:
+            result.max = min(self.max, self.bucket_value(max(result.counts)) / 1000000.0)
+        return result
+
+    #百分位耗时(秒),p取0~1
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        threshold = max(1, int(math.ceil(p * self.count)))
+        cumulative = 0
+        for index in sorted(self.counts):
+            cumulative += self.counts[index]
+            if cumulative >= threshold:
+                return min(self.bucket_value(index) / 1000000.0, self.max)
+        return self.max
+
+    def summary(self):
+        return {"count": self.count, "sum": self.total, "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5), "p90": self.percentile(0.9), "p99": self.percentile(0.99),
+            "p999": self.percentile(0.999), "max": self.max}
+
+#按线程分片的直方图收集器: 每个线程只写自己的分片,不需要加锁;快照时合并所有分片,不会清空数据;
+#线程退出后,快照时把它的分片并入retired并删除
+class HistogramCollector(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.shards = []
+        self.retired = {}
+        self.local = threading.local()
+
+    def record(self, func_name, seconds):
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append((weakref.ref(threading.current_thread()), shard))
+        hist = shard.get(func_name)
+        if hist is None:
+            hist = shard[func_name] = LatencyHistogram()
+        hist.record(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            alive = []
+            for ref, shard in self.shards:
+                thread = ref()
+                if thread is not None and thread.is_alive():
+                    alive.append((ref, shard))
+                    continue
+                for func_name, hist in shard.items():
+                    self.retired.setdefault(func_name, LatencyHistogram()).merge(hist)
+            self.shards = alive
+            shards = [shard for _, shard in alive]
+            result = dict((func_name, LatencyHistogram().merge(hist)) for func_name, hist in self.retired.iteritems())
+        for shard in shards:
+            for func_name, hist in shard.items():
+                result.setdefault(func_name, LatencyHistogram()).merge(hist)
+        return result
+
 class StatNameSpace(object):
     OPT_TIMES="opt_times"
     OPT_COST ="opt_cost"
-    name_stat = {}
-    
+    collectors = {}
+    #设置后ctime在每次调用前后执行op_tracer.enter(name)/exit(),见optrace.OpTracer
+    op_tracer = None
+    #get_stat上一次读取时的快照,get_stat只输出两次读取之间的增量
+    last_snapshots = {}
+    lock = threading.Lock()
+
+    @classmethod
+    def get_collector(cls, name):
+        collector = cls.collectors.get(name)
+        if collector is None:
+            with cls.lock:
+                collector = cls.collectors.setdefault(name, HistogramCollector())
+        return collector
+
+    #不清空数据的快照: {func_name: {count, sum, mean, p50, p90, p99, p999, max}},耗时单位为秒
+    @classmethod
+    def snapshot(cls, name):
+        collector = cls.collectors.get(name)
+        if not collector:
+            return {}
+        return dict((func_name, hist.summary()) for func_name, hist in collector.snapshot().iteritems())
+
     @classmethod
     def get_times(cls, name):
-        return cls.name_stat.get(name, {}).get(StatNameSpace.OPT_TIMES, {})
+        return dict((func_name, stat["count"]) for func_name, stat in cls.snapshot(name).iteritems())
     
     @classmethod
     def get_cost(cls, name):
-        return cls.name_stat.get(name, {}).get(StatNameSpace.OPT_COST, {})
+        return dict((func_name, stat["sum"]) for func_name, stat in cls.snapshot(name).iteritems())
     
+    #兼容原有格式,输出自上次调用以来的次数、总耗时、平均耗时以及百分位耗时
     @classmethod
     def get_stat(cls, name, prefix=""):
-        name_statinfo = cls.name_stat.get(name)
-        if not name_statinfo:
+        collector = cls.collectors.get(name)
+        if not collector:
+            return ""
+
+        current = collector.snapshot()
+        with cls.lock:
+            last = cls.last_snapshots.get(name, {})
+            cls.last_snapshots[name] = current
+        interval = {}
+        for func_name, hist in current.iteritems():
+            delta = hist.diff(last[func_name]) if func_name in last else hist
+            if delta.count:
+                interval[func_name] = delta.summary()
+        if not interval:
             return ""
-        
-        opt_times = name_statinfo.get(cls.OPT_TIMES)
-        opt_cost = name_statinfo.get(cls.OPT_COST)
-        handler_times = ["%s:%s" %(name, opt_times.get(name)) for name in opt_times.iterkeys()]
-        handler_cost =  ["%s:%ss" %(name, opt_cost.get(name))  for name in opt_cost.iterkeys()]
-        average_cost = ["%s:%ss" %(name, round(opt_cost.get(name, 1)/opt_times.get(name, 1), 3)) for name in opt_cost.iterkeys()]
-        opt_cost.clear()
-        opt_times.clear()
-        return "STAT-%s-exec count:%s - cost:%s - average:%s" %(prefix, handler_times, handler_cost, average_cost)
+
+        handler_times = ["%s:%s" %(func_name, stat["count"]) for func_name, stat in interval.iteritems()]
+        handler_cost =  ["%s:%ss" %(func_name, round(stat["sum"], 6)) for func_name, stat in interval.iteritems()]
+        average_cost = ["%s:%ss" %(func_name, round(stat["mean"], 6)) for func_name, stat in interval.iteritems()]
+        percentile_cost = ["%s:%s/%s/%s/%s/%ss" %(func_name, round(stat["p50"], 6), round(stat["p90"], 6), round(stat["p99"], 6),
+            round(stat["p999"], 6), round(stat["max"], 6)) for func_name, stat in interval.iteritems()]
+        return "STAT-%s-exec count:%s - cost:%s - average:%s - p50/p90/p99/p999/max:%s" %(prefix, handler_times, handler_cost, average_cost, percentile_cost)
     
 def ctime(name):
     def _ctime(func):
+        op_name = "%s.%s" %(name, func.__name__)
+        @functools.wraps(func)
         def __ctime(*args, **kwargs):
-            #print("before %s called." % func.__name__)
-            begin = time.time()
-            ret = func(*args, **kwargs)
-            end = time.time()
-            opt_times = StatNameSpace.get_times(name)
-            opt_cost = StatNameSpace.get_cost(name)
-            
-            n_times = opt_times.get(func.__name__)
-            if n_times:
-                opt_times[func.__name__] += 1
-            else:
-                opt_times[func.__name__] = 1
-                
-            n_cost = opt_cost.get(func.__name__)
-            if n_cost:
-                opt_cost[func.__name__] += round(end-begin, 3)
-            else:
-                opt_cost[func.__name__] = round(end-begin, 3)
-            
-            StatNameSpace.name_stat[name] = {StatNameSpace.OPT_COST: opt_cost, StatNameSpace.OPT_TIMES: opt_times}
-            return ret
-            #print("after %s called. result: %s, cost:%ss" % (func.__name__, ret, round(end - begin, 3)))
+            begin = timer()
+            tracer = StatNameSpace.op_tracer
+            if tracer is not None:
+                tracer.enter(op_name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if tracer is not None:
+                    tracer.exit()
+                StatNameSpace.get_collector(name).record(func.__name__, timer() - begin)
         return __ctime
     return _ctime
+
+#带过期时间的有界LRU缓存,线程安全,用作进程内的近端缓存
+class LRUCache(object):
+    def __init__(self, maxsize=1024, ttl=5):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return default
+            value, expire_at = item
+            if expire_at and expire_at < time.time():
+                self.expired += 1
+                self.misses += 1
+                return default
+            self.data[key] = item
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None or (self.ttl and ttl > self.ttl):
+            ttl = self.ttl
+        expire_at = time.time() + ttl if ttl else 0
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (value, expire_at)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys=None, prefixes=None):
+        count = 0
+        with self.lock:
+            for key in keys or []:
+                if self.data.pop(key, None) is not None:
+                    count += 1
+            if prefixes:
+                prefixes = tuple(prefixes)
+                for key in [k for k in self.data.iterkeys() if k.startswith(prefixes)]:
+                    del self.data[key]
+                    count += 1
+            self.invalidations += count
+        return count
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def get_stat(self):
+        return {"size": len(self.data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses,
+            "evictions": self.evictions, "expired": self.expired, "invalidations": self.invalidations}
+
+class _FlightCall(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+#同一个key的并发调用合并为一次执行,其余调用等待执行结果;copy_result为True时等待方拿到结果的深拷贝
+#有等待方时,执行方在唤醒等待方之前先深拷贝一份私有的结果,等待方从这份拷贝再拷贝,执行方修改自己拿到的结果不影响等待方
+class SingleFlight(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.stat = {}
+
+    def incr(self, name, count=1):
+        with self.lock:
+            self.stat[name] = self.stat.get(name, 0) + count
+
+    def do(self, key, func, copy_result=True):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _FlightCall()
+                self.stat["leaders"] = self.stat.get("leaders", 0) + 1
+            else:
+                call.waiters += 1
+                self.stat["coalesced"] = self.stat.get("coalesced", 0) + 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result) if copy_result else call.result
+
+        result = None
+        try:
+            result = func()
+            return result
+        except Exception, e:
+            call.error = e
+            raise
+        finally:
+            #出队后不会再有新的等待方
+            with self.lock:
+                self.calls.pop(key, None)
+            try:
+                call.result = copy.deepcopy(result) if copy_result and call.waiters else result
+            except Exception, e:
+                call.error = e
+            call.event.set()
+
+    def get_stat(self):
+        with self.lock:
+            return dict(self.stat, inflight=len(self.calls))
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import types
+import threading
+from langs import HistogramCollector
+
+"""
+按Dal操作统计redis命令和mongodb查询的扇出,用于发现N+1等访问模式
+    ctime装饰的方法在调用前后执行OpTracer.enter/exit,同一线程内嵌套的调用(find_by_page -> find_one -> RedisProxy.get)
+    都归到最外层的操作上; 没有处于任何操作中的调用(后台线程等)归到"background"
+    TracedRedis/TracedMongo包装get_redis/get_mongodb返回的客户端,每次调用记一次往返:
+        redis: 往返次数, 命令数(pipeline中的每条命令都计数), 估算的发送/接收字节数(参数和返回值的长度)
+        mongodb: 集合方法的调用次数(find的游标只计一次,getMore不计)
+    每个操作结束时把各项计数记入分布,get_stat输出每个操作的次数和各项的p50/p99/max
+"""
+METRICS = ("redis_rtt", "redis_cmds", "bytes_out", "bytes_in", "mongo_queries")
+BACKGROUND_OP = "background"
+
+def estimate_size(value):
+    if value is None:
+        return 0
+    if isinstance(value, (str, unicode, bytearray)):
+        return len(value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sum(estimate_size(v) for v in value)
+    if isinstance(value, dict):
+        return sum(estimate_size(k) + estimate_size(v) for k, v in value.iteritems())
+    return len(str(value))
+
+#parent不为空时是其他线程中代为执行的部分(如Dal.fan_out),计数累加到parent上
+class OpContext(object):
+    __slots__ = ("name", "depth", "counts", "lock", "parent")
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.depth = 0
+        self.counts = dict.fromkeys(METRICS, 0)
+        self.lock = threading.Lock()
+        self.parent = parent
+
+    def add(self, **counts):
+        target = self.parent or self
+        with target.lock:
+            for metric, value in counts.iteritems():
+                target.counts[metric] += value
+
+class OpTracer(object):
+    def __init__(self):
+        self.local = threading.local()
+        self.collector = HistogramCollector()
+
+    def enter(self, name):
+        ctx = getattr(self.local, "ctx", None)
+        if ctx is None:
+            self.local.ctx = OpContext(name)
+        else:
+            ctx.depth += 1
+
+    def exit(self):
+        ctx = getattr(self.local, "ctx", None)
+        if ctx is None:
+            return
+        if ctx.depth:
+            ctx.depth -= 1
+            return
+        self.local.ctx = None
+        self.record(ctx.name, ctx.counts)
+
+    def current(self):
+        return getattr(self.local, "ctx", None)
+
+    #在其他线程中执行属于ctx的调用(如Dal.fan_out),结束后调用detach
+    def attach(self, ctx):
+        self.local.ctx = OpContext(ctx.name, ctx.parent or ctx) if ctx is not None else None
+
+    def detach(self):
+        self.local.ctx = None
+
+    def add(self, **counts):
+        ctx = getattr(self.local, "ctx", None)
+        if ctx is None:
+            #后台调用没有结束点,每次调用单独记录
+            self.record(BACKGROUND_OP, dict(dict.fromkeys(METRICS, 0), **counts))
+            return
+        ctx.add(**counts)
+
+    #计数按"个"记录,借用以微秒为单位的直方图: 计数n记为n微秒
+    def record(self, name, counts):
+        for metric, value in counts.iteritems():
+            self.collector.record("%s|%s" %(name, metric), value / 1000000.0)
+
+    #{操作: {"count": 次数, 指标: {"p50", "p99", "max", "mean"}}}
+    def get_stat(self):
+        result = {}
+        for key, hist in self.collector.snapshot().iteritems():
+            name, metric = key.split("|", 1)
+            op = result.setdefault(name, {})
+            op["count"] = hist.count
+            op[metric] = {"p50": int(round(hist.percentile(0.5) * 1000000)), "p99": int(round(hist.percentile(0.99) * 1000000)),
+                "max": int(round(hist.max * 1000000)), "mean": round(hist.total * 1000000 / hist.count, 2) if hist.count else 0.0}
+        return result
+
+class TracedRedis(object):
+    def __init__(self, client, tracer):
+        self._client = client
+        self._tracer = tracer
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+        if name == "pipeline":
+            return self._pipeline
+        tracer = self._tracer
+
+        def _call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if isinstance(result, types.GeneratorType):
+                return self._iter(result, args, kwargs)
+            tracer.add(redis_rtt=1, redis_cmds=1, bytes_out=estimate_size(args) + estimate_size(kwargs.values()),
+                bytes_in=estimate_size(result))
+            return result
+        return _call
+
+    #scan_iter等迭代器按迭代到的数据累计接收字节数
+    def _iter(self, source, args, kwargs):
+        tracer = self._tracer
+        tracer.add(redis_rtt=1, redis_cmds=1, bytes_out=estimate_size(args) + estimate_size(kwargs.values()))
+        for item in source:
+            tracer.add(bytes_in=estimate_size(item))
+            yield item
+
+    #返回原始的pipeline对象(lua脚本需要识别pipeline类型),只替换execute统计整批命令
+    def _pipeline(self, *args, **kwargs):
+        pipe_cmd = self._client.pipeline(*args, **kwargs)
+        execute = pipe_cmd.execute
+        tracer = self._tracer
+
+        def _execute(*exec_args, **exec_kwargs):
+            commands = list(getattr(pipe_cmd, "command_stack", []))
+            result = execute(*exec_args, **exec_kwargs)
+            tracer.add(redis_rtt=1 if commands else 0, redis_cmds=len(commands),
+                bytes_out=sum(estimate_size(command[0]) for command in commands), bytes_in=estimate_size(result))
+            return result
+        pipe_cmd.execute = _execute
+        return pipe_cmd
+
+class TracedMongo(object):
+    def __init__(self, db, tracer):
+        self._db = db
+        self._tracer = tracer
+
+    def __getitem__(self, name):
+        return TracedCollection(self._db[name], self._tracer)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+class TracedCollection(object):
+    def __init__(self, collection, tracer):
+        self._collection = collection
+        self._tracer = tracer
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+        tracer = self._tracer
+        if name.startswith("initialize_"):
+            #bulk操作在execute时才发送
+            def _bulk(*args, **kwargs):
+                bulk = attr(*args, **kwargs)
+                execute = bulk.execute
+
+                def _execute(*exec_args, **exec_kwargs):
+                    tracer.add(mongo_queries=1)
+                    return execute(*exec_args, **exec_kwargs)
+                bulk.execute = _execute
+                return bulk
+            return _bulk
+
+        def _call(*args, **kwargs):
+            tracer.add(mongo_queries=1)
+            return attr(*args, **kwargs)
+        return _call
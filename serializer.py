@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import json
+import struct
+import calendar
+import datetime
+import msgpack
+from bson import ObjectId
+from bson.decimal128 import Decimal128
+from bson.tz_util import utc
+from langs import timer
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+"""
+缓存值的序列化器注册表, Dal的pack参数即为序列化器:
+    True: "msgpack", 旧格式,不支持BSON类型,读写前需要把_id转成str
+    False: "json", 旧格式,安装了ujson时用ujson解码
+    字符串: 注册表中的序列化器名称,如"bson_msgpack"; 缓存key以"$pack_<名称>"结尾,与旧格式的key互不影响
+native为True的序列化器可以直接保存ObjectId/datetime/Decimal128,Dal不再把_id转成str
+"""
+SERIALIZERS = {}
+
+class Serializer(object):
+    name = None
+    native = False
+
+    def dumps(self, value):
+        raise NotImplementedError()
+
+    def loads(self, data):
+        raise NotImplementedError()
+
+class MsgpackSerializer(Serializer):
+    name = "msgpack"
+
+    def dumps(self, value):
+        return msgpack.packb(value)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, use_list = True)
+
+class JsonSerializer(Serializer):
+    name = "json"
+
+    def dumps(self, value):
+        return json.dumps(value)
+
+    def loads(self, data):
+        if ujson is not None:
+            return ujson.loads(data, precise_float=True)
+        return json.loads(data, "UTF-8")
+
+EXT_OBJECTID = 1
+EXT_DATETIME = 2
+EXT_DECIMAL128 = 3
+EPOCH = datetime.datetime(1970, 1, 1)
+
+#msgpack扩展类型: ObjectId为12字节, datetime为UTC微秒数(8字节)加是否带时区(1字节), Decimal128为16字节BID
+def _ext_default(obj):
+    if isinstance(obj, ObjectId):
+        return msgpack.ExtType(EXT_OBJECTID, obj.binary)
+    if isinstance(obj, datetime.datetime):
+        aware = obj.utcoffset() is not None
+        if aware:
+            seconds = calendar.timegm(obj.utctimetuple())
+        else:
+            seconds = calendar.timegm(obj.timetuple())
+        return msgpack.ExtType(EXT_DATETIME, struct.pack(">qB", seconds * 1000000 + obj.microsecond, aware))
+    if isinstance(obj, Decimal128):
+        return msgpack.ExtType(EXT_DECIMAL128, obj.bid)
+    raise TypeError("unsupported type %s" %type(obj))
+
+def _ext_hook(code, data):
+    if code == EXT_OBJECTID:
+        return ObjectId(data)
+    if code == EXT_DATETIME:
+        micros, aware = struct.unpack(">qB", data)
+        result = EPOCH + datetime.timedelta(microseconds=micros)
+        return result.replace(tzinfo=utc) if aware else result
+    if code == EXT_DECIMAL128:
+        return Decimal128.from_bid(data)
+    return msgpack.ExtType(code, data)
+
+class BsonMsgpackSerializer(Serializer):
+    name = "bson_msgpack"
+    native = True
+
+    def dumps(self, value):
+        return msgpack.packb(value, default=_ext_default)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, use_list = True, ext_hook=_ext_hook)
+
+def register_serializer(serializer):
+    SERIALIZERS[serializer.name] = serializer
+
+def get_serializer(pack=True):
+    #非字符串的pack(True/1/None等)按真假选择,与旧版本的pack参数兼容
+    if not isinstance(pack, basestring):
+        return SERIALIZERS["msgpack" if pack else "json"]
+    serializer = SERIALIZERS.get(pack)
+    if serializer is None:
+        raise Exception("get_serializer error, unknown serializer %s" %pack)
+    return serializer
+
+for _serializer in (MsgpackSerializer(), JsonSerializer(), BsonMsgpackSerializer()):
+    register_serializer(_serializer)
+
+#比较各序列化器对docs的编解码吞吐,返回{名称: {"encode_ops", "decode_ops", "bytes"}}
+#旧格式的序列化器不支持BSON类型,先按Dal的方式把_id转成str,datetime等仍不支持的序列化器跳过
+def benchmark(docs, rounds=1000, names=None):
+    result = {}
+    for name, serializer in sorted(SERIALIZERS.iteritems()):
+        if names and name not in names:
+            continue
+        values = docs
+        if not serializer.native:
+            values = [dict(doc, _id=str(doc["_id"])) if "_id" in doc else doc for doc in docs]
+        try:
+            data = [serializer.dumps(value) for value in values]
+        except (TypeError, ValueError):
+            continue
+        begin = timer()
+        for _ in xrange(rounds):
+            for value in values:
+                serializer.dumps(value)
+        encode_cost = timer() - begin
+        begin = timer()
+        for _ in xrange(rounds):
+            for d in data:
+                serializer.loads(d)
+        decode_cost = timer() - begin
+        count = float(rounds * len(values))
+        result[name] = {"encode_ops": round(count / encode_cost, 1) if encode_cost else 0.0,
+            "decode_ops": round(count / decode_cost, 1) if decode_cost else 0.0,
+            "bytes": sum(len(d) for d in data) / len(data) if data else 0}
+    return result
+
+if __name__ == "__main__":
+    sample = {"_id": ObjectId(), "uid": 10086, "name": u"用户昵称", "tags": ["a", "b", "c"], "score": 98.5,
+        "profile": {"level": 12, "vip": True, "city": "shenzhen"}, "items": range(20)}
+    print "plain  ", benchmark([sample], rounds=20000)
+    sample = dict(sample, created=datetime.datetime.utcnow(), balance=Decimal128("1024.50"))
+    print "bson   ", benchmark([sample], rounds=20000)
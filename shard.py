@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import bisect
+import struct
+import hashlib
+import threading
+
+"""
+缓存key在多个redis实例间的一致性哈希分片
+每个节点按权重在环上放置replicas个虚拟节点,key落在顺时针方向的第一个虚拟节点上;
+增加或删除一个节点只影响环上相邻区间的key,约1/N的key需要重新分布
+key以"{tag}"开头时按tag路由(hash tag),同一个tag的key总在同一个节点上,可以在一个pipeline/事务中读写
+"""
+def routing_key(key):
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    if key.startswith("{"):
+        end = key.find("}", 1)
+        if end > 1:
+            return key[1:end]
+    return key
+
+#为key加上hash tag,以"{tag}"开头的其他key(如分页索引的元数据)与其路由到同一节点
+def shard_tag(key):
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    if key.startswith("{"):
+        return key
+    return "{%s}%s" %(hashlib.md5(key).hexdigest()[:12], key)
+
+def _hash(value):
+    return struct.unpack(">I", hashlib.md5(value).digest()[:4])[0]
+
+class HashRing(object):
+    def __init__(self, replicas=160):
+        self.replicas = replicas
+        self.weights = {}
+        self.ring = ([], [])
+        self.lock = threading.Lock()
+
+    def add_node(self, name, weight=1):
+        with self.lock:
+            self.weights[name] = weight
+            self._build()
+
+    def remove_node(self, name):
+        with self.lock:
+            if self.weights.pop(name, None) is not None:
+                self._build()
+
+    def _build(self):
+        ring = []
+        for name, weight in self.weights.iteritems():
+            for i in xrange(int(self.replicas * weight)):
+                ring.append((_hash("%s#%s" %(name, i)), name))
+        ring.sort()
+        #整体替换,读取方不加锁也只会看到完整的环
+        self.ring = ([point for point, _ in ring], [name for _, name in ring])
+
+    def get_node(self, key):
+        points, point_nodes = self.ring
+        if not points:
+            return None
+        index = bisect.bisect(points, _hash(routing_key(key)))
+        return point_nodes[index % len(points)]
+
+    def nodes(self):
+        return sorted(self.weights)
+
+    def __len__(self):
+        return len(self.weights)
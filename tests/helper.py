@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import os
+import sys
+import logging
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fakeredis
+import mongomock
+from connpool import ConnectionPool
+from dal import Dal
+
+"""
+测试用的Dal: redis使用独立的fakeredis实例,mongodb使用mongomock
+    运行: python -m unittest discover -s tests
+"""
+class RecordHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+def make_dal(size=2, redis_client=None, **kwargs):
+    if redis_client is None:
+        redis_client = fakeredis.FakeStrictRedis(singleton=False)
+    mongo_db = mongomock.MongoClient()["dal_test"]
+    logger = logging.getLogger("dal_test_%s" %id(redis_client))
+    logger.propagate = False
+    logger.errors = RecordHandler()
+    logger.addHandler(logger.errors)
+    redis_pool = ConnectionPool(lambda num: redis_client, size=size, name="redis")
+    mongodb_pool = ConnectionPool(lambda num: mongo_db, size=size, name="mongodb")
+    return Dal(redis_pool, mongodb_pool, logger, debug=False, **kwargs), redis_client, mongo_db
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import unittest
+import redis
+from helper import make_dal
+
+try:
+    import tornadis
+    from tornado import gen
+    from tornado.concurrent import Future
+    from tornado.testing import AsyncTestCase, gen_test
+    from asyncdal import AsyncDal
+except ImportError:
+    tornadis = None
+    AsyncTestCase = unittest.TestCase
+    gen_test = lambda func: func
+
+"""
+AsyncDal的测试: tornadis.Client和motor数据库用内存中的替身代替,与同步的Dal共用同一个fakeredis和mongomock
+    FakeTornadis按tornadis的约定执行命令: redis的错误作为ClientError返回而不是抛出,pipeline返回每条命令的结果
+    fakeredis不支持lua脚本和UNLINK,这两个命令返回unknown command错误
+"""
+def _done(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+class FakeTornadis(object):
+    UNSUPPORTED = ("EVAL", "EVALSHA", "UNLINK")
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+        #{命令: 异常},模拟连接中断等错误
+        self.errors = {}
+
+    def call(self, *args):
+        if len(args) == 1 and isinstance(args[0], tornadis.Pipeline):
+            return _done(self._pipeline(args[0].pipelined_args))
+        return _done(self._execute(args))
+
+    def _pipeline(self, commands):
+        result = []
+        queued = None
+        for args in commands:
+            name = args[0].upper()
+            if "MULTI" == name:
+                queued = []
+                result.append("OK")
+            elif "EXEC" == name:
+                result.append(queued)
+                queued = None
+            elif queued is not None:
+                queued.append(self._execute(args))
+                result.append("QUEUED")
+            else:
+                result.append(self._execute(args))
+        return result
+
+    def _execute(self, args):
+        name, args = args[0].upper(), list(args[1:])
+        self.commands.append(name)
+        try:
+            return self._dispatch(name, args)
+        except redis.ResponseError, e:
+            return tornadis.ClientError(str(e))
+        except redis.ConnectionError, e:
+            return tornadis.ConnectionError(str(e))
+
+    def _dispatch(self, name, args):
+        client = self.client
+        if name in self.errors:
+            raise self.errors[name]
+        if name in self.UNSUPPORTED:
+            raise redis.ResponseError("ERR unknown command '%s'" %name)
+        if "SET" == name:
+            options = [str(arg).upper() for arg in args[2:]]
+            ex = int(args[args.index("EX") + 1]) if "EX" in options else None
+            return "OK" if client.set(args[0], args[1], ex=ex, nx="NX" in options, xx="XX" in options) else None
+        if "HMSET" == name:
+            client.hmset(args[0], dict(zip(args[1::2], args[2::2])))
+            return "OK"
+        if "HGETALL" == name:
+            return [item for pair in client.hgetall(args[0]).iteritems() for item in pair]
+        if name in ("ZRANGE", "ZREVRANGE"):
+            withscores = len(args) > 3
+            result = client.zrange(args[0], int(args[1]), int(args[2]), desc="ZREVRANGE" == name, withscores=withscores)
+            return [str(item) for pair in result for item in pair] if withscores else result
+        if "MGET" == name:
+            return client.mget(args)
+        if "SMEMBERS" == name:
+            return list(client.smembers(args[0]))
+        if "TTL" == name:
+            return client.ttl(args[0])
+        if "DEL" == name:
+            return client.delete(*args)
+        result = getattr(client, name.lower())(*args)
+        if isinstance(result, bool):
+            return int(result)
+        return result
+
+class FakeMotorCursor(object):
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        self.cursor = self.cursor.sort(*args, **kwargs)
+        return self
+
+    def skip(self, count):
+        self.cursor = self.cursor.skip(count)
+        return self
+
+    def limit(self, count):
+        self.cursor = self.cursor.limit(count)
+        return self
+
+    def count(self):
+        return _done(self.cursor.count())
+
+    def to_list(self, length=None):
+        return _done(list(self.cursor))
+
+class FakeMotorCollection(object):
+    def __init__(self, collection):
+        self.collection = collection
+
+    def find(self, *args, **kwargs):
+        return FakeMotorCursor(self.collection.find(*args, **kwargs))
+
+    def __getattr__(self, name):
+        attr = getattr(self.collection, name)
+        return lambda *args, **kwargs: _done(attr(*args, **kwargs))
+
+class FakeMotorDatabase(object):
+    def __init__(self, db):
+        self.db = db
+
+    def __getitem__(self, name):
+        return FakeMotorCollection(self.db[name])
+
+@unittest.skipIf(tornadis is None, "tornado/tornadis not installed")
+class AsyncDalTest(AsyncTestCase):
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        self.dal, self.redis, self.db = make_dal()
+        self.tornadis = FakeTornadis(self.redis)
+        self.async_dal = AsyncDal(self.tornadis, FakeMotorDatabase(self.db), self.dal.logger, debug=False)
+        self.db.user.insert_many([{"_id": i, "uid": i, "g": i % 2} for i in xrange(10)])
+
+    def tearDown(self):
+        AsyncTestCase.tearDown(self)
+        self.assertEqual([r.getMessage() for r in self.dal.logger.errors.records], [])
+
+    @gen_test
+    def test_find_one_shares_cache_with_dal(self):
+        doc = yield self.async_dal.find_one("user", query={"uid": 1})
+        self.assertEqual(doc, {"_id": "1", "uid": 1, "g": 1})
+        self.db.user.update_one({"uid": 1}, {"$set": {"g": 5}})
+        self.assertEqual(self.dal.find_one("user", query={"uid": 1}), doc)
+        self.assertEqual(self.dal.find_one("user", query={"uid": 2})["uid"], 2)
+        self.db.user.delete_one({"uid": 2})
+        doc = yield self.async_dal.find_one("user", query={"uid": 2})
+        self.assertEqual(doc["uid"], 2)
+
+    @gen_test
+    def test_update_clears_cache(self):
+        yield self.async_dal.find_one("user", query={"uid": 3})
+        status = yield self.async_dal.update("user", prefix="find_one", value={"$set": {"g": 7}}, query={"uid": 3})
+        self.assertTrue(status)
+        doc = yield self.async_dal.find_one("user", query={"uid": 3})
+        self.assertEqual(doc["g"], 7)
+
+    @gen_test
+    def test_nfind_cached(self):
+        rows = yield self.async_dal.nfind("user", query={"g": 0}, sort=("uid", 1))
+        self.assertEqual([r["uid"] for r in rows], [0, 2, 4, 6, 8])
+        self.db.user.delete_many({})
+        rows = yield self.async_dal.nfind("user", query={"g": 0}, sort=("uid", 1))
+        self.assertEqual(len(rows), 5)
+
+    @gen_test
+    def test_load_once_merges_concurrent_loads(self):
+        calls = []
+
+        @gen.coroutine
+        def _load():
+            calls.append(1)
+            yield gen.moment
+            raise gen.Return({"v": [1]})
+        first, second = yield [self.async_dal.load_once("k", _load), self.async_dal.load_once("k", _load)]
+        self.assertEqual((first, second, len(calls)), ({"v": [1]}, {"v": [1]}, 1))
+        self.assertIsNot(first, second)
+
+    @gen_test
+    def test_strict_family(self):
+        proxy = self.async_dal.redis_proxy
+        yield proxy.strict_set("s", {"a": 1}, 60)
+        self.assertEqual((yield proxy.strict_get("s")), {"a": 1})
+        self.assertEqual((yield proxy.strict_mget(["s", "missing"])), [{"a": 1}, None])
+        self.assertTrue((yield proxy.strict_setnx("nx", "1")))
+        self.assertFalse((yield proxy.strict_setnx("nx", "2")))
+        yield proxy.strict_sadd("set", [1, 2], cache_time=60)
+        self.assertEqual(sorted((yield proxy.strict_sinter("set"))), [1, 2])
+        self.assertGreater(self.redis.ttl("set"), 0)
+        yield proxy.strict_hset("h", "f", {"x": 1}, cache_time=60)
+        self.assertEqual((yield proxy.strict_hget("h", "f")), {"x": 1})
+        yield proxy.strict_pipeline_zadd("z", [("a", 2), ("b", 1)])
+        self.assertEqual((yield proxy.strict_zrange("z", 0, -1, withscores=True)), [("b", 1.0), ("a", 2.0)])
+        yield proxy.strict_incr("n")
+        yield proxy.strict_incrby("n", 4)
+        self.assertEqual(self.redis.get("n"), "5")
+
+    @gen_test
+    def test_find_by_page(self):
+        self.db.user.delete_many({})
+        from bson import ObjectId
+        self.db.user.insert_many([{"_id": ObjectId(), "uid": i} for i in xrange(30)])
+        result, page_count, _, total = yield self.async_dal.find_by_page("user", query={}, sort=("uid", 1), page=2, count=10)
+        self.assertEqual(([r["uid"] for r in result], total), (range(10, 20), 30))
+        #同步的Dal读取同一个分页索引
+        result, _, _, total = self.dal.find_by_page("user", query={}, sort=("uid", 1), page=3, count=10)
+        self.assertEqual(([r["uid"] for r in result], total), (range(20, 30), 30))
+
+    @gen_test
+    def test_find_by_page_zero_returns_all_rows(self):
+        self.db.user.delete_many({})
+        from bson import ObjectId
+        self.db.user.insert_many([{"_id": ObjectId(), "uid": i} for i in xrange(150)])
+        result, _, _, total = yield self.async_dal.find_by_page("user", query={}, sort=("uid", 1), page=0, count=20)
+        self.assertEqual(([r["uid"] for r in result], total), (range(150), 150))
+
+    def fill_kw(self, cache_kw):
+        keys = ["kw_member_%s_%s" %(cache_kw, i) for i in xrange(3)]
+        for key in keys:
+            self.redis.set(key, 1)
+        self.dal.cacheKeyword(keys, {}, cache_kw)
+        return keys + [cache_kw]
+
+    def pop_errors(self):
+        messages = [r.getMessage() for r in self.dal.logger.errors.records]
+        del self.dal.logger.errors.records[:]
+        return messages
+
+    #fakeredis不支持EVAL和UNLINK: 脚本停用后用SMEMBERS和DEL清除,各只记录一次日志
+    @gen_test
+    def test_kw_clear_falls_back_without_scripting(self):
+        for i in xrange(3):
+            keys = self.fill_kw("kw%s" %i)
+            status = yield self.async_dal.insert("user", value={"_id": 100 + i}, cache_kw="kw%s" %i)
+            self.assertTrue(status)
+            self.assertEqual([key for key in keys if self.redis.exists(key)], [])
+        proxy = self.async_dal.redis_proxy
+        self.assertEqual((proxy.kw_clear_script, proxy.unlink_supported), (False, False))
+        messages = self.pop_errors()
+        self.assertEqual(len(messages), 2)
+        self.assertIn("script error, disabled", messages[0])
+        self.assertIn("UNLINK unsupported", messages[1])
+        self.assertEqual(self.tornadis.commands.count("EVAL"), 1)
+
+    @gen_test
+    def test_kw_clear_transient_script_error_keeps_script(self):
+        self.tornadis.errors["EVAL"] = redis.ConnectionError("Error 104 while reading from socket")
+        for i in xrange(2):
+            keys = self.fill_kw("kw%s" %i)
+            yield self.async_dal.clearKwCache("kw%s" %i)
+            self.assertEqual([key for key in keys if self.redis.exists(key)], [])
+        self.assertTrue(self.async_dal.redis_proxy.kw_clear_script)
+        self.assertEqual(len([m for m in self.pop_errors() if "script error, fallback" in m]), 2)
+        self.assertEqual(self.tornadis.commands.count("EVAL"), 2)
+
+    @gen_test
+    def test_pubsub_publish(self):
+        pubsub = self.redis.pubsub()
+        pubsub.subscribe("ch")
+        pubsub.get_message()
+        yield self.async_dal.pubsub_publish("ch", {"a": 1})
+        message = pubsub.get_message()
+        self.assertEqual(message["channel"], "ch")
+
+if __name__ == "__main__":
+    unittest.main()
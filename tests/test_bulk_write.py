@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import unittest
+from helper import make_dal
+
+class BulkWriteTest(unittest.TestCase):
+    def setUp(self):
+        self.dal, self.redis, self.db = make_dal()
+        self.ops = [{"op": "insert", "value": {"_id": 1, "uid": 1}},
+            {"op": "upsert", "value": {"_id": 2}},
+            {"op": "update", "query": {"_id": 3}},
+            {"op": "insert", "value": {"_id": 4, "uid": 4}},
+            {"op": "delete", "query": {"_id": 1}}]
+
+    def test_unordered_skips_bad_ops(self):
+        summary = self.dal.bulk_write("user", self.ops)
+        results = summary["results"]
+        self.assertEqual([r["ok"] for r in results], [True, False, False, True, True])
+        self.assertIn("unknown op upsert", results[1]["error"])
+        self.assertIn("value", results[2]["error"])
+        self.assertEqual(summary["errors"], 2)
+        self.assertEqual(sorted(d["_id"] for d in self.db.user.find()), [4])
+
+    def test_ordered_stops_at_first_bad_op(self):
+        summary = self.dal.bulk_write("user", self.ops, ordered=True)
+        results = summary["results"]
+        self.assertEqual([r["ok"] for r in results], [True, False, False, False, False])
+        self.assertIn("unknown op upsert", results[1]["error"])
+        self.assertEqual(results[2]["error"], "not executed")
+        self.assertEqual(summary["errors"], 4)
+        self.assertEqual([d["_id"] for d in self.db.user.find()], [1])
+
+    def test_all_bad_ops(self):
+        summary = self.dal.bulk_write("user", [{"op": "update", "query": {}, "value": {"$set": {"a": 1}, "b": 2}}, None])
+        self.assertEqual(summary["errors"], 2)
+        self.assertEqual(summary["inserted"], 0)
+        self.assertEqual(self.dal.logger.errors.records, [])
+
+    def test_connection_failure_reported(self):
+        def _fail():
+            raise Exception("ConnectionPool(mongodb) checkout timeout")
+        self.dal.get_mongodb = _fail
+        summary = self.dal.bulk_write("user", self.ops[:2])
+        self.assertEqual(summary["errors"], 2)
+        self.assertEqual([r["error"] for r in summary["results"]], ["ConnectionPool(mongodb) checkout timeout"] * 2)
+        self.assertEqual(len(self.dal.logger.errors.records), 1)
+
+if __name__ == "__main__":
+    unittest.main()
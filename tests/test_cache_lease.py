@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import time
+import threading
+import unittest
+from helper import make_dal
+
+class CacheLeaseTest(unittest.TestCase):
+    def setUp(self):
+        self.dal, self.redis, self.db = make_dal(cache_lease_time=10, cache_lease_wait=1.0)
+        self.db.user.insert_one({"_id": 1, "uid": 1})
+
+    def hold_lease(self, query, seconds):
+        key = self.dal.redis_proxy.generateKey("user", "find_one", query, pack=True)
+        lease_key = "lease_%s" %key
+        self.redis.set(lease_key, 1)
+        timer = threading.Timer(seconds, self.redis.delete, args=(lease_key,))
+        timer.start()
+        return timer
+
+    #执行方没有写入缓存(文档不存在)时,租约释放后立即自行回源,不等满cache_lease_wait
+    def test_missing_document_stops_waiting_after_release(self):
+        self.hold_lease({"uid": 2}, 0.1)
+        begin = time.time()
+        self.assertIsNone(self.dal.find_one("user", query={"uid": 2}))
+        self.assertLess(time.time() - begin, 0.5)
+        self.assertEqual(self.dal.single_flight.get_stat().get("lease_released"), 1)
+
+    #执行方写入缓存后,等待方直接读取缓存,不回源
+    def test_reads_value_written_by_leader(self):
+        timer = self.hold_lease({"uid": 1}, 0.3)
+        threading.Timer(0.1, self.dal.redis_proxy.set, args=("user", "find_one", {"uid": 1, "cached": True}, {"uid": 1})).start()
+        result = self.dal.find_one("user", query={"uid": 1})
+        timer.join()
+        self.assertEqual(result, {"uid": 1, "cached": True})
+        self.assertEqual(self.dal.single_flight.get_stat().get("lease_hits"), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import gc
+import threading
+import unittest
+import helper
+import fakeredis
+import mongomock
+from connpool import ConnectionPool
+
+#在线程中调用func,返回结果,线程在release之前不退出
+class Worker(object):
+    def __init__(self, func):
+        self.func = func
+        self.ready = threading.Event()
+        self.go = threading.Event()
+        self.result = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.start()
+        self.ready.wait(5)
+
+    def _run(self):
+        self.result = self.func()
+        self.ready.set()
+        self.go.wait(5)
+        self.result = self.func()
+
+    def call_again(self):
+        self.go.set()
+        self.thread.join(5)
+        return self.result
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.clients = dict((num, fakeredis.FakeStrictRedis(singleton=False)) for num in (1, 2))
+        self.pool = ConnectionPool(lambda num: self.clients[num], size=2, name="redis")
+
+    def test_affinity_balanced_and_released_on_exit(self):
+        workers = [Worker(self.pool.slot) for _ in xrange(4)]
+        self.assertEqual(sorted(w.result for w in workers), [1, 1, 2, 2])
+        self.assertEqual(self.pool.get_stat()["bound_threads"], {1: 2, 2: 2})
+        for w in workers:
+            w.call_again()
+        gc.collect()
+        self.assertEqual(self.pool.get_stat()["bound_threads"], {1: 0, 2: 0})
+
+    def test_checkout_exclusive_and_timeout(self):
+        first = self.pool.checkout()
+        second = Worker(lambda: self.pool.checkout())
+        self.assertEqual(sorted([first, second.result]), [1, 2])
+        self.assertRaises(Exception, self.pool.checkout, 0.01)
+        stat = self.pool.get_stat()
+        self.assertEqual((stat["in_use"], stat["timeouts"]), (2, 1))
+        self.pool.checkin(first)
+        self.assertEqual(self.pool.checkout(0.01), first)
+        self.pool.checkin(first)
+        self.pool.checkin(second.result)
+        second.call_again()
+        self.pool.checkin(second.result)
+
+    def test_checkout_avoids_bound_slots(self):
+        bound = Worker(self.pool.slot)
+        slot = self.pool.checkout()
+        self.assertNotEqual(slot, bound.result)
+        self.pool.checkin(slot)
+        bound.call_again()
+
+    def test_bound_thread_moves_off_checked_out_slot(self):
+        workers = [Worker(self.pool.slot) for _ in xrange(2)]
+        slot = self.pool.checkout()
+        owner = [w for w in workers if w.result == slot][0]
+        self.assertNotEqual(owner.call_again(), slot)
+        self.assertEqual(self.pool.get_stat()["bound_threads"][slot], 0)
+        self.pool.checkin(slot)
+        for w in workers:
+            if w is not owner:
+                w.call_again()
+
+    def test_connection_context(self):
+        with self.pool.connection() as client:
+            client.set("k", "v")
+            self.assertEqual(self.pool.get_stat()["in_use"], 1)
+            self.assertIs(self.pool.get(), client)
+            with self.pool.connection() as inner:
+                self.assertIs(inner, client)
+        self.assertEqual(self.pool.get_stat()["in_use"], 0)
+        self.assertEqual(sum(1 for c in self.clients.values() if c.get("k") == "v"), 1)
+
+    def test_mongodb_pool(self):
+        dbs = dict((num, mongomock.MongoClient()["db_%s" %num]) for num in (1, 2, 3))
+        pool = ConnectionPool(lambda num: dbs.get(num), name="mongodb")
+        with pool.connection() as db:
+            db.user.insert_one({"_id": 1})
+        self.assertEqual(pool.size, 3)
+        self.assertEqual(sum(d.user.count_documents({}) for d in dbs.values()), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import unittest
+import redis
+import fakeredis
+from helper import make_dal
+
+#pipeline执行时连接出错的节点
+class DownRedis(object):
+    def __init__(self):
+        self.client = fakeredis.FakeStrictRedis(singleton=False)
+        self.down = True
+
+    def pipeline(self, *args, **kwargs):
+        pipe_cmd = self.client.pipeline(*args, **kwargs)
+        if self.down:
+            def _execute(*args, **kwargs):
+                raise redis.ConnectionError("Error 111 connecting")
+            pipe_cmd.execute = _execute
+        return pipe_cmd
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+class CounterAggregatorTest(unittest.TestCase):
+    def setUp(self):
+        self.dal, self.redis, self.db = make_dal(counter_interval=60)
+        self.up = fakeredis.FakeStrictRedis(singleton=False)
+        self.down = DownRedis()
+        self.dal.add_redis("up", self.up, shard=True)
+        self.dal.add_redis("down", self.down, shard=True)
+        self.counter = self.dal.counter
+
+    def tearDown(self):
+        self.counter.closed = True
+        self.counter.wakeup.set()
+
+    def node_keys(self, name, count=40):
+        return [key for key in ("c%s" %i for i in xrange(count)) if self.dal.shard_ring.get_node(key) == name]
+
+    #一个节点出错时只重试该节点的增量,已写入的节点不会重复累加
+    def test_failed_shard_restored_alone(self):
+        for key in self.node_keys("up") + self.node_keys("down"):
+            self.counter.add(key, 2)
+        self.assertEqual(self.counter.flush(), len(self.node_keys("up")))
+        self.assertEqual(self.counter.get_stat()["pending"], len(self.node_keys("down")))
+        self.down.down = False
+        self.assertEqual(self.counter.flush(), len(self.node_keys("down")))
+        for key in self.node_keys("up"):
+            self.assertEqual(self.up.get(key), "2")
+        for key in self.node_keys("down"):
+            self.assertEqual(self.down.client.get(key), "2")
+        self.assertEqual(len(self.dal.logger.errors.records), 1)
+
+    #redis拒绝的命令不重试
+    def test_rejected_command_dropped(self):
+        self.down.down = False
+        key = self.node_keys("up")[0]
+        self.up.hset(key, "f", 1)
+        self.counter.add(key, 1)
+        self.counter.add(self.node_keys("up")[1], 1)
+        self.assertEqual(self.counter.flush(), 2)
+        stat = self.counter.get_stat()
+        self.assertEqual((stat["pending"], stat["dropped"]), (0, 1))
+
+class CounterOutageTest(unittest.TestCase):
+    def setUp(self):
+        self.down = DownRedis()
+        self.dal, _, _ = make_dal(redis_client=self.down, counter_interval=60, counter_max_keys=5)
+        self.counter = self.dal.counter
+        self.flushes = []
+        flush = self.counter.flush
+        self.counter.flush = lambda force=True: self.flushes.append(force) or flush(force)
+
+    def tearDown(self):
+        self.counter.closed = True
+        self.counter.wakeup.set()
+
+    #redis故障时调用方线程只同步刷新一次,之后新的key丢弃,已有的key继续合并
+    def test_add_does_not_retry_inline_during_outage(self):
+        for i in xrange(100):
+            self.counter.add("c%s" %i)
+        for i in xrange(5):
+            self.counter.add("c%s" %i)
+        self.assertEqual(self.flushes, [False])
+        self.assertEqual(len(self.dal.logger.errors.records), 1)
+        stat = self.counter.get_stat()
+        self.assertEqual((stat["pending"], stat["dropped"]), (5, 95))
+        self.down.down = False
+        self.counter.failed_at = 0
+        self.assertEqual(self.counter.flush(), 5)
+        self.assertEqual([self.down.client.get("c%s" %i) for i in xrange(5)], ["2"] * 5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import unittest
+from bson import ObjectId
+from helper import make_dal
+
+class FindByPageTest(unittest.TestCase):
+    def setUp(self):
+        self.dal, self.redis, self.db = make_dal()
+        self.db.user.insert_many([{"_id": ObjectId(), "uid": i} for i in xrange(150)])
+
+    def tearDown(self):
+        self.assertEqual(self.dal.logger.errors.records, [])
+
+    def test_page_zero_returns_all_rows(self):
+        result, page_count, current_count, total = self.dal.find_by_page("user", query={}, sort=("uid", 1), page=0, count=20)
+        self.assertEqual((len(result), page_count, total), (150, 150, 150))
+        self.assertEqual([r["uid"] for r in result], range(150))
+
+    def test_page_zero_after_partial_index(self):
+        result, _, _, total = self.dal.find_by_page("user", query={}, sort=("uid", 1), page=1, count=20)
+        self.assertEqual(([r["uid"] for r in result], total), (range(20), 150))
+        result, _, _, _ = self.dal.find_by_page("user", query={}, sort=("uid", 1), page=0, count=20)
+        self.assertEqual([r["uid"] for r in result], range(150))
+
+    def test_last_page(self):
+        result, _, _, _ = self.dal.find_by_page("user", query={}, sort=("uid", 1), page=8, count=20)
+        self.assertEqual([r["uid"] for r in result], range(140, 150))
+
+if __name__ == "__main__":
+    unittest.main()
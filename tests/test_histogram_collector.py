@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import threading
+import unittest
+import helper
+from langs import HistogramCollector
+
+class HistogramCollectorTest(unittest.TestCase):
+    def test_exited_threads_folded_into_retired(self):
+        collector = HistogramCollector()
+        collector.record("find_one", 0.001)
+        threads = [threading.Thread(target=collector.record, args=("find_one", 0.002)) for _ in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(collector.shards), 9)
+        self.assertEqual(collector.snapshot()["find_one"].count, 9)
+        self.assertEqual(len(collector.shards), 1)
+        collector.record("find_one", 0.001)
+        snapshot = collector.snapshot()
+        self.assertEqual(snapshot["find_one"].count, 10)
+        #snapshot返回的直方图不能是retired本身
+        snapshot["find_one"].record(0.001)
+        self.assertEqual(collector.snapshot()["find_one"].count, 10)
+
+if __name__ == "__main__":
+    unittest.main()
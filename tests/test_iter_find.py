@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import json
+import unittest
+from helper import make_dal
+
+class IterFindCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dal, self.redis, self.db = make_dal()
+        self.db.user.insert_many([{"_id": i, "uid": i, "name": "u%s" %i} for i in xrange(25)])
+
+    def tearDown(self):
+        self.assertEqual(self.dal.logger.errors.records, [])
+
+    def check_cached_read(self, pack):
+        first = list(self.dal.iter_find("user", query={}, cache=True, batch_size=10, pack=pack))
+        self.assertEqual(len(first), 25)
+        #清空mongodb,第二次只能从缓存的chunk读取
+        self.db.user.delete_many({})
+        second = list(self.dal.iter_find("user", query={}, cache=True, batch_size=10, pack=pack))
+        self.assertEqual(second, first)
+        self.assertEqual(second[3], {"_id": "3", "uid": 3, "name": "u3"})
+        return [key for key in self.redis.keys("*") if key.endswith("_$pack_%s_0" %int(pack))]
+
+    def test_pack_false_reads_back_cached_chunks(self):
+        keys = self.check_cached_read(False)
+        self.assertEqual(len(keys), 1)
+        self.assertEqual(len(json.loads(self.redis.get(keys[0]))), 10)
+
+    def test_pack_true_reads_back_cached_chunks(self):
+        self.check_cached_read(True)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import unittest
+import redis
+from helper import make_dal
+
+class FailingScript(object):
+    def __init__(self, error):
+        self.error = error
+        self.calls = 0
+
+    def __call__(self, keys=None, args=None, client=None):
+        self.calls += 1
+        raise self.error
+
+class KwClearTest(unittest.TestCase):
+    def setUp(self):
+        self.dal, self.redis, self.db = make_dal()
+        self.proxy = self.dal.redis_proxy
+
+    def fill(self, cache_kw, count=3):
+        keys = ["kw_member_%s_%s" %(cache_kw, i) for i in xrange(count)]
+        for key in keys:
+            self.redis.set(key, 1)
+        self.dal.cacheKeyword(keys, {}, cache_kw)
+        return keys
+
+    #fakeredis不支持lua脚本: 第一次失败后停用脚本,只记一次错误日志,之后直接使用pipeline
+    def test_script_failure_logged_once(self):
+        for i in xrange(3):
+            keys = self.fill("kw%s" %i)
+            self.dal.clearKwCache("kw%s" %i)
+            self.assertEqual([key for key in keys if self.redis.exists(key)], [])
+            self.assertFalse(self.redis.exists("kw%s" %i))
+        self.assertIs(self.proxy.kw_clear_script, False)
+        script_errors = [r for r in self.dal.logger.errors.records if "script error" in r.getMessage()]
+        self.assertEqual(len(script_errors), 1)
+
+    #连接中断等临时错误只在当次调用退化为pipeline,脚本保持启用
+    def test_transient_error_keeps_script(self):
+        script = self.proxy.kw_clear_script = FailingScript(redis.ConnectionError("Error 104 while reading from socket"))
+        for i in xrange(2):
+            keys = self.fill("kw%s" %i)
+            self.dal.clearKwCache("kw%s" %i)
+            self.assertEqual([key for key in keys + ["kw%s" %i] if self.redis.exists(key)], [])
+        self.assertIs(self.proxy.kw_clear_script, script)
+        self.assertEqual(script.calls, 2)
+        self.assertEqual(len([r for r in self.dal.logger.errors.records if "script error" in r.getMessage()]), 2)
+
+    def test_unsupported_error_disables_script(self):
+        for error in (redis.ResponseError("unknown command 'EVALSHA'"), redis.exceptions.NoScriptError("NOSCRIPT No matching script.")):
+            self.proxy.kw_clear_script = FailingScript(error)
+            keys = self.fill("kw")
+            self.dal.clearKwCache("kw")
+            self.assertEqual([key for key in keys + ["kw"] if self.redis.exists(key)], [])
+            self.assertIs(self.proxy.kw_clear_script, False)
+
+    def test_clear_keys_and_kw_after_script_disabled(self):
+        self.proxy.kw_clear_script = False
+        members = self.fill("kw")
+        self.redis.set("plain", 1)
+        count, _ = self.proxy.clear_keys_and_kw(["plain"], ["kw"])
+        self.assertEqual(count, len(members) + 1)
+        self.assertEqual([key for key in members + ["plain", "kw"] if self.redis.exists(key)], [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import unittest
+from helper import make_dal
+from langs import LRUCache
+
+class NearCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dal, self.redis, self.db = make_dal(near_cache=LRUCache(100, ttl=60))
+        self.db.user.insert_many([{"_id": i, "uid": i, "tags": ["a"]} for i in xrange(5)])
+
+    def test_find_one_result_not_shared(self):
+        doc = self.dal.find_one("user", query={"uid": 1})
+        doc["tags"].append("b")
+        doc["x"] = 1
+        again = self.dal.find_one("user", query={"uid": 1})
+        self.assertEqual(again["tags"], ["a"])
+        self.assertNotIn("x", again)
+        again["x"] = 2
+        self.assertNotIn("x", self.dal.find_one("user", query={"uid": 1}))
+
+    def test_find_many_by_ids_result_not_shared(self):
+        docs = self.dal.find_many_by_ids("user", [1, 2])
+        docs[0]["x"] = 1
+        for doc in self.dal.find_many_by_ids("user", [1, 2]) + [self.dal.find_one("user", query={"_id": 1})]:
+            self.assertNotIn("x", doc)
+
+if __name__ == "__main__":
+    unittest.main()
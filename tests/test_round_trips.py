@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import unittest
+import fakeredis
+from helper import make_dal
+
+#每次直接调用redis命令或执行一次pipeline记一次往返
+class CountingRedis(object):
+    def __init__(self, client):
+        self._client = client
+        self.round_trips = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+        if name == "pipeline":
+            return self._pipeline
+
+        def _call(*args, **kwargs):
+            self.round_trips += 1
+            return attr(*args, **kwargs)
+        return _call
+
+    def _pipeline(self, *args, **kwargs):
+        pipe_cmd = self._client.pipeline(*args, **kwargs)
+        execute = pipe_cmd.execute
+
+        def _execute(*exec_args, **exec_kwargs):
+            self.round_trips += 1
+            return execute(*exec_args, **exec_kwargs)
+        pipe_cmd.execute = _execute
+        return pipe_cmd
+
+class RoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.raw = fakeredis.FakeStrictRedis(singleton=False)
+        self.redis = CountingRedis(self.raw)
+        self.dal, _, self.db = make_dal(redis_client=self.redis)
+        self.proxy = self.dal.redis_proxy
+
+    #RedisProxy的方法出错时只记日志,没有错误日志才说明命令都执行成功了
+    def tearDown(self):
+        self.assertEqual([r.getMessage() for r in self.dal.logger.errors.records], [])
+
+    def assertRoundTrips(self, expected, func, *args, **kwargs):
+        self.redis.round_trips = 0
+        result = func(*args, **kwargs)
+        self.assertEqual(self.redis.round_trips, expected, "%s: %s round trips" %(func.__name__, self.redis.round_trips))
+        return result
+
+    def test_get_hit_and_miss(self):
+        self.assertIsNone(self.assertRoundTrips(1, self.proxy.get, "user", query={"uid": 1}))
+        self.proxy.set("user", value={"uid": 1}, query={"uid": 1}, cache_time=60)
+        self.assertEqual(self.assertRoundTrips(1, self.proxy.get, "user", query={"uid": 1}), {"uid": 1})
+
+    def test_writes_with_ttl(self):
+        self.assertRoundTrips(1, self.proxy.set, "user", value={"uid": 1}, query={"uid": 1}, cache_time=60)
+        self.assertRoundTrips(1, self.proxy.strict_set, "k_set", {"a": 1}, cache_time=60)
+        self.assertTrue(self.assertRoundTrips(1, self.proxy.strict_setnx, "k_nx", "v", cache_time=60))
+        self.assertFalse(self.assertRoundTrips(1, self.proxy.strict_setnx, "k_nx", "v", cache_time=60))
+        self.assertRoundTrips(1, self.proxy.strict_sadd, "k_sadd", "m", cache_time=60)
+        self.assertRoundTrips(1, self.proxy.strict_zadd, "k_zadd", "m", score=1, cache_time=60)
+        self.assertRoundTrips(1, self.proxy.strict_hset, "k_hset", "f", "v", cache_time=60)
+        self.assertRoundTrips(1, self.proxy.hashset, "user_hash", value={"uid": 1}, hkey="f", cache_time=60)
+        for key in self.raw.keys():
+            self.assertGreater(self.raw.ttl(key), 0, key)
+
+if __name__ == "__main__":
+    unittest.main()
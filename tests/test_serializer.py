@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import unittest
+import helper
+from serializer import get_serializer
+
+class GetSerializerTest(unittest.TestCase):
+    def test_non_string_pack_by_truth(self):
+        for pack in (True, 1, 2L):
+            self.assertEqual(get_serializer(pack).name, "msgpack")
+        for pack in (False, 0, None):
+            self.assertEqual(get_serializer(pack).name, "json")
+
+    def test_names(self):
+        self.assertEqual(get_serializer("bson_msgpack").name, "bson_msgpack")
+        self.assertEqual(get_serializer(u"json").name, "json")
+        self.assertRaises(Exception, get_serializer, "unknown")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import threading
+import unittest
+import helper
+from langs import SingleFlight
+
+class SingleFlightTest(unittest.TestCase):
+    #执行方返回后立即修改结果,等待方拿到的仍是完整的原始结果
+    def test_leader_mutation_not_seen_by_waiters(self):
+        flight = SingleFlight()
+        go = threading.Event()
+        results = {}
+        errors = []
+
+        def _load():
+            go.wait(5)
+            return {"items": dict((i, [i]) for i in xrange(20000))}
+
+        def _leader():
+            result = results["leader"] = flight.do("k", _load)
+            for i in xrange(20000, 40000):
+                result["items"][i] = [i]
+
+        def _waiter(n):
+            try:
+                results[n] = flight.do("k", _load)
+            except Exception, e:
+                errors.append(e)
+
+        leader = threading.Thread(target=_leader)
+        leader.start()
+        while not flight.calls:
+            pass
+        waiters = [threading.Thread(target=_waiter, args=(n,)) for n in xrange(4)]
+        for waiter in waiters:
+            waiter.start()
+        while flight.get_stat().get("coalesced", 0) < len(waiters):
+            pass
+        go.set()
+        for thread in [leader] + waiters:
+            thread.join(10)
+        self.assertEqual(errors, [])
+        for n in xrange(4):
+            self.assertEqual(len(results[n]["items"]), 20000)
+            self.assertIsNot(results[n]["items"], results["leader"]["items"])
+        self.assertEqual(len(results["leader"]["items"]), 40000)
+
+    def test_no_copy_without_waiters(self):
+        flight = SingleFlight()
+        value = {"a": [1]}
+        self.assertIs(flight.do("k", lambda: value), value)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+
+import unittest
+import redis
+import fakeredis
+from helper import make_dal
+
+#UNLINK总是返回error的客户端,其他命令交给fakeredis
+class UnlinkErrorRedis(object):
+    def __init__(self, error):
+        self.client = fakeredis.FakeStrictRedis(singleton=False)
+        self.error = error
+
+    def execute_command(self, *args):
+        raise self.error
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+class UnlinkTest(unittest.TestCase):
+    def test_unknown_command_falls_back_to_del(self):
+        dal, client, _ = make_dal(redis_client=UnlinkErrorRedis(redis.ResponseError("unknown command 'UNLINK'")))
+        client.set("a", 1)
+        self.assertEqual(dal.redis_proxy.unlink("a"), 1)
+        self.assertFalse(dal.redis_proxy.unlink_supported)
+        self.assertFalse(client.exists("a"))
+
+    def test_transient_error_keeps_unlink(self):
+        dal, client, _ = make_dal(redis_client=UnlinkErrorRedis(redis.ConnectionError("Error 104 while reading from socket")))
+        client.set("a", 1)
+        self.assertEqual(dal.redis_proxy.unlink("a"), 0)
+        self.assertTrue(dal.redis_proxy.unlink_supported)
+        messages = [r.getMessage() for r in dal.logger.errors.records]
+        self.assertEqual(len(messages), 1)
+        self.assertNotIn("unsupported", messages[0])
+
+if __name__ == "__main__":
+    unittest.main()